@@ -0,0 +1 @@
+"""Benchmarks of simpleacl, run with: python -m benchmarks.run --help"""
@@ -0,0 +1,127 @@
+"""Synthetic policy generators"""
+from __future__ import absolute_import, unicode_literals
+import random
+
+import simpleacl
+
+
+class PolicySpec(object):
+    """Shape of a generated policy"""
+
+    def __init__(self, roles=200, fanout=2, dotted_depth=3, privileges=100,
+                 privilege_depth=2, contexts=10, density=0.05,
+                 deny_ratio=0.2, seed=1):
+        self.roles = roles
+        self.fanout = fanout  # Explicit parents per role
+        self.dotted_depth = dotted_depth  # Longest chain of dotted names
+        self.privileges = privileges
+        self.privilege_depth = privilege_depth
+        self.contexts = contexts
+        self.density = density  # Rules per (role, privilege, context)
+        self.deny_ratio = deny_ratio
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def dotted_names(prefix, count, depth):
+    """Returns names in dotted chains of given depth: a0, a0.a1, ..."""
+    names = []
+    for i in range(count):
+        if depth > 1 and i % depth:
+            names.append('{0}.{1}{2}'.format(names[-1], prefix, i))
+        else:
+            names.append('{0}{1}'.format(prefix, i))
+    return names
+
+
+class Policy(object):
+    """Generated policy: names, rule rows and bulk_load() document.
+
+    Parents of a role are picked from the roles before it, so the
+    hierarchy has no cycles and the last role is the deepest one. Rules
+    for MISS_PRIVILEGE are never generated, and DEEP_PRIVILEGE is only
+    allowed to the first role, so checks of them walk the whole chain.
+    """
+
+    MISS_PRIVILEGE = 'bench.miss'
+    DEEP_PRIVILEGE = 'bench.deep'
+
+    def __init__(self, spec):
+        rnd = random.Random(spec.seed)
+        self.spec = spec
+        self.roles = dotted_names('r', spec.roles, spec.dotted_depth)
+        self.privileges = dotted_names('p', spec.privileges,
+                                       spec.privilege_depth)
+        self.contexts = [None] + ['c{0}'.format(i)
+                                  for i in range(spec.contexts)]
+        self.parents = {}
+        for i, role in enumerate(self.roles):
+            self.parents[role] = rnd.sample(self.roles[:i],
+                                            min(spec.fanout, i))
+        rules = {}
+        count = int(len(self.roles) * len(self.privileges) *
+                    len(self.contexts) * spec.density)
+        for i in range(count):
+            key = (rnd.choice(self.roles), rnd.choice(self.privileges),
+                   rnd.choice(self.contexts))
+            rules[key] = rnd.random() >= spec.deny_ratio
+        self.rules = [key + (allow, ) for key, allow in sorted(
+            rules.items(), key=lambda item: tuple(map(str, item[0]))
+        )]
+        self.rules.append((self.roles[0], self.DEEP_PRIVILEGE, None, True))
+        self.deep_role = self.roles[-1]
+        self.root_role = self.roles[0]
+
+    def all_privileges(self):
+        return self.privileges + [self.MISS_PRIVILEGE, self.DEEP_PRIVILEGE]
+
+    def document(self):
+        """Returns bulk_load() document of the rules in default context"""
+        return {
+            'roles': [[role, self.parents[role]] for role in self.roles],
+            'privileges': self.all_privileges(),
+            'acl': [{'role': role, 'privilege': privilege, 'allow': allow}
+                    for role, privilege, context, allow in self.rules
+                    if context is None],
+        }
+
+    def build(self, backend_class=None, cache_size=None):
+        """Returns Acl with the whole policy"""
+        acl = simpleacl.Acl(backend_class=backend_class,
+                            cache_size=cache_size)
+        for role in self.roles:
+            acl.add_role(role, self.parents[role])
+        for privilege in self.all_privileges():
+            acl.add_privilege(privilege)
+        acl.add_rules(self.rules)
+        return acl
+
+    def hit_queries(self, count, seed=2):
+        """Returns (role, privilege, context) of directly stored rules"""
+        rnd = random.Random(seed)
+        return [rule[:3] for rule in
+                (rnd.choice(self.rules) for i in range(count))]
+
+    def miss_queries(self, count, seed=3):
+        """Returns queries of roles without parents, which nothing decides"""
+        rnd = random.Random(seed)
+        roots = [role for role in self.roles
+                 if not self.parents[role] and '.' not in role]
+        return [(rnd.choice(roots), self.MISS_PRIVILEGE,
+                 rnd.choice(self.contexts)) for i in range(count)]
+
+    def deep_queries(self, count):
+        """Returns queries decided by the most distant ancestor"""
+        return [(self.deep_role, self.DEEP_PRIVILEGE, None)] * count
+
+
+CURRENT = None  # Policy which Builder builds, set by the runner
+
+
+class Builder(object):
+    """AclMiddleware builder of the CURRENT policy"""
+
+    def __call__(self):
+        return CURRENT.build()
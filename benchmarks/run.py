@@ -0,0 +1,267 @@
+"""Runs the benchmarks and writes the results as JSON.
+
+    python -m benchmarks.run --output before.json
+    python -m benchmarks.run --output after.json --compare before.json
+
+Timings are nanoseconds per operation: the best and the median of
+--repeat runs. Policies are generated from a fixed seed, so results of
+runs with the same options are comparable.
+"""
+from __future__ import absolute_import, unicode_literals, print_function
+import argparse
+import functools
+import gc
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import simpleacl
+from simpleacl.bitset import BitsetBackend
+from simpleacl.middleware import AclMiddleware
+from simpleacl.sqlite import SqliteBackend
+
+from benchmarks import policy as policies
+
+FORMAT_VERSION = 1
+
+BACKENDS = {
+    'simple': None,
+    'bitset': BitsetBackend,
+    'sqlite': SqliteBackend,
+}
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def measure(func, operations, repeat):
+    """Returns timing of func(), which performs that many operations"""
+    times = []
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = clock()
+            func()
+            times.append(clock() - start)
+    finally:
+        if enabled:
+            gc.enable()
+    times.sort()
+    return {
+        'operations': operations,
+        'best_ns': times[0] * 1e9 / operations,
+        'median_ns': times[len(times) // 2] * 1e9 / operations,
+    }
+
+
+def measure_memory(func):
+    """Returns result of func() and bytes it allocated"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {'retained_bytes': current, 'peak_bytes': peak}
+
+
+def bench_checks(policy, backend_class, options):
+    results = {}
+    acl = policy.build(backend_class)
+    queries = {
+        'hit': policy.hit_queries(options.queries),
+        'miss': policy.miss_queries(options.queries),
+        'deep': policy.deep_queries(options.queries),
+    }
+    for kind, batch in sorted(queries.items()):
+        def scalar(batch=batch):
+            check = acl.check
+            for role, privilege, context in batch:
+                check(role, privilege, context)
+
+        def batched(batch=batch):
+            acl.is_allowed_many(batch)
+
+        results['check_' + kind] = measure(scalar, len(batch), options.repeat)
+        results['check_many_' + kind] = measure(batched, len(batch),
+                                                options.repeat)
+
+    acl.set_active_role(policy.deep_role)
+    deep = policy.DEEP_PRIVILEGE
+
+    def active():
+        is_allowed = acl.is_allowed
+        for i in range(options.queries):
+            is_allowed(deep)
+    results['is_allowed_active_deep'] = measure(active, options.queries,
+                                                options.repeat)
+
+    cached = policy.build(backend_class, cache_size=options.queries)
+    batch = queries['hit']
+
+    def hit_cached():
+        check = cached.check
+        for role, privilege, context in batch:
+            check(role, privilege, context)
+    hit_cached()  # Warm up
+    results['check_hit_cached'] = measure(hit_cached, len(batch),
+                                          options.repeat)
+    return results
+
+
+def bench_loading(policy, backend_class, options):
+    results = {}
+    document = policy.document()
+    text = json.dumps(document)
+    rules = len(document['acl'])
+    create = functools.partial(simpleacl.Acl, backend_class=backend_class)
+
+    def bulk_load():
+        acl = create()
+        acl.bulk_load(document)
+        return acl
+
+    def create_instance():
+        # Parses JSON, as applications load policies from files
+        acl = create()
+        acl.bulk_load(text)
+        return acl
+
+    def add_rules():
+        return policy.build(backend_class)
+
+    for name, func, count in (
+            ('bulk_load', bulk_load, rules),
+            ('create_instance', create_instance, rules),
+            ('build_add_rules', add_rules, len(policy.rules))):
+        timing = measure(func, count, options.load_repeat)
+        timing['rules_per_second'] = 1e9 / timing['best_ns']
+        timing.update(measure_memory(func)[1])
+        results[name] = timing
+    return results
+
+
+def bench_middleware(policy, backend_class, options):
+    policies.CURRENT = policy
+    config = {
+        'simpleacl.build.module': 'benchmarks.policy',
+        'simpleacl.build.class': 'Builder',
+    }
+    role, privilege, context = policy.hit_queries(1)[0]
+
+    def start_response(status, headers):
+        pass
+
+    def untouched_app(environ, start_response):
+        return []
+
+    def checking_app(environ, start_response):
+        acl = environ['simpleacl']
+        acl.set_active_role(role)
+        acl.is_allowed(privilege, context)
+        return []
+
+    def run(app):
+        def func():
+            for i in range(options.queries):
+                app({}, start_response)
+        return measure(func, options.queries, options.repeat)
+
+    results = {
+        'request_bare': run(untouched_app),
+        'request_untouched': run(AclMiddleware(untouched_app, config)),
+        'request_check': run(AclMiddleware(checking_app, config)),
+    }
+    config['simpleacl.reload.interval'] = '3600'
+    results['request_check_reload'] = run(
+        AclMiddleware(checking_app, config)
+    )
+    return results
+
+
+def get_meta(options):
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'format': FORMAT_VERSION,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'revision': revision,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'backend': options.backend,
+        'repeat': options.repeat,
+    }
+
+
+def compare(results, baseline):
+    """Prints ratios of best timings to those of baseline"""
+    for name in sorted(results):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        ratio = results[name]['best_ns'] / old['best_ns']
+        print('{0:30} {1:12.0f} ns {2:8.2f}x'.format(
+            name, results[name]['best_ns'], ratio
+        ), file=sys.stderr)
+
+
+def parse_args(args=None):
+    defaults = policies.PolicySpec()
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    for name, value in sorted(defaults.as_dict().items()):
+        parser.add_argument('--' + name.replace('_', '-'), type=type(value),
+                            default=value)
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        default='simple')
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--load-repeat', type=int, default=3)
+    parser.add_argument('--only', action='append',
+                        choices=['checks', 'loading', 'middleware'])
+    parser.add_argument('--output', help='JSON file, stdout by default')
+    parser.add_argument('--compare', help='JSON file of an earlier run')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    spec = policies.PolicySpec(**dict(
+        (name, getattr(options, name))
+        for name in policies.PolicySpec().as_dict()
+    ))
+    policy = policies.Policy(spec)
+    backend_class = BACKENDS[options.backend]
+    results = {}
+    for name, bench in (('checks', bench_checks),
+                        ('loading', bench_loading),
+                        ('middleware', bench_middleware)):
+        if not options.only or name in options.only:
+            results.update(bench(policy, backend_class, options))
+    report = {
+        'meta': get_meta(options),
+        'policy': dict(spec.as_dict(), rules=len(policy.rules)),
+        'results': results,
+    }
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -17,32 +17,96 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #######################################################################
 from __future__ import absolute_import, unicode_literals
+import copy
+import itertools
+import threading
+import weakref
+from contextlib import contextmanager
 try:
     import simplejson as json
 except:
     import json
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python < 3.7
+    ContextVar = None
 
+from simpleacl import instrument, stream
+from simpleacl.cache import DecisionCache, MISSING
 from simpleacl.exceptions import MissingRole, MissingActiveRole,\
-    MissingPrivilege
+    MissingPrivilege, MissingACLObject, CyclicRoleHierarchy,\
+    CyclicContextHierarchy
 
 try:
     str = unicode  # Python 2.* compatible
 except NameError:
     pass
 
+try:
+    from sys import intern
+except ImportError:  # Python 2.* interns byte strings only
+    def intern(name):
+        return name
+
 
 ALL_PRIVILEGES = 'all'
+WILDCARD = '*'  # Last segment of privileges which match their subtree
+BULK_CHUNK_SIZE = 1000  # Rules per backend call of non-atomic add_rules()
+FILTER_MEMO_SIZE = 10000  # Contexts remembered by one filter_allowed()
+
+
+class _ThreadLocalVar(threading.local):
+    """Fallback for ContextVar on old Pythons (per-thread only)"""
+
+    value = None
+
+    def __init__(self, name, default=None):
+        self.value = default
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+# Maps weak references of Acl instances to their active roles
+_active_roles = (ContextVar or _ThreadLocalVar)(
+    'simpleacl_active_roles', default=None
+)
+
+
+def intern_name(name):
+    """Returns the canonical copy of name, so dict probes compare by identity"""
+    if type(name) is str:
+        return intern(name)
+    return name
 
 
 class Role(object):
-    """Holds a role value"""
+    """Holds a role value.
 
-    _parents = None  # Order is important, so use the list(), not set
-    acl = None
+    One instance per name is kept by the ACL, see Acl.add_role(); so
+    comparison starts with identity, and the hash is computed once.
+    """
+
+    __slots__ = (
+        'name', '_hash',
+        '_parents',  # Order is important, so use the list(), not set
+        '_dotted_parent',  # The "a" role for the "a.b" role
+        '_children',
+        '_ancestors',  # Cached linearization, see get_ancestors()
+        'acl', '__weakref__',
+    )
 
     def __init__(self, name):
-        self.name = name
+        self.name = intern_name(name)
+        self._hash = hash(self.name)
         self._parents = []
+        self._dotted_parent = None
+        self._children = []
+        self._ancestors = None
+        self.acl = None
 
     def __repr__(self):
         return '<Role %s>' % self.name
@@ -54,13 +118,15 @@ class Role(object):
         return unicode(self)
 
     def __eq__(self, other):
-        return self.name.__eq__(getattr(other, 'name', other))
+        if other is self:
+            return True
+        return self.name == getattr(other, 'name', other)
 
     def __ne__(self, other):
-        return self.name.__ne__(getattr(other, 'name', other))
+        return not self.__eq__(other)
 
     def __hash__(self):
-        return self.name.__hash__()
+        return self._hash
 
     def __bytes__(self):
         return str(self.name).encode('utf-8')
@@ -79,7 +145,11 @@ class Role(object):
             )
         parent = self.acl.add_role(parent)
         if parent not in self._parents:
+            self._check_cycle(parent)
             self._parents.append(parent)
+            parent._add_child(self)
+            self._invalidate()
+            self.acl._parents_changed(self)
     
     def remove_parent(self, parent=None):
         if self.acl is None:
@@ -89,12 +159,19 @@ class Role(object):
             )
             
         if parent is None:
-            self._parents = None
+            parents, self._parents = self._parents, []
+            for parent in parents:
+                parent._remove_child(self)
+            self._invalidate()
+            self.acl._parents_changed(self)
             return True
         
         parent = self.acl.add_role(parent)
         if parent in self._parents:
             self._parents.remove(parent)
+            parent._remove_child(self)
+            self._invalidate()
+            self.acl._parents_changed(self)
             return True
         else:
             return False
@@ -102,21 +179,100 @@ class Role(object):
     def get_parents(self):
         return self._parents
 
+    def set_dotted_parent(self, parent):
+        """Links the "a" role as parent of the "a.b" role"""
+        if parent == self._dotted_parent:
+            return
+        self._check_cycle(parent)
+        previous, self._dotted_parent = self._dotted_parent, parent
+        if previous is not None:
+            previous._remove_child(self)
+        parent._add_child(self)
+        self._invalidate()
+
+    def get_ancestors(self):
+        """Returns the role followed by all its ancestors.
+
+        Parents are visited depth-first, left-to-right, the dotted parent
+        after the explicit ones, and every role occurs only once. The
+        result is cached until the hierarchy above the role changes.
+        """
+        ancestors = self._ancestors
+        if ancestors is None:
+            result = [self]
+            seen = set(result)
+            parents = self._parents
+            if self._dotted_parent is not None:
+                parents = parents + [self._dotted_parent]
+            for parent in parents:
+                for ancestor in parent.get_ancestors():
+                    if ancestor not in seen:
+                        seen.add(ancestor)
+                        result.append(ancestor)
+            ancestors = self._ancestors = tuple(result)
+        return ancestors
+
+    def _check_cycle(self, parent):
+        if self in parent.get_ancestors():
+            raise CyclicRoleHierarchy(
+                'Role: %s can not inherit from its own descendant %s.' % (
+                    self.get_name(), parent.get_name()
+                )
+            )
+
+    def _add_child(self, child):
+        if child not in self._children:
+            self._children.append(child)
+
+    def _remove_child(self, child):
+        if self not in child._parents and child._dotted_parent != self:
+            if child in self._children:
+                self._children.remove(child)
+
+    def _invalidate(self):
+        """Drops cached ancestors of the role and of all its descendants"""
+        stack = [self]
+        while stack:
+            role = stack.pop()
+            if role._ancestors is not None:
+                role._ancestors = None
+                stack.extend(role._children)
+
 
 class Privilege(object):
-    """Holds a privilege value"""
+    """Holds a privilege value.
+
+    Privileges added to an ACL form a trie by the segments of their
+    dotted names, see Acl._get_privilege_chain().
+    """
+
+    __slots__ = (
+        'name', '_hash',
+        '_parent',  # The "a" privilege for the "a.b" privilege
+        '_children',  # Segment to privilege; None until linked into trie
+        '_wildcard',  # The "a.*" privilege for the "a" privilege
+        '_chain',  # Cached result of Acl._get_privilege_chain()
+        '__weakref__',
+    )
 
     def __init__(self, name):
-        self.name = name
+        self.name = intern_name(name)
+        self._hash = hash(self.name)
+        self._parent = None
+        self._children = None
+        self._wildcard = None
+        self._chain = None
 
     def __eq__(self, other):
-        return self.name.__eq__(getattr(other, 'name', other))
+        if other is self:
+            return True
+        return self.name == getattr(other, 'name', other)
 
     def __ne__(self, other):
-        return self.name.__ne__(getattr(other, 'name', other))
+        return not self.__eq__(other)
 
     def __hash__(self):
-        return self.name.__hash__()
+        return self._hash
 
     def __bytes__(self):
         return str(self.name).encode('utf-8')
@@ -127,33 +283,219 @@ class Privilege(object):
     def get_name(self):
         return self.name
 
+    def _invalidate(self):
+        """Drops cached chains of the privilege and of its subtree"""
+        stack = [self]
+        while stack:
+            privilege = stack.pop()
+            privilege._chain = None
+            if privilege._children:
+                stack.extend(privilege._children.values())
+            if privilege._wildcard is not None:
+                privilege._wildcard._chain = None
+
 
 class Context(object):
     """Holder for context value.
 
-    Sometimes apposite for usege as context wrapper."""
+    Sometimes apposite for usege as context wrapper. Rules of the parents
+    of a context apply to it too, see get_ancestors()."""
 
-    _parents = []  # Order is important, so use the list(), not set
+    __slots__ = ('base', '_hash', '_parents', '_children', '_ancestors',
+                 '__weakref__')
 
-    def __init__(self, base):
+    def __init__(self, base, parents=None):
         self.base = base
+        try:
+            self._hash = hash(base)
+        except TypeError:  # Raised by __hash__(), rules need hashable ones
+            self._hash = None
+        self._parents = []  # Order is important, so use the list(), not set
+        self._children = []  # Weak references, contexts are often transient
+        self._ancestors = None  # Cached linearization, see get_ancestors()
+        for parent in parents or ():
+            self.add_parent(parent)
 
     def __eq__(self, other):
-        return self.base.__eq__(getattr(other, 'base', other))
+        if other is self:
+            return True
+        return self.base == getattr(other, 'base', other)
 
     def __ne__(self, other):
-        return self.base.__ne__(getattr(other, 'base', other))
+        return not self.__eq__(other)
 
     def __hash__(self):
-        return self.base.__hash__()
+        if self._hash is None:
+            return hash(self.base)  # Raises TypeError
+        return self._hash
+
+    def __repr__(self):
+        return '<Context %r>' % (self.base, )
 
     def add_parent(self, parent):
         if parent not in self._parents:
+            if self in get_context_ancestors(parent):
+                raise CyclicContextHierarchy(
+                    'Context: %r can not inherit from its own descendant %r.'
+                    % (self.base, getattr(parent, 'base', parent))
+                )
             self._parents.append(parent)
+            if isinstance(parent, Context):
+                parent._add_child(self)
+            self._invalidate()
+
+    def remove_parent(self, parent):
+        if parent in self._parents:
+            parent = self._parents.pop(self._parents.index(parent))
+            if isinstance(parent, Context):
+                parent._remove_child(self)
+            self._invalidate()
+            return True
+        return False
 
     def get_parents(self):
         return self._parents
 
+    def get_ancestors(self):
+        """Returns the context followed by all its ancestors.
+
+        Parents are visited depth-first, left-to-right, and every context
+        occurs only once. The result is cached until the hierarchy above
+        the context changes.
+        """
+        ancestors = self._ancestors
+        if ancestors is None:
+            result = [self]
+            for parent in self._parents:
+                for ancestor in get_context_ancestors(parent):
+                    if ancestor not in result:
+                        result.append(ancestor)
+            ancestors = self._ancestors = tuple(result)
+        return ancestors
+
+    def _add_child(self, child):
+        self._children = [ref for ref in self._children
+                          if ref() is not None and ref() is not child]
+        self._children.append(weakref.ref(child))
+
+    def _remove_child(self, child):
+        self._children = [ref for ref in self._children
+                          if ref() is not None and ref() is not child]
+
+    def _invalidate(self):
+        """Drops cached ancestors of the context and of all its descendants"""
+        stack = [self]
+        while stack:
+            context = stack.pop()
+            if context._ancestors is not None:
+                context._ancestors = None
+                for ref in context._children:
+                    child = ref()
+                    if child is not None:
+                        stack.append(child)
+
+
+def get_context_ancestors(context):
+    """Returns the context followed by its ancestors"""
+    get_ancestors = getattr(context, 'get_ancestors', None)
+    if get_ancestors is not None:
+        return get_ancestors()
+    result = [context]
+    for parent in getattr(context, 'get_parents', tuple)():
+        for ancestor in get_context_ancestors(parent):
+            if ancestor not in result:
+                result.append(ancestor)
+    return result
+
+
+def get_context_key(context):
+    """Returns string which identifies context in a persistent storage"""
+    if context is None:
+        return ''
+    return str(getattr(context, 'base', context))
+
+
+class _Overlay(dict):
+    """Rows of the contexts changed in a copy() of a backend.
+
+    Other contexts are read through to the rows of the original, and
+    are copied by the first change of them, see setdefault().
+    """
+
+    def __init__(self, parent):
+        super(_Overlay, self).__init__()
+        self.parent = parent
+        self.deleted = set()
+
+    def __missing__(self, key):
+        if key in self.deleted:
+            raise KeyError(key)
+        return self.parent[key]
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        return key not in self.deleted and key in self.parent
+
+    def __setitem__(self, key, value):
+        self.deleted.discard(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        dict.pop(self, key, None)
+        self.deleted.add(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        """Returns own rows of key, copied from the original if needed"""
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        if key not in self.deleted and key in self.parent:
+            default = dict((item, copy.copy(value))
+                           for item, value in self.parent[key].items())
+        self[key] = default
+        return default
+
+    def items(self):
+        result = list(dict.items(self))
+        for key, value in list(self.parent.items()):
+            if key not in self.deleted and not dict.__contains__(self, key):
+                result.append((key, value))
+        return result
+
+    def keys(self):
+        return [key for key, value in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    def merge_into(self, target):
+        """Applies the changes to target, the rows of the original"""
+        for key in self.deleted:
+            target.pop(key, None)
+        for key, value in dict.items(self):
+            target[key] = value
+
 
 class SimpleBackend(object):
     """A simple storage."""
@@ -168,6 +510,7 @@ class SimpleBackend(object):
         self._roles = {}
         self._privileges = {}
         self._acl = {}
+        self._rindex = {}  # Reverse index: context, privilege, role
 
     def add_role(self, role, parents=None):
         """Adds role"""
@@ -197,12 +540,37 @@ class SimpleBackend(object):
                 'Privilege must be added before requested.'
             )
 
+    def copy(self):
+        """Returns a draft backend which reads through to this one.
+
+        Roles and privileges are shared. The draft keeps only the rules
+        of the contexts it changes, so it costs the size of the changes,
+        and commit() applies them to this backend. This backend must not
+        be changed otherwise while the draft is in use, see Acl.edit().
+        """
+        other = copy.copy(self)
+        other._acl = _Overlay(self._acl)
+        other._rindex = _Overlay(self._rindex)
+        return other
+
+    def commit(self, draft):
+        """Applies the changes of draft, a copy() of this backend"""
+        draft._acl.merge_into(self._acl)
+        draft._rindex.merge_into(self._rindex)
+        return self
+
+    def _get_rows(self, context):
+        """Returns rules and reverse index of context, ready for changes"""
+        return (self._acl.setdefault(context, {}),
+                self._rindex.setdefault(context, {}))
+
     def add_rule(self, role, privilege=ALL_PRIVILEGES,
                  context=None, allow=True):
         """Adds rule to the ACL"""
-        acl = self._acl.setdefault(context, {})
+        acl, rindex = self._get_rows(context)
         role_rules = acl.setdefault(role, {})
         role_rules[privilege] = allow
+        rindex.setdefault(privilege, {})[role] = allow
         return self
 
     def remove_rule(self, role, privilege=ALL_PRIVILEGES,
@@ -210,11 +578,71 @@ class SimpleBackend(object):
         """Removes rule from ACL"""
         try:
             if self._acl[context][role][privilege] == allow:
-                del self._acl[context][role][privilege]
+                acl, rindex = self._get_rows(context)
+                del acl[role][privilege]
+                del rindex[privilege][role]
         except KeyError:
             pass
         return self
 
+    def add_rules_bulk(self, rules):
+        """Adds many rules given as {context: {role: {privilege: allow}}}"""
+        for context, roles in rules.items():
+            acl, rindex = self._get_rows(context)
+            for role, privileges in roles.items():
+                acl.setdefault(role, {}).update(privileges)
+                for privilege, allow in privileges.items():
+                    try:
+                        rindex[privilege][role] = allow
+                    except KeyError:
+                        rindex[privilege] = {role: allow}
+        return self
+
+    def find_rule(self, roles, privileges, contexts):
+        """Returns the first rule of given keys, or None if there is none.
+
+        Keys are tried for each of roles, in each of contexts, for each of
+        privileges; see Acl._resolve(). The reverse index tells which
+        contexts have rules for any of the privileges, so the others are
+        skipped for all roles at once, as are roles without rules in a
+        context. Nothing raises KeyError on the way.
+        """
+        acl = self._acl
+        rindex = self._rindex
+        layers = []
+        for context in contexts:
+            present = rindex.get(context)
+            if present:
+                for privilege in privileges:
+                    if present.get(privilege):
+                        layers.append(acl[context])
+                        break
+        if not layers:
+            return None
+        for role in roles:
+            for rows in layers:
+                rules = rows.get(role)
+                if rules:
+                    for privilege in privileges:
+                        allow = rules.get(privilege)
+                        if allow is not None:
+                            return allow
+        return None
+
+    def get_rules(self, role, context=None):
+        """Returns {privilege: allow} of rules of role in context"""
+        try:
+            return self._acl[context][role]
+        except KeyError:
+            return {}
+
+    def get_roles_with_rule(self, privilege, context=None):
+        """Returns {role: allow} of rules for privilege in context"""
+        try:
+            return self._rindex[context][privilege]
+        except KeyError:
+            return {}
+
     def role_has_privilege(self, role, privilege, context=None, allow=True):
         """Removes rule from ACL"""
         try:
@@ -232,36 +660,96 @@ class SimpleBackend(object):
         except KeyError:
             return undef
 
+    def is_allowed_many(self, keys, undef=None):
+        """Returns is_allowed() for each (role, privilege, context) key"""
+        acl = self._acl
+        result = []
+        for role, privilege, context in keys:
+            try:
+                result.append(acl[context][role][privilege])
+            except KeyError:
+                result.append(undef)
+        return result
+
+    def get_role_names(self):
+        """Returns names of all roles"""
+        return list(self._roles)
+
+    def get_privilege_names(self):
+        """Returns names of all privileges"""
+        return list(self._privileges)
+
+    def iter_rules(self):
+        """Yields (role, privilege, context, allow) for all rules"""
+        for context, roles in list(self._acl.items()):
+            for role, privileges in list(roles.items()):
+                for privilege, allow in list(privileges.items()):
+                    yield role, privilege, context, allow
+
 
 class Acl(object):
     """Access control list."""
 
-    active_role = None
+    _generation = 0
+    _cache = None
+    _draft = None  # Copy yielded by an open edit()
+    instrumentation = None  # See simpleacl.instrument.Instrumentation
 
-    def __init__(self, backend_class=None):
-        """Constructor."""
+    def __init__(self, backend_class=None, cache_size=None):
+        """Constructor.
+
+        Pass cache_size to memoize up to that many is_allowed() decisions.
+        """
         if backend_class is None:
             backend_class = SimpleBackend
         self._backend = backend_class()
+        self._ref = weakref.ref(self)
+        self._edit_lock = threading.RLock()
+        self._generations = itertools.count(1)  # next() is atomic
+        if cache_size:
+            self._cache = DecisionCache(cache_size)
         self.add_privilege(ALL_PRIVILEGES)
 
+    def _changed(self):
+        """Marks the policy as changed, so cached decisions are dropped"""
+        self._generation = next(self._generations)
+
+    def cache_info(self):
+        """Returns hits/misses statistics of decision cache or None"""
+        if self._cache is None:
+            return None
+        return self._cache.info()
+
+    def clear_cache(self):
+        """Drops all cached decisions"""
+        if self._cache is not None:
+            self._cache.clear()
+
     def add_role(self, name_or_instance, parents=None):
         """Adds a role to the ACL"""
         if isinstance(name_or_instance, bytes):
             name_or_instance = str(name_or_instance)
         if isinstance(name_or_instance, str):
-            instance = self._backend.role_class(name_or_instance)
+            name = name_or_instance
         elif isinstance(name_or_instance, self._backend.role_class):
-            instance = name_or_instance
+            name = name_or_instance.get_name()
         else:
             raise Exception(
                 'Unable to add a role of type: {0}'\
                     .format(type(name_or_instance).__name__)
             )
-        self._backend.add_role(instance)
+        # The hierarchy is kept on role instances, so always use the stored one
+        try:
+            instance = self._backend.get_role(name)
+        except MissingRole:
+            if name_or_instance is name:
+                name_or_instance = self._backend.role_class(name)
+            self._backend.add_role(name_or_instance)
+            instance = self._backend.get_role(name)
+            self._changed()
         
         if instance.acl is None:
-            instance.acl = self
+            self._adopt_role(instance)
         
         # Parents support for roles
         if parents is not None:
@@ -275,6 +763,9 @@ class Acl(object):
         if '.' in instance.get_name():
             parent = instance.get_name().rsplit('.', 1).pop(0)
             parent = self.add_role(parent)  # Recursive
+            if instance._dotted_parent is not parent:
+                instance.set_dotted_parent(parent)
+                self._changed()
         return instance
 
     def get_role(self, name_or_instance):
@@ -282,33 +773,94 @@ class Acl(object):
         
         if isinstance(name_or_instance, self._backend.role_class):
             instance = name_or_instance
+            if instance.acl is self:
+                return instance
+            try:
+                instance = self._backend.get_role(instance.get_name())
+            except MissingRole:  # Not added, so there is no hierarchy
+                pass
+            if instance.acl is None:
+                instance.acl = self
         else:
             instance = self._backend.get_role(name_or_instance)
-        
-        if instance.acl is None:
-            instance.acl = self
+            if instance.acl is None:
+                self._adopt_role(instance)
         
         return instance
 
+    def _adopt_role(self, instance):
+        """Links a role loaded by backend into the hierarchy"""
+        instance.acl = self
+        self._link_stored_parents(instance)
+        if '.' in instance.get_name() and instance._dotted_parent is None:
+            try:
+                parent = self.get_role(
+                    instance.get_name().rsplit('.', 1).pop(0)
+                )
+            except MissingRole:
+                pass
+            else:
+                instance.set_dotted_parent(parent)
+
+    def _link_stored_parents(self, instance):
+        get_role_parents = getattr(self._backend, 'get_role_parents', None)
+        if get_role_parents is not None:
+            for name in get_role_parents(instance.get_name()):
+                parent = self.get_role(name)
+                if parent not in instance._parents:
+                    instance._parents.append(parent)
+                    parent._add_child(instance)
+            instance._invalidate()
+
+    def _reload_role(self, instance):
+        """Links role to its stored parents again.
+
+        Called by backends shared between processes, see KVBackend, when
+        another process has changed the parents.
+        """
+        parents, instance._parents = instance._parents, []
+        for parent in parents:
+            parent._remove_child(instance)
+        instance._invalidate()
+        self._link_stored_parents(instance)
+        self._changed()
+
+    def _parents_changed(self, role):
+        """Called by role when its parents have been changed"""
+        set_role_parents = getattr(self._backend, 'set_role_parents', None)
+        if set_role_parents is not None:
+            set_role_parents(role, role.get_parents())
+        self._changed()
+
     def add_privilege(self, name_or_instance):
         """Adds a privilege to the ACL"""
         if isinstance(name_or_instance, bytes):
             name_or_instance = str(name_or_instance)
         if isinstance(name_or_instance, str):
-            instance = self._backend.privilege_class(name_or_instance)
+            name = name_or_instance
         elif isinstance(name_or_instance, self._backend.privilege_class):
-            instance = name_or_instance
+            name = name_or_instance.get_name()
         else:
             raise Exception(
                 'Unable to add a privilege of type: {0}'\
                     .format(type(name_or_instance).__name__)
             )
-        self._backend.add_privilege(instance)
+        try:
+            return self.get_privilege(name)
+        except MissingPrivilege:
+            pass
+        if name_or_instance is name:
+            name_or_instance = self._backend.privilege_class(name)
+        self._backend.add_privilege(name_or_instance)
+        instance = self._backend.get_privilege(name)
+        self._changed()
 
         # Hierarchical support for instances
         if '.' in instance.get_name():
             parent = instance.get_name().rsplit('.', 1).pop(0)
-            parent = self.add_instance(parent)  # Recursive
+            parent = self.add_privilege(parent)  # Recursive
+        if instance._children is None:
+            self._link_privilege(instance)
         return instance
 
     def get_privilege(self, name_or_instance):
@@ -316,34 +868,210 @@ class Acl(object):
         if isinstance(name_or_instance, bytes):
             name_or_instance = str(name_or_instance)
         if isinstance(name_or_instance, str):
-            return self._backend.get_privilege(name_or_instance)
-        if isinstance(name_or_instance, self._backend.privilege_class):
-            return name_or_instance
-        raise Exception(
-            'Unable to get a Privelege of type: {0}'\
-                .format(type(name_or_instance).__name__)
-        )
+            instance = self._backend.get_privilege(name_or_instance)
+        elif isinstance(name_or_instance, self._backend.privilege_class):
+            try:
+                instance = self._backend.get_privilege(name_or_instance.name)
+            except MissingPrivilege:  # Not added, but rules may match
+                return name_or_instance
+        else:
+            raise Exception(
+                'Unable to get a Privelege of type: {0}'\
+                    .format(type(name_or_instance).__name__)
+            )
+        if instance._children is None:
+            self._link_privilege(instance)
+        return instance
+
+    def _link_privilege(self, instance):
+        """Links a privilege stored by backend into the trie"""
+        instance._children = {}
+        name = instance.get_name()
+        if '.' in name:
+            parent, segment = name.rsplit('.', 1)
+            try:
+                parent = self.get_privilege(parent)
+            except MissingPrivilege:
+                return
+            instance._parent = parent
+            if segment == WILDCARD:
+                parent._wildcard = instance
+                parent._invalidate()
+                return
+            parent._children[segment] = instance
+        if instance._wildcard is None:
+            # Backends loaded from storage may have it without linking it
+            try:
+                self.get_privilege(name + '.' + WILDCARD)
+            except MissingPrivilege:
+                pass
 
     def add_rule(self, role, privileges=ALL_PRIVILEGES,
                  context=None, allow=True):
         """Adds rule to the ACL"""
-        if not hasattr(privileges, '__iter__'):
+        if isinstance(privileges, (str, bytes)) or \
+                not hasattr(privileges, '__iter__'):
             privileges = (privileges, )
-        for priv in privileges:
-            self._backend.add_rule(
-                self.get_role(role), self.get_privilege(priv), context, allow
-            )
+        with self._edit_lock:
+            backend = self._get_writable_backend()
+            for priv in privileges:
+                backend.add_rule(
+                    self.get_role(role), self.get_privilege(priv), context,
+                    allow
+                )
+            self._changed()
+        return self
+
+    def _get_writable_backend(self):
+        """Returns the backend which takes changes of rules.
+
+        Call it with _edit_lock held, so an edit() open in another thread
+        is waited for; the one open in this thread takes the changes.
+        """
+        if self._draft is not None:
+            return self._draft._backend
+        return self._backend
+
+    @contextmanager
+    def edit(self):
+        """Collects changes of rules and publishes them at once.
+
+        Yields a copy of the ACL whose backend is a draft which keeps
+        the changed contexts only and reads the others through to this
+        one (see SimpleBackend.copy()), and checks of the copy see the
+        changes. When the block exits without an error, the draft
+        replaces the current backend by a single assignment, the changes
+        are applied to the current backend (see SimpleBackend.commit()),
+        and it takes over again; checks in other threads never wait, and
+        the ones started after the exit see all of the changes. If the
+        block raises, the changes are dropped.
+
+        Edits and other changes of rules are serialized: they wait for
+        an edit open in another thread. Changes made in the thread of
+        the edit, through this ACL or a nested edit() of it, go to the
+        open copy. Roles, privileges and role parents are not copied:
+        they are changed at once. Backends without copy() but with
+        batch() (like SqliteBackend) write the changes in one
+        transaction instead, and the copy does not see them.
+        """
+        with self._edit_lock:
+            if self._draft is not None:  # Nested edit
+                yield self._draft
+                return
+            backend = self._backend
+            if getattr(backend, 'copy', None) is None:
+                with backend.batch():
+                    yield self
+                self._changed()
+                return
+            draft = copy.copy(self)
+            draft._backend = backend.copy()
+            draft._cache = None
+            # Shared instances belong to this ACL, so hierarchy changes
+            # made through the copy reach its cache
+            draft.add_role = self.add_role
+            draft.get_role = self.get_role
+            draft.add_privilege = self.add_privilege
+            draft._draft = draft  # So edit() of the copy yields itself
+            self._draft = draft
+            try:
+                yield draft
+            finally:
+                self._draft = None
+            self._backend = draft._backend  # Checks see all changes at once
+            self._changed()
+            backend.commit(draft._backend)
+            self._backend = backend
+
+    def add_rules(self, rows, context=None, atomic=True):
+        """Adds many rules at once.
+
+        Each row is a (role[, privileges[, context[, allow]]]) tuple or a
+        dict with "role", "privilege" (or "privileges"), "context" and
+        "allow" keys; context defaults to the given one. Names are looked
+        up once, and rules are grouped by context and role before they are
+        handed to the backend.
+
+        In atomic mode all rows are validated before anything is written,
+        so a bad row leaves the ACL unchanged. Otherwise rows are written
+        in chunks of BULK_CHUNK_SIZE, each validated as a whole, so the
+        chunks before the one with the bad row stay written and nothing
+        of that chunk is.
+        """
+        grouped = {}  # By raw (context, role) first, hashing names is cheap
+        count = 0
+        for row in rows:
+            if isinstance(row, dict):
+                key = (row.get('context', context), row['role'])
+                names = row.get('privilege',
+                                row.get('privileges', ALL_PRIVILEGES))
+                allow = row.get('allow', True)
+            else:
+                size = len(row)
+                key = (row[2] if size > 2 else context, row[0])
+                names = row[1] if size > 1 else ALL_PRIVILEGES
+                allow = row[3] if size > 3 else True
+            group = grouped.get(key)
+            if group is None:
+                group = grouped[key] = {}
+            if isinstance(names, (str, bytes)) or \
+                    not hasattr(names, '__iter__'):
+                group[names] = allow
+            else:
+                for name in names:
+                    group[name] = allow
+            count += 1
+            if not atomic and count >= BULK_CHUNK_SIZE:
+                self._add_rules_bulk(self._resolve_rules(grouped))
+                grouped = {}
+                count = 0
+        if grouped:
+            # Resolves every row before writing, so a bad one raises here
+            self._add_rules_bulk(self._resolve_rules(grouped))
         return self
 
+    def _resolve_rules(self, grouped):
+        """Returns {context: {role: {privilege: allow}}} of instances"""
+        privileges = {}
+        rules = {}
+        for (context, role), group in grouped.items():
+            role_rules = rules.setdefault(context, {}).setdefault(
+                self.get_role(role), {}
+            )
+            for name, allow in group.items():
+                try:
+                    privilege = privileges[name]
+                except KeyError:
+                    privilege = privileges[name] = self.get_privilege(name)
+                role_rules[privilege] = bool(allow)
+        return rules
+
+    def _add_rules_bulk(self, rules):
+        with self._edit_lock:
+            backend = self._get_writable_backend()
+            if hasattr(backend, 'add_rules_bulk'):
+                backend.add_rules_bulk(rules)
+            else:
+                for context, roles in rules.items():
+                    for role, privileges in roles.items():
+                        for privilege, allow in privileges.items():
+                            backend.add_rule(role, privilege, context, allow)
+            self._changed()
+
     def remove_rule(self, role, privileges=ALL_PRIVILEGES,
                     context=None, allow=True):
         """Removes rule from ACL"""
-        if not hasattr(privileges, '__iter__'):
+        if isinstance(privileges, (str, bytes)) or \
+                not hasattr(privileges, '__iter__'):
             privileges = (privileges, )
-        for priv in privileges:
-            self._backend.remove_rule(
-                self.get_role(role), self.get_privilege(priv), context, allow
-            )
+        with self._edit_lock:
+            backend = self._get_writable_backend()
+            for priv in privileges:
+                backend.remove_rule(
+                    self.get_role(role), self.get_privilege(priv), context,
+                    allow
+                )
+            self._changed()
         return self
 
     def allow(self, role, privileges=ALL_PRIVILEGES, context=None):
@@ -372,6 +1100,26 @@ class Acl(object):
         except MissingPrivilege:
             return False
 
+    def _get_active_role(self):
+        roles = _active_roles.get()
+        if roles:
+            return roles.get(self._ref)
+        return None
+
+    def _set_active_role(self, role):
+        # The mapping is never mutated in place, so a copied context
+        # (new thread or asyncio task) never sees changes of another one.
+        roles = dict(
+            (ref, value) for ref, value in (_active_roles.get() or {}).items()
+            if ref is not self._ref and ref() is not None
+        )
+        if role is not None:
+            roles[self._ref] = role
+        _active_roles.set(roles)
+
+    active_role = property(_get_active_role, _set_active_role, None,
+                           "Active role of the current thread or task")
+
     def active_role_is(self, role):
         """Sets active role"""
         self.active_role = self.get_role(role)
@@ -381,63 +1129,441 @@ class Acl(object):
         """Just alias for self.active_role_is()"""
         return self.active_role_is(role)
 
+    def clear_active_role(self):
+        """Unsets active role of the current thread or task"""
+        self.active_role = None
+        return self
+
+    @contextmanager
+    def as_role(self, role):
+        """Sets active role for the duration of with-block"""
+        previous = self.active_role
+        self.active_role_is(role)
+        try:
+            yield self
+        finally:
+            self.active_role = previous
+
     def is_allowed(self, privilege, context=None, undef=False):
         """Returns True if active role is allowed
 
         for given privilege in given given context
         """
-        if not self.active_role:
+        role = self.active_role
+        if not role:
             raise MissingActiveRole(
                 "A role must be set active before checking permissions"
             )
+        return self.check(role, privilege, context, undef)
 
-        role = self.active_role
+    def check(self, role, privilege, context=None, undef=False):
+        """Returns True if role is allowed
+
+        for given privilege in given context. Unlike is_allowed() it does
+        not depend on the active role, so it is safe to share the ACL
+        between threads.
+        """
+        if self.instrumentation is not None:
+            return self._check_traced(role, privilege, context, undef)
+        role = self.get_role(role)
         privilege = self.get_privilege(privilege)
 
-        allow = self._backend.is_allowed(role, privilege, context, None)
-        if allow is not None:
-            return allow
+        if self._cache is None:
+            allow = self._resolve(role, privilege, context)
+        else:
+            key = self._get_decision_key(role, privilege, context)
+            generation = self._generation  # Before the lookup, see set()
+            allow = self._cache.get(key, generation)
+            if allow is MISSING:
+                allow = self._resolve(role, privilege, context)
+                self._cache.set(key, allow, generation)
+        if allow is None:
+            return undef
+        return allow
 
-        allow = self._backend.is_allowed(
-            role, self.get_privilege(ALL_PRIVILEGES), context, None
-        )
-        if allow is not None:
-            return allow
+    def _check_traced(self, role, privilege, context=None, undef=False):
+        """check() which reports the decision to instrumentation"""
+        instrumentation = self.instrumentation
+        started = instrument.clock()
+        role = self.get_role(role)
+        privilege = self.get_privilege(privilege)
 
-        # Parents support for roles
-        for parent in role.get_parents():
-            self.active_role_is(parent)
-            allow = self.is_allowed(privilege, context, None)
-            if allow is not None:
-                return allow
+        allow = MISSING
+        if self._cache is not None:
+            key = self._get_decision_key(role, privilege, context)
+            generation = self._generation
+            allow = self._cache.get(key, generation)
+        if allow is MISSING:
+            allow, level, depth, calls = self._trace(role, privilege, context)
+            if self._cache is not None:
+                self._cache.set(key, allow, generation)
+        else:
+            level, depth, calls = instrument.CACHED, 0, 0
+        instrumentation.record(instrument.Decision(
+            role, privilege, context, allow, level, depth, calls,
+            instrument.clock() - started
+        ))
+        if allow is None:
+            return undef
+        return allow
 
-        # Hierarchical support for roles
-        if '.' in role.get_name():
-            parent = self.get_role(role.get_name().rsplit('.', 1).pop(0))
-            self.active_role_is(parent)
-            allow = self.is_allowed(privilege, context, None)
-            if allow is not None:
-                return allow
+    def is_allowed_many(self, queries, undef=False):
+        """Returns list of check() results for many queries at once.
 
-        self.active_role_is(role)
+        Each query is a (role, privilege) or (role, privilege, context)
+        tuple. Names are resolved and hierarchies are expanded once per
+        batch, and the backend is asked for all rules in one call.
+        """
+        results = []
+        roles = {}
+        privileges = {}
+        groups = {}  # Queries by (role, context)
+        for index, query in enumerate(queries):
+            role, privilege = query[0], query[1]
+            context = query[2] if len(query) > 2 else None
+            try:
+                role = roles[role]
+            except KeyError:
+                role = roles[role] = self.get_role(role)
+            try:
+                privilege = privileges[privilege]
+            except KeyError:
+                privilege = privileges[privilege] = \
+                    self.get_privilege(privilege)
+            results.append(undef)
+            groups.setdefault((role, context), []).append((index, privilege))
+
+        generation = self._generation
+
+        # Backends which answer from memory skip the candidate expansion
+        find_rule = getattr(self._backend, 'find_rule', None)
+        keys = []
+        positions = {}
+        plans = []
+        chains = {}
+        for (role, context), items in groups.items():
+            ancestors = role.get_ancestors()
+            contexts = self._get_context_chain(context)
+            cached = context if len(contexts) == 1 else tuple(contexts)
+            layers = [(ancestor, parent)
+                      for ancestor in ancestors
+                      for parent in contexts]
+            for index, privilege in items:
+                if self._cache is not None:
+                    allow = self._cache.get(
+                        (role, privilege, cached), generation
+                    )
+                    if allow is not MISSING:
+                        if allow is not None:
+                            results[index] = allow
+                        continue
+                try:
+                    chain = chains[privilege]
+                except KeyError:
+                    chain = chains[privilege] = \
+                        self._get_privilege_chain(privilege)
+                if find_rule is not None:
+                    allow = find_rule(ancestors, chain, contexts)
+                    if allow is not None:
+                        results[index] = allow
+                    if self._cache is not None:
+                        self._cache.set((role, privilege, cached), allow,
+                                        generation)
+                    continue
+                candidates = []
+                for ancestor, parent in layers:
+                    for item in chain:
+                        key = (ancestor, item, parent)
+                        position = positions.get(key)
+                        if position is None:
+                            position = positions[key] = len(keys)
+                            keys.append(key)
+                        candidates.append(position)
+                plans.append((index, (role, privilege, cached), candidates))
+
+        if not plans:
+            return results
+        backend = self._backend
+        if hasattr(backend, 'is_allowed_many'):
+            answers = backend.is_allowed_many(keys, None)
+        else:
+            answers = [backend.is_allowed(role, privilege, context, None)
+                       for role, privilege, context in keys]
 
-        # Hierarchical support for privileges
-        if '.' in privilege.get_name():
-            parent = self.get_privilege(
-                privilege.get_name().rsplit('.', 1).pop(0)
-            )
-            allow = self.is_allowed(parent, context, None)
-            if allow is not None:
-                return allow
-
-        # Parents support for context
-        if hasattr(context, 'get_parents'):
-            for parent in context.get_parents():
-                allow = self.is_allowed(privilege, parent, None)
+        for index, key, candidates in plans:
+            allow = None
+            for position in candidates:
+                allow = answers[position]
+                if allow is not None:
+                    results[index] = allow
+                    break
+            if self._cache is not None:
+                self._cache.set(key, allow, generation)
+        return results
+
+    def effective_privileges(self, role, context=None):
+        """Returns privileges which role is allowed in context.
+
+        The result is what check() would answer for every privilege, but
+        the rules are read once per role ancestor and context parent.
+        """
+        role = self.get_role(role)
+        backend = self._backend
+        layers = [(ancestor, parent)
+                  for ancestor in role.get_ancestors()
+                  for parent in self._get_context_chain(context)]
+        if hasattr(backend, 'get_effective_privileges'):
+            decided = backend.get_effective_privileges(layers)
+        else:
+            privileges = [self.get_privilege(name)
+                          for name in backend.get_privilege_names()]
+            get_rules = getattr(backend, 'get_rules', None)
+            if get_rules is None:
+                decided = dict(
+                    (privilege, self._resolve(role, privilege, context))
+                    for privilege in privileges
+                )
+            else:
+                rules = [layer for layer in (
+                    get_rules(ancestor, parent) for ancestor, parent in layers
+                ) if layer]
+                decided = dict(
+                    (privilege, self._decide(rules, privilege))
+                    for privilege in privileges
+                )
+        return sorted((privilege for privilege, allow in decided.items()
+                       if allow), key=Privilege.get_name)
+
+    def _decide(self, rules, privilege):
+        """Returns the first rule for privilege in {privilege: allow} layers"""
+        chain = self._get_privilege_chain(privilege)
+        for layer in rules:
+            for item in chain:
+                allow = layer.get(item)
                 if allow is not None:
                     return allow
+        return None
+
+    def roles_with_privilege(self, privilege, context=None):
+        """Returns roles which are allowed privilege in context.
+
+        Only the roles which have a rule for the privilege ("all" and its
+        dotted parents included) and their descendants are checked, if
+        the backend has a reverse index; otherwise all roles are.
+        """
+        privilege = self.get_privilege(privilege)
+        backend = self._backend
+        get_roles_with_rule = getattr(backend, 'get_roles_with_rule', None)
+        if get_roles_with_rule is None:
+            roles = [self.get_role(name) for name in backend.get_role_names()]
+        else:
+            stack = [
+                role
+                for parent in self._get_context_chain(context)
+                for item in self._get_privilege_chain(privilege)
+                for role in get_roles_with_rule(item, parent)
+            ]
+            roles = []
+            seen = set()
+            while stack:
+                role = self.get_role(stack.pop())
+                if role not in seen:
+                    seen.add(role)
+                    roles.append(role)
+                    stack.extend(role._children)
+        return sorted((role for role in roles
+                       if self._resolve(role, privilege, context)),
+                      key=Role.get_name)
+
+    def filter_allowed(self, privilege, objects, key=None, role=None):
+        """Yields the objects which role is allowed privilege for.
+
+        key(obj) returns the context of an object, the object itself is
+        used without key. role defaults to the active role. The result is
+        a lazy generator, and objects come out in the input order.
+
+        The ancestors of the role and the chain of the privilege are
+        resolved once. For every context the first deciding ancestor is
+        remembered, so the parents shared by many objects (a project of
+        documents, say) are looked up once for the whole stream.
+        """
+        if role is None:
+            role = self.active_role
+            if not role:
+                raise MissingActiveRole(
+                    "A role must be set active before checking permissions"
+                )
+        role = self.get_role(role)
+        privilege = self.get_privilege(privilege)
+        return self._filter_allowed(role, privilege, objects, key)
+
+    def _filter_allowed(self, role, privilege, objects, key):
+        ancestors = role.get_ancestors()
+        chain = self._get_privilege_chain(privilege)
+        generation = None
+        # Context to (index of deciding ancestor, allow); the rules of a
+        # context alone do not depend on context hierarchies
+        memo = {}
+        for obj in objects:
+            if generation != self._generation:
+                generation = self._generation
+                ancestors = role.get_ancestors()
+                memo.clear()
+            allow = None
+            index = len(ancestors)
+            for context in self._get_context_chain(
+                    obj if key is None else key(obj)):
+                try:
+                    decision = memo[context]
+                except KeyError:
+                    decision = self._find_layer_rule(ancestors, chain,
+                                                     context)
+                    if len(memo) >= FILTER_MEMO_SIZE:
+                        memo.clear()
+                    memo[context] = decision
+                # Closer ancestors win over closer contexts, see _resolve()
+                if decision[0] < index:
+                    index, allow = decision
+            if allow:
+                yield obj
+
+    def _find_layer_rule(self, ancestors, chain, context):
+        """Returns (index of the first of ancestors with a rule, allow)
+
+        for the privilege chain in context alone, or (len(ancestors),
+        None) if there is no such rule.
+        """
+        find_rule = getattr(self._backend, 'find_rule', None)
+        if find_rule is not None:
+            if find_rule(ancestors, chain, (context, )) is None:
+                return len(ancestors), None
+            for index, ancestor in enumerate(ancestors):
+                allow = find_rule((ancestor, ), chain, (context, ))
+                if allow is not None:
+                    return index, allow
+        is_allowed = self._backend.is_allowed
+        for index, ancestor in enumerate(ancestors):
+            for item in chain:
+                allow = is_allowed(ancestor, item, context, None)
+                if allow is not None:
+                    return index, allow
+        return len(ancestors), None
 
-        return undef
+    def _resolve(self, role, privilege, context=None):
+        """Returns the first matching rule, or None if no rule decides.
+
+        Rules are looked up for the role and its ancestors (see
+        Role.get_ancestors()), for each of them in the context and its
+        parents, and there for the privilege, the "all" privilege and the
+        dotted parents of the privilege, in that order.
+        """
+        privileges = self._get_privilege_chain(privilege)
+        contexts = self._get_context_chain(context)
+        find_rule = getattr(self._backend, 'find_rule', None)
+        if find_rule is not None:
+            return find_rule(role.get_ancestors(), privileges, contexts)
+        is_allowed = self._backend.is_allowed
+        for role in role.get_ancestors():
+            for context in contexts:
+                for privilege in privileges:
+                    allow = is_allowed(role, privilege, context, None)
+                    if allow is not None:
+                        return allow
+        return None
+
+    def _trace(self, role, privilege, context=None):
+        """Returns _resolve() result with level, depth and backend calls
+
+        of the deciding rule, see simpleacl.instrument.Decision.
+        """
+        is_allowed = self._backend.is_allowed
+        privileges = self._get_privilege_chain(privilege)
+        contexts = self._get_context_chain(context)
+        ancestors = role.get_ancestors()
+        calls = 0
+        for depth, ancestor in enumerate(ancestors):
+            for context_index, parent in enumerate(contexts):
+                for privilege_index, item in enumerate(privileges):
+                    calls += 1
+                    allow = is_allowed(ancestor, item, parent, None)
+                    if allow is None:
+                        continue
+                    if depth:
+                        if role.get_name().startswith(
+                                ancestor.get_name() + '.'):
+                            level = instrument.DOTTED_ROLE
+                        else:
+                            level = instrument.ROLE_PARENT
+                    elif context_index:
+                        level = instrument.CONTEXT_PARENT
+                    elif not privilege_index:
+                        level = instrument.DIRECT
+                    elif item.get_name() == ALL_PRIVILEGES:
+                        level = instrument.ALL
+                    else:
+                        level = instrument.DOTTED_PRIVILEGE
+                    return allow, level, depth, calls
+        return None, instrument.UNDEF, len(ancestors), calls
+
+    def _get_candidates(self, role, privilege, context=None):
+        """Returns all (role, privilege, context) rule keys of a check
+
+        in the order of precedence, see _resolve().
+        """
+        privileges = self._get_privilege_chain(privilege)
+        contexts = self._get_context_chain(context)
+        return [(ancestor, item, parent)
+                for ancestor in role.get_ancestors()
+                for parent in contexts
+                for item in privileges]
+
+    def _get_privilege_chain(self, privilege):
+        """Returns the privilege, "all" and dotted parents of privilege.
+
+        The "a.*" wildcard privilege, if there is one, precedes its "a"
+        parent: its rules match the whole subtree of "a", but not "a"
+        itself. Chains of privileges in the trie are cached, so only
+        the first check of a privilege walks its parents.
+        """
+        chain = privilege._chain
+        if chain is not None:
+            return chain
+        all_privileges = self.get_privilege(ALL_PRIVILEGES)
+        if privilege == all_privileges:
+            chain = (privilege, )
+        elif '.' not in privilege.get_name():
+            chain = (privilege, all_privileges)
+        else:
+            parent = privilege._parent
+            if parent is None:  # Not added, see get_privilege()
+                parent = self.get_privilege(
+                    privilege.get_name().rsplit('.', 1).pop(0)
+                )
+            wildcard = parent._wildcard
+            if wildcard is None or wildcard is privilege:
+                chain = (privilege, all_privileges, parent)
+            else:
+                chain = (privilege, all_privileges, wildcard, parent)
+            chain += self._get_privilege_chain(parent)[2:]
+        if privilege._children is not None:
+            privilege._chain = chain
+        return chain
+
+    def _get_context_chain(self, context):
+        """Returns the context followed by its ancestors"""
+        return get_context_ancestors(context)
+
+    def _get_decision_key(self, role, privilege, context):
+        """Returns the key of a cached decision.
+
+        Decisions depend on the context chain, so contexts with ancestors
+        are keyed by the whole chain, and changes of context hierarchies
+        need no invalidation of cached decisions.
+        """
+        chain = self._get_context_chain(context)
+        if len(chain) > 1:
+            context = tuple(chain)
+        return role, privilege, context
 
     def bulk_load(self, json_or_dict, context=None):
         """You can store your roles, privileges and allow list (many to many)
@@ -454,23 +1580,97 @@ class Acl(object):
 
         if 'roles' in clean:
             for value in clean['roles']:
-                if hasattr(value, '__iter__'):
-                    self.add_role(*value)
-                elif isinstance(value, dict):
-                    self.add_role(**value)
-                else:
-                    self.add_role(value)
+                self._load_role(value)
 
         if 'privileges' in clean:
             for value in clean['privileges']:
                 self.add_privilege(value)
 
         if 'acl' in clean:
-            for row in clean['acl']:
-                self.allow(row['role'], row['privilege'],
-                           context, row['allow'])
+            self.add_rules(clean['acl'], context)
+        return self
+
+    def bulk_load_stream(self, source, context=None, lines=False,
+                         batch_size=1000, progress=None):
+        """Loads a policy incrementally, with memory bounded by batch_size.
+
+        source is a file object or an iterable of str or bytes chunks of
+        a bulk_load() document, or of newline-delimited rows if lines is
+        true (see simpleacl.stream.iter_lines()). Rules are written in
+        batches, and progress(stats) is called after each batch with a
+        simpleacl.stream.LoadStats instance.
+
+        Rules naming roles or privileges which are not loaded yet stay
+        buffered until more of them are, so the sections may come in any
+        order as with bulk_load(); memory is only bounded by batch_size
+        when the roles and privileges come first.
+        """
+        stats = stream.LoadStats()
+        chunks = stream.iter_chunks(source, stats)
+        if lines:
+            items = stream.iter_lines(chunks)
+        else:
+            items = stream.iter_document(chunks)
+
+        def flush(rules):
+            self.add_rules(rules)  # Atomic, so a failed batch can be retried
+            stats.rules += len(rules)
+            stats.elapsed = stream.clock() - stats.started
+            if progress is not None:
+                progress(stats)
+
+        rules = []
+        pending = False  # The buffered rules need names not loaded yet
+        for key, value in items:
+            if key == 'roles':
+                self._load_role(value)
+                stats.roles += 1
+                pending = False
+            elif key == 'privileges':
+                self.add_privilege(value)
+                stats.privileges += 1
+                pending = False
+            elif key == 'acl':
+                rules.append((value['role'], value['privilege'], context,
+                              value.get('allow', True)))
+            if len(rules) >= batch_size and not pending:
+                try:
+                    flush(rules)
+                except (MissingRole, MissingPrivilege):
+                    pending = True
+                else:
+                    rules = []
+        stats.finished = True
+        flush(rules)
+        return self
+
+    def _load_role(self, value):
+        if isinstance(value, dict):
+            self.add_role(**value)
+        elif isinstance(value, (str, bytes)):
+            self.add_role(value)
+        elif hasattr(value, '__iter__'):
+            self.add_role(*value)
+        else:
+            self.add_role(value)
+
+    def compile_snapshot(self, path):
+        """Writes read-only image of the ACL into path.
+
+        Load it with simpleacl.snapshot.load_snapshot().
+        """
+        from simpleacl.snapshot import write_snapshot
+        write_snapshot(self, path)
         return self
 
+    def compile(self, verify=True):
+        """Returns (optimized ACL, report) of the policy.
+
+        See simpleacl.compiler.compile_policy().
+        """
+        from simpleacl.compiler import compile_policy
+        return compile_policy(self, verify)
+
     @classmethod
     def create_instance(cls, json_or_dict):
         """You can store your roles, privileges and allow list (many to many)
@@ -0,0 +1,230 @@
+"""Asyncio support, requires Python 3.5+"""
+from __future__ import absolute_import, unicode_literals
+import asyncio
+
+from simpleacl import Acl, SimpleBackend, ALL_PRIVILEGES
+from simpleacl.cache import MISSING
+from simpleacl.exceptions import MissingActiveRole
+
+
+class AsyncBackend(object):
+    """Protocol of asynchronous rule storage.
+
+    Mirrors the rule methods of SimpleBackend as coroutines. Subclasses
+    should override is_allowed_many() to answer all keys in one round
+    trip; the default asks is_allowed() for every key concurrently.
+    """
+
+    async def add_rule(self, role, privilege=ALL_PRIVILEGES,
+                       context=None, allow=True):
+        raise NotImplementedError
+
+    async def remove_rule(self, role, privilege=ALL_PRIVILEGES,
+                          context=None, allow=True):
+        raise NotImplementedError
+
+    async def role_has_privilege(self, role, privilege, context=None,
+                                 allow=True):
+        return await self.is_allowed(role, privilege, context) == allow
+
+    async def is_allowed(self, role, privilege, context=None, undef=None):
+        raise NotImplementedError
+
+    async def is_allowed_many(self, keys, undef=None):
+        return list(await asyncio.gather(*[
+            self.is_allowed(role, privilege, context, undef)
+            for role, privilege, context in keys
+        ]))
+
+
+class MemoryAsyncBackend(AsyncBackend):
+    """In-process AsyncBackend, a stand-in for a remote storage.
+
+    Counts round trips, and may simulate latency of every round trip.
+    """
+
+    def __init__(self, latency=0):
+        """Constructor."""
+        self.latency = latency
+        self.round_trips = 0
+        self._storage = SimpleBackend()
+
+    async def _round_trip(self):
+        self.round_trips += 1
+        await asyncio.sleep(self.latency)
+
+    async def add_rule(self, role, privilege=ALL_PRIVILEGES,
+                       context=None, allow=True):
+        await self._round_trip()
+        self._storage.add_rule(role, privilege, context, allow)
+        return self
+
+    async def remove_rule(self, role, privilege=ALL_PRIVILEGES,
+                          context=None, allow=True):
+        await self._round_trip()
+        self._storage.remove_rule(role, privilege, context, allow)
+        return self
+
+    async def is_allowed(self, role, privilege, context=None, undef=None):
+        await self._round_trip()
+        return self._storage.is_allowed(role, privilege, context, undef)
+
+    async def is_allowed_many(self, keys, undef=None):
+        await self._round_trip()
+        return self._storage.is_allowed_many(keys, undef)
+
+
+class AsyncAcl(Acl):
+    """Access control list with rules in an AsyncBackend.
+
+    Roles and privileges are kept by the synchronous backend, rules are
+    read and written by coroutines only.
+    """
+
+    def __init__(self, backend_class=None, async_backend=None,
+                 cache_size=None):
+        """Constructor."""
+        super(AsyncAcl, self).__init__(backend_class, cache_size)
+        if async_backend is None:
+            async_backend = MemoryAsyncBackend()
+        self._async_backend = async_backend
+        self._in_flight = {}
+
+    def add_rule(self, role, privileges=ALL_PRIVILEGES,
+                 context=None, allow=True):
+        raise TypeError('Rules of AsyncAcl are changed by add_rule_async().')
+
+    remove_rule = add_rule
+
+    def add_rules(self, rows, context=None, atomic=True):
+        raise TypeError('Rules of AsyncAcl are changed by add_rule_async().')
+
+    def edit(self):
+        raise TypeError('Rules of AsyncAcl are changed by add_rule_async().')
+
+    def check(self, role, privilege, context=None, undef=False):
+        raise TypeError('Rules of AsyncAcl are read by coroutines only.')
+
+    def is_allowed(self, privilege, context=None, undef=False):
+        raise TypeError('Rules of AsyncAcl are read by coroutines only.')
+
+    def is_allowed_many(self, queries, undef=False):
+        raise TypeError('Rules of AsyncAcl are read by coroutines only.')
+
+    def role_has_privilege(self, role, privilege, context=None, allow=True):
+        raise TypeError('Rules of AsyncAcl are read by coroutines only.')
+
+    def effective_privileges(self, role, context=None):
+        raise TypeError('Rules of AsyncAcl are read by coroutines only.')
+
+    roles_with_privilege = effective_privileges
+
+    def filter_allowed(self, privilege, objects, key=None, role=None):
+        raise TypeError('Rules of AsyncAcl are read by coroutines only.')
+
+    def compile(self, verify=True):
+        raise TypeError('Rules of AsyncAcl are read by coroutines only.')
+
+    def compile_snapshot(self, path):
+        raise TypeError('Rules of AsyncAcl are read by coroutines only.')
+
+    async def add_rule_async(self, role, privileges=ALL_PRIVILEGES,
+                             context=None, allow=True):
+        """Adds rule to the ACL"""
+        if isinstance(privileges, (str, bytes)) or \
+                not hasattr(privileges, '__iter__'):
+            privileges = (privileges, )
+        role = self.get_role(role)
+        privileges = [self.get_privilege(priv) for priv in privileges]
+        try:
+            for priv in privileges:
+                await self._async_backend.add_rule(role, priv, context, allow)
+        finally:
+            self._changed()
+        return self
+
+    async def remove_rule_async(self, role, privileges=ALL_PRIVILEGES,
+                                context=None, allow=True):
+        """Removes rule from ACL"""
+        if isinstance(privileges, (str, bytes)) or \
+                not hasattr(privileges, '__iter__'):
+            privileges = (privileges, )
+        role = self.get_role(role)
+        privileges = [self.get_privilege(priv) for priv in privileges]
+        try:
+            for priv in privileges:
+                await self._async_backend.remove_rule(
+                    role, priv, context, allow
+                )
+        finally:
+            self._changed()
+        return self
+
+    async def allow_async(self, role, privileges=ALL_PRIVILEGES,
+                          context=None):
+        """Adds an "allow" rule to the ACL"""
+        return await self.add_rule_async(role, privileges, context, True)
+
+    async def deny_async(self, role, privileges=ALL_PRIVILEGES,
+                         context=None):
+        """Adds a "deny" rule to the ACL"""
+        return await self.add_rule_async(role, privileges, context, False)
+
+    async def role_has_privilege_async(self, role, privilege, context=None,
+                                       allow=True):
+        """Returns True if role has privilege"""
+        return await self._async_backend.role_has_privilege(
+            self.get_role(role), self.get_privilege(privilege), context, allow
+        )
+
+    async def is_allowed_async(self, privilege, context=None, undef=False):
+        """Returns True if active role is allowed
+
+        for given privilege in given given context
+        """
+        role = self.active_role
+        if not role:
+            raise MissingActiveRole(
+                "A role must be set active before checking permissions"
+            )
+        return await self.check_async(role, privilege, context, undef)
+
+    async def check_async(self, role, privilege, context=None, undef=False):
+        """Returns True if role is allowed
+
+        for given privilege in given context. All rules along the role,
+        context and privilege hierarchies are fetched in one round trip,
+        and concurrent identical checks share it.
+        """
+        role = self.get_role(role)
+        privilege = self.get_privilege(privilege)
+        generation = self._generation
+        key = self._get_decision_key(role, privilege, context)
+
+        allow = MISSING
+        if self._cache is not None:
+            allow = self._cache.get(key, generation)
+        if allow is MISSING:
+            flight = (key, generation)
+            future = self._in_flight.get(flight)
+            if future is None:
+                future = asyncio.ensure_future(
+                    self._resolve_async(role, privilege, context)
+                )
+                self._in_flight[flight] = future
+                future.add_done_callback(
+                    lambda future: self._in_flight.pop(flight, None)
+                )
+            allow = await asyncio.shield(future)
+            if self._cache is not None:
+                self._cache.set(key, allow, generation)
+        if allow is None:
+            return undef
+        return allow
+
+    async def _resolve_async(self, role, privilege, context=None):
+        keys = self._get_candidates(role, privilege, context)
+        for allow in await self._async_backend.is_allowed_many(keys, None):
+            if allow is not None:
+                return allow
+        return None
@@ -0,0 +1,260 @@
+from __future__ import absolute_import, unicode_literals
+
+from simpleacl import SimpleBackend, ALL_PRIVILEGES, WILDCARD
+
+
+class BitsetBackend(SimpleBackend):
+    """A compact storage for dense policies.
+
+    Privileges are interned to bit positions, and the rules of a role in
+    a context are kept as a pair of integers: the bitset of allowed and
+    the bitset of denied privileges. Rows are keyed by role name, as the
+    hash of a string is cached by Python itself.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        super(BitsetBackend, self).__init__()
+        self._bits = {}  # Privilege name to bit
+        self._depths = {}  # Bit to precedence of dotted parent, see _expand()
+        # Bit to bitset of dotted descendants, by number of privileges
+        self._subtrees = (0, {})
+
+    def add_privilege(self, privilege):
+        """Adds privilege"""
+        name = privilege.get_name()
+        if name not in self._bits:
+            self._bits[name] = 1 << len(self._bits)
+            # "a.*" is closer than "a" and farther than "a.b" to "a.b.c"
+            depth = name.count('.') * 2
+            if name.endswith('.' + WILDCARD):
+                depth -= 1
+            self._depths[self._bits[name]] = depth
+        return super(BitsetBackend, self).add_privilege(privilege)
+
+    def add_rule(self, role, privilege=ALL_PRIVILEGES,
+                 context=None, allow=True):
+        """Adds rule to the ACL"""
+        bit = self._bits[privilege.get_name()]
+        row = self._get_rows(context)[0].setdefault(role.name, [0, 0])
+        if allow:
+            row[0] |= bit
+            row[1] &= ~bit
+        else:
+            row[1] |= bit
+            row[0] &= ~bit
+        return self
+
+    def add_rules_bulk(self, rules):
+        """Adds many rules given as {context: {role: {privilege: allow}}}"""
+        bits = self._bits
+        for context, roles in rules.items():
+            rows = self._get_rows(context)[0]
+            for role, privileges in roles.items():
+                allow = deny = 0
+                for privilege, value in privileges.items():
+                    if value:
+                        allow |= bits[privilege.get_name()]
+                    else:
+                        deny |= bits[privilege.get_name()]
+                row = rows.setdefault(role.name, [0, 0])
+                row[0] = (row[0] & ~deny) | allow
+                row[1] = (row[1] & ~allow) | deny
+        return self
+
+    def remove_rule(self, role, privilege=ALL_PRIVILEGES,
+                    context=None, allow=True):
+        """Removes rule from ACL"""
+        try:
+            self._acl[context][role.name]
+            bit = self._bits[privilege.get_name()]
+        except KeyError:
+            return self
+        rows = self._get_rows(context)[0]
+        row = rows[role.name]
+        row[0 if allow else 1] &= ~bit
+        if not (row[0] or row[1]):
+            del rows[role.name]
+            if not rows:
+                del self._acl[context]
+        return self
+
+    def role_has_privilege(self, role, privilege, context=None, allow=True):
+        """Returns True if there is such rule"""
+        try:
+            row = self._acl[context][role.name]
+            bit = self._bits[privilege.get_name()]
+        except KeyError:
+            return False
+        return bool(row[0 if allow else 1] & bit)
+
+    def is_allowed(self, role, privilege, context=None, undef=None):
+        """Returns True if active role is allowed
+
+        for given privilege in given given context
+        """
+        try:
+            row = self._acl[context][role.name]
+            bit = self._bits[privilege.name]
+        except KeyError:
+            return undef
+        if row[0] & bit:
+            return True
+        if row[1] & bit:
+            return False
+        return undef
+
+    def find_rule(self, roles, privileges, contexts):
+        """Returns the first rule of given keys, or None if there is none.
+
+        See SimpleBackend.find_rule(). A row is skipped by one AND with
+        the bits of all privileges.
+        """
+        acl = self._acl
+        layers = [acl[context] for context in contexts if context in acl]
+        bits = [self._bits[privilege.name] for privilege in privileges
+                if privilege.name in self._bits]
+        mask = 0
+        for bit in bits:
+            mask |= bit
+        if not layers or not mask:
+            return None
+        for role in roles:
+            name = role.name
+            for rows in layers:
+                row = rows.get(name)
+                if row is None or not (row[0] | row[1]) & mask:
+                    continue
+                for bit in bits:
+                    if row[0] & bit:
+                        return True
+                    if row[1] & bit:
+                        return False
+        return None
+
+    def is_allowed_many(self, keys, undef=None):
+        """Returns is_allowed() for each (role, privilege, context) key"""
+        acl = self._acl
+        bits = self._bits
+        result = []
+        for role, privilege, context in keys:
+            try:
+                row = acl[context][role.name]
+                bit = bits[privilege.name]
+            except KeyError:
+                result.append(undef)
+                continue
+            if row[0] & bit:
+                result.append(True)
+            elif row[1] & bit:
+                result.append(False)
+            else:
+                result.append(undef)
+        return result
+
+    def get_rules(self, role, context=None):
+        """Returns {privilege name: allow} of rules of role in context"""
+        try:
+            allow, deny = self._acl[context][role.name]
+        except KeyError:
+            return {}
+        result = {}
+        for name, bit in self._bits.items():
+            if allow & bit:
+                result[name] = True
+            elif deny & bit:
+                result[name] = False
+        return result
+
+    def get_roles_with_rule(self, privilege, context=None):
+        """Returns {role: allow} of rules for privilege in context.
+
+        There is no reverse index, so the rows of the context are scanned;
+        that is one AND per role.
+        """
+        try:
+            rows = self._acl[context]
+            bit = self._bits[privilege.get_name()]
+        except KeyError:
+            return {}
+        return dict((self._roles[name], bool(allow & bit))
+                    for name, (allow, deny) in rows.items()
+                    if (allow | deny) & bit)
+
+    def iter_rules(self):
+        """Yields (role, privilege, context, allow) for all rules"""
+        privileges = [(self._privileges[name], bit)
+                      for name, bit in self._bits.items()]
+        for context, rows in list(self._acl.items()):
+            for name, (allow, deny) in list(rows.items()):
+                role = self._roles[name]
+                for privilege, bit in privileges:
+                    if allow & bit:
+                        yield role, privilege, context, True
+                    elif deny & bit:
+                        yield role, privilege, context, False
+
+    def get_effective_privileges(self, layers):
+        """Returns {privilege: allow} for all decided privileges.
+
+        layers is a sequence of (role, context) pairs in the order of
+        precedence, see Acl._resolve(). Each layer is merged with a few
+        OR/AND-NOT operations over the whole privilege bitset.
+        """
+        allowed = decided = 0
+        for role, context in layers:
+            try:
+                row = self._acl[context][role.name]
+            except KeyError:
+                continue
+            allow, deny = self._expand(row[0], row[1])
+            allowed |= allow & ~decided
+            decided |= allow | deny
+        result = {}
+        for name, bit in self._bits.items():
+            if decided & bit:
+                result[self._privileges[name]] = bool(allowed & bit)
+        return result
+
+    def _expand(self, allow, deny):
+        """Applies "all" and dotted privilege rules within one layer"""
+        all_bit = self._bits[ALL_PRIVILEGES]
+        decided = allow | deny
+        if decided & all_bit:
+            rest = ((1 << len(self._bits)) - 1) & ~decided
+            if allow & all_bit:
+                return allow | rest, deny
+            return allow, deny | rest
+        subtrees = self._get_subtrees()
+        parents = [bit for bit in subtrees if decided & bit]
+        # The closest dotted parent wins, so go from the deepest one
+        parents.sort(key=self._depths.get, reverse=True)
+        for bit in parents:
+            rest = subtrees[bit] & ~decided
+            if allow & bit:
+                allow |= rest
+            else:
+                deny |= rest
+            decided |= rest
+        return allow, deny
+
+    def _get_subtrees(self):
+        # Privileges are shared with copies, so their number is the version
+        count, subtrees = self._subtrees
+        if count != len(self._bits):
+            count = len(self._bits)
+            subtrees = {}
+            for name, bit in self._bits.items():
+                wildcard = name.endswith('.' + WILDCARD)
+                while '.' in name:
+                    name = name.rsplit('.', 1).pop(0)
+                    parents = [name]
+                    if not wildcard:
+                        parents.append(name + '.' + WILDCARD)
+                    wildcard = False
+                    for parent in parents:
+                        if parent in self._bits:
+                            parent = self._bits[parent]
+                            subtrees[parent] = subtrees.get(parent, 0) | bit
+            self._subtrees = (count, subtrees)
+        return subtrees
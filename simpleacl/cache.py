@@ -0,0 +1,71 @@
+from __future__ import absolute_import, unicode_literals
+import threading
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+MISSING = object()
+
+
+class DecisionCache(object):
+    """Bounded LRU storage for authorization decisions.
+
+    Every entry belongs to the generation it was computed in. A lookup
+    with another generation drops the whole cache, so a decision made
+    before a policy change can never be returned after it. The cache is
+    safe to share between threads.
+    """
+
+    def __init__(self, maxsize=1024):
+        """Constructor."""
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.generation = None
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, generation, default=MISSING):
+        """Returns cached decision or default"""
+        with self._lock:
+            if generation != self.generation:
+                self._data.clear()
+                self.generation = generation
+                self.misses += 1
+                return default
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value  # Mark as most recently used
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation):
+        """Stores decision computed in the given generation.
+
+        Pass the generation read before the decision was computed; a
+        decision of another generation than the one of the last get()
+        may be stale, and it is dropped.
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Drops all entries and resets counters"""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Returns hit/miss statistics"""
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,287 @@
+"""Validation and optimization of a policy.
+
+compile_policy() reads roles, privileges and rules of an ACL, checks
+the role hierarchy, and builds an equivalent in-memory ACL:
+
+    * rule-less roles with a single parent are spliced out of the
+      parent lists of their children, which shortens ancestor chains;
+    * rules which do not change any answer are dropped, like a grant
+      which a child repeats after its parent.
+
+Answers are identical for every role and privilege, without context and
+in every context chain. A chain built later may put any rule contexts
+one after another, so while rules are kept in several contexts, a rule
+in a context is dropped only if other rules of its role in the same
+context decide the same way.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from simpleacl import Acl, Context, get_context_key
+
+
+class CompileReport(object):
+    """What compile_policy() has found and changed"""
+
+    def __init__(self):
+        self.cycles = []  # Lists of role names, the first one repeated
+        self.unreachable = []  # Roles which no rule applies to
+        self.redundant = []  # Dropped (role, privilege, context, allow)
+        self.flattened = []  # (role, parent) links replaced by grandparent
+        self.rules_before = 0
+        self.rules_after = 0
+        self.links_before = 0  # Explicit parent links
+        self.links_after = 0
+        self.depth_before = 0.0  # Mean number of role ancestors
+        self.depth_after = 0.0
+        self.max_depth_before = 0
+        self.max_depth_after = 0
+
+    @property
+    def ok(self):
+        return not self.cycles
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        if self.cycles:
+            return '<CompileReport {0} cycles>'.format(len(self.cycles))
+        return ('<CompileReport rules {0.rules_before} -> {0.rules_after}, '
+                'mean depth {0.depth_before:.2f} -> {0.depth_after:.2f}, '
+                '{1} unreachable roles>'.format(self, len(self.unreachable)))
+
+
+def _get_parent_names(acl, name):
+    """Returns explicit and dotted parents of role without loading it"""
+    backend = acl._backend
+    get_role_parents = getattr(backend, 'get_role_parents', None)
+    if get_role_parents is not None:
+        parents = list(get_role_parents(name))
+    else:
+        parents = [parent.get_name()
+                   for parent in backend.get_role(name).get_parents()]
+    if '.' in name:
+        parents.append(name.rsplit('.', 1).pop(0))
+    return parents
+
+
+def find_cycles(graph):
+    """Returns cycles of {name: [parent names]} as lists of names"""
+    cycles = []
+    state = {}  # 1 while on the stack, 2 when done
+    for start in sorted(graph):
+        if start in state:
+            continue
+        path = [start]
+        stack = [iter(graph.get(start, ()))]
+        state[start] = 1
+        while stack:
+            for parent in stack[-1]:
+                if state.get(parent) == 1:
+                    cycles.append(path[path.index(parent):] + [parent])
+                elif parent not in state:
+                    state[parent] = 1
+                    path.append(parent)
+                    stack.append(iter(graph.get(parent, ())))
+                    break
+            else:
+                state[path.pop()] = 2
+                stack.pop()
+    return cycles
+
+
+def _depths(acl, names):
+    depths = [len(acl.get_role(name).get_ancestors()) - 1 for name in names]
+    if not depths:
+        return 0.0, 0
+    return float(sum(depths)) / len(depths), max(depths)
+
+
+def compile_policy(acl, verify=True, acl_class=Acl):
+    """Returns (optimized ACL, CompileReport) of acl.
+
+    The optimized ACL is None if the role hierarchy has cycles. With
+    verify the optimized ACL is checked against acl for every role,
+    privilege and context with rules, and AssertionError is raised on
+    any difference.
+    """
+    report = CompileReport()
+    backend = acl._backend
+    role_names = sorted(backend.get_role_names())
+    privilege_names = sorted(backend.get_privilege_names())
+    graph = dict((name, _get_parent_names(acl, name)) for name in role_names)
+    report.cycles = find_cycles(graph)
+    if report.cycles:
+        return None, report
+
+    rules = list(backend.iter_rules())
+    report.rules_before = len(rules)
+    report.links_before = sum(
+        len(acl.get_role(name).get_parents()) for name in role_names
+    )
+    report.depth_before, report.max_depth_before = _depths(acl, role_names)
+
+    has_rules = set(role.get_name() for role, p, c, a in rules)
+    parents = dict((name, [parent.get_name() for parent in
+                           acl.get_role(name).get_parents()])
+                   for name in role_names)
+    for name in role_names:
+        _flatten(name, parents, graph, has_rules, report)
+
+    target = acl_class()
+    for name in privilege_names:
+        target.add_privilege(name)
+    for name in role_names:
+        target.add_role(name)
+    for name in role_names:
+        for parent in parents[name]:
+            target.get_role(name).add_parent(parent)
+    for role, privilege, context, allow in rules:
+        target.add_rule(role.get_name(), privilege.get_name(), context, allow)
+
+    contexts = [None]
+    for role, privilege, context, allow in rules:
+        if context not in contexts:
+            contexts.append(context)
+    table = _get_table(target, role_names, privilege_names, contexts)
+    _drop_redundant(target, rules, privilege_names, contexts, table, report)
+    target._changed()
+
+    report.rules_after = report.rules_before - len(report.redundant)
+    report.links_after = sum(len(names) for names in parents.values())
+    report.depth_after, report.max_depth_after = _depths(target, role_names)
+    report.unreachable = _find_unreachable(target, role_names)
+
+    if verify:
+        for context in contexts + _get_chains(contexts):
+            for role in role_names:
+                for privilege in privilege_names:
+                    if target.check(role, privilege, context, None) != \
+                            acl.check(role, privilege, context, None):
+                        raise AssertionError(
+                            'Compiled policy differs for {0!r}'.format(
+                                (role, privilege, context)
+                            )
+                        )
+    return target, report
+
+
+def _get_chains(contexts):
+    """Returns contexts whose chains put each rule context before another"""
+    contexts = [context for context in contexts if context is not None]
+    chains = []
+    for first in contexts:
+        for second in contexts:
+            if second != first:
+                chains.append(Context(
+                    (get_context_key(first), get_context_key(second)),
+                    parents=[first, second]
+                ))
+    return chains
+
+
+def _flatten(name, parents, graph, has_rules, report):
+    """Splices rule-less single-parent roles out of the parents of name"""
+    result = []
+    for parent in parents[name]:
+        # Ancestors of such parent are its only parent and its ancestors,
+        # so the order of the remaining ancestors is kept
+        while parent not in has_rules and len(graph[parent]) == 1:
+            report.flattened.append((name, parent))
+            parent = graph[parent][0]
+        if parent not in result:
+            result.append(parent)
+    parents[name] = result
+
+
+def _get_table(acl, role_names, privilege_names, contexts):
+    """Returns {(role, privilege, context key): answer} of all checks"""
+    table = {}
+    for role in role_names:
+        for privilege in privilege_names:
+            for context in contexts:
+                table[role, privilege, get_context_key(context)] = \
+                    acl.check(role, privilege, context, None)
+    return table
+
+
+def _drop_redundant(target, rules, privilege_names, contexts, table, report):
+    """Drops rules which do not change any answer, children first"""
+    backend = target._backend
+    covers = {}  # Privilege to names of privileges whose chain includes it
+    for name in privilege_names:
+        for item in target._get_privilege_chain(target.get_privilege(name)):
+            covers.setdefault(item.get_name(), []).append(name)
+    rules = sorted(rules, key=lambda rule: (
+        -(len(target.get_role(rule[0].get_name()).get_ancestors())),
+        rule[0].get_name(), rule[1].get_name(), get_context_key(rule[2])
+    ))
+    for role, privilege, context, allow in rules:
+        role = target.get_role(role.get_name())
+        privilege = target.get_privilege(privilege.get_name())
+        backend.remove_rule(role, privilege, context, allow)
+        if _is_redundant(target, role, privilege, context, allow, covers,
+                         contexts, table):
+            report.redundant.append(
+                (role.get_name(), privilege.get_name(), context, allow)
+            )
+        else:
+            backend.add_rule(role, privilege, context, allow)
+
+
+def _is_redundant(target, role, privilege, context, allow, covers, contexts,
+                  table):
+    if context is not None and len(contexts) > 2:
+        # Contexts with rules may be chained in any order
+        return _is_repeated_in_layer(target, role, privilege, context,
+                                     allow, covers)
+    key = get_context_key(context)
+    if target._resolve(role, privilege, context) != \
+            table[role.get_name(), privilege.get_name(), key]:
+        return False  # The usual case, so it is checked first
+    roles = []
+    stack = [role]
+    while stack:
+        item = stack.pop()
+        if item not in roles:
+            roles.append(item)
+            stack.extend(item._children)
+    affected = [item for item in contexts
+                if context in target._get_context_chain(item)]
+    for item in roles:
+        for name in covers[privilege.get_name()]:
+            for parent in affected:
+                answer = target._resolve(item, target.get_privilege(name),
+                                         parent)
+                if answer != table[item.get_name(), name,
+                                   get_context_key(parent)]:
+                    return False
+    return True
+
+
+def _is_repeated_in_layer(target, role, privilege, context, allow, covers):
+    """Returns True if other rules of role in context shadow or repeat
+    the removed rule for every privilege whose chain includes it"""
+    is_allowed = target._backend.is_allowed
+    for name in covers[privilege.get_name()]:
+        passed = False
+        for item in target._get_privilege_chain(target.get_privilege(name)):
+            if item == privilege:
+                passed = True
+                continue
+            answer = is_allowed(role, item, context, None)
+            if answer is not None:
+                if passed and answer != allow:
+                    return False
+                break
+        else:
+            return False
+    return True
+
+
+def _find_unreachable(target, role_names):
+    """Returns names of roles which no rule applies to"""
+    ruled = set(role for role, privilege, context, allow
+                in target._backend.iter_rules())
+    return [name for name in role_names
+            if ruled.isdisjoint(target.get_role(name).get_ancestors())]
@@ -0,0 +1,52 @@
+from __future__ import absolute_import, unicode_literals
+import mmap
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+COUNTER = struct.Struct('<Q')
+
+
+class SharedGeneration(object):
+    """Policy generation counter shared by processes through a file.
+
+    The file holds one 64-bit integer and is memory-mapped, so get() is
+    a single read of shared memory and costs no system call. Whoever
+    changes the policy source calls bump(), and every process which
+    mapped the file sees the new value at once; see AclMiddleware.
+    """
+
+    def __init__(self, path):
+        """Constructor."""
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < COUNTER.size:
+                os.ftruncate(fd, COUNTER.size)
+            self._mmap = mmap.mmap(fd, COUNTER.size)
+        finally:
+            os.close(fd)
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns the current generation"""
+        return COUNTER.unpack_from(self._mmap)[0]
+
+    def bump(self):
+        """Increments the generation and returns the new one"""
+        with self._lock:
+            with open(self.path, 'rb') as f:
+                if fcntl is not None:  # Serializes bumps of processes
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                generation = self.get() + 1
+                COUNTER.pack_into(self._mmap, 0, generation)
+                self._mmap.flush()
+        return generation
+
+    def close(self):
+        self._mmap.close()
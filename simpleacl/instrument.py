@@ -0,0 +1,105 @@
+from __future__ import absolute_import, unicode_literals
+import threading
+import time
+from bisect import bisect_left
+from collections import namedtuple
+
+# Levels of the rule which decided a check, see Acl._trace()
+DIRECT = 'direct'
+ALL = 'all'
+ROLE_PARENT = 'role_parent'
+DOTTED_ROLE = 'dotted_role'
+DOTTED_PRIVILEGE = 'dotted_privilege'
+CONTEXT_PARENT = 'context_parent'
+UNDEF = 'undef'
+CACHED = 'cached'
+
+LEVELS = (DIRECT, ALL, ROLE_PARENT, DOTTED_ROLE, DOTTED_PRIVILEGE,
+          CONTEXT_PARENT, UNDEF, CACHED)
+
+# Upper bounds of latency histogram buckets, in seconds
+LATENCY_BUCKETS = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4,
+                   1e-3, 1e-2, float('inf'))
+
+clock = getattr(time, 'perf_counter', time.time)
+
+# One traced check. allow is None when no rule decided. depth is the
+# position of the deciding role in Role.get_ancestors(), 0 for the role
+# itself; for undecided checks it is the number of ancestors.
+# backend_calls is the number of rules looked up, 0 for cached decisions.
+# elapsed is in seconds.
+Decision = namedtuple('Decision', [
+    'role', 'privilege', 'context', 'allow', 'level', 'depth',
+    'backend_calls', 'elapsed'
+])
+
+
+class Instrumentation(object):
+    """Collects statistics of Acl.check() and is_allowed() decisions.
+
+    Assign an instance to acl.instrumentation to enable it, and None to
+    disable it again; a disabled ACL pays only for one attribute lookup
+    per check. callback(decision) is called with each Decision, so the
+    statistics can be exported to a metrics system. The counters are
+    safe to share between threads.
+    """
+
+    def __init__(self, callback=None, buckets=LATENCY_BUCKETS):
+        """Constructor."""
+        self.callback = callback
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Sets all counters to zero"""
+        with self._lock:
+            self.checks = 0
+            self.allowed = 0
+            self.denied = 0
+            self.backend_calls = 0
+            self.elapsed = 0.0
+            self.max_depth = 0
+            self.levels = dict.fromkeys(LEVELS, 0)
+            self.latency = [0] * len(self.buckets)
+            self.depths = {}
+
+    def record(self, decision):
+        """Counts decision and passes it to the callback"""
+        with self._lock:
+            self.checks += 1
+            if decision.allow:
+                self.allowed += 1
+            elif decision.allow is not None:
+                self.denied += 1
+            self.backend_calls += decision.backend_calls
+            self.elapsed += decision.elapsed
+            self.levels[decision.level] = \
+                self.levels.get(decision.level, 0) + 1
+            self.latency[bisect_left(self.buckets, decision.elapsed)] += 1
+            if decision.level != CACHED:
+                self.depths[decision.depth] = \
+                    self.depths.get(decision.depth, 0) + 1
+                self.max_depth = max(self.max_depth, decision.depth)
+        if self.callback is not None:
+            self.callback(decision)
+
+    def stats(self):
+        """Returns the counters as a dict"""
+        with self._lock:
+            return {
+                'checks': self.checks,
+                'allowed': self.allowed,
+                'denied': self.denied,
+                'undecided': self.levels[UNDEF],
+                'backend_calls': self.backend_calls,
+                'backend_calls_per_check': (
+                    self.backend_calls / float(self.checks)
+                    if self.checks else 0.0
+                ),
+                'elapsed': self.elapsed,
+                'max_depth': self.max_depth,
+                'levels': dict(self.levels),
+                'depths': dict(self.depths),
+                'latency': list(zip(self.buckets, self.latency)),
+            }
@@ -0,0 +1,401 @@
+from __future__ import absolute_import, unicode_literals
+import threading
+import time
+from contextlib import contextmanager
+
+from simpleacl import SimpleBackend, ALL_PRIVILEGES, get_context_key, json
+from simpleacl.exceptions import MissingRole, MissingPrivilege
+
+clock = getattr(time, 'monotonic', time.time)
+
+ALLOW = '1'
+DENY = '0'
+FLUSH = '*'  # Invalidation message which drops whole near-caches
+
+
+class KVClient(object):
+    """Interface of clients of a key-value store used by KVBackend.
+
+    Keys and values are strings. mget() must fetch all keys in one round
+    trip (a pipeline or a multi-get command), so a check costs at most
+    one. Adapt the client of your store (Redis, say) to these methods.
+    """
+
+    def mget(self, keys):
+        """Returns values of keys, None for missing ones"""
+        raise NotImplementedError
+
+    def mset(self, mapping):
+        """Stores {key: value} in one round trip"""
+        raise NotImplementedError
+
+    def delete(self, keys):
+        """Deletes keys in one round trip"""
+        raise NotImplementedError
+
+    def scan(self, prefix):
+        """Returns {key: value} of keys which start with prefix"""
+        raise NotImplementedError
+
+    def publish(self, channel, message):
+        """Sends message to subscribers of channel"""
+        raise NotImplementedError
+
+    def subscribe(self, channel, callback):
+        """Calls callback(message) for every message sent to channel"""
+        raise NotImplementedError
+
+
+class MemoryKVServer(object):
+    """In-process stand-in of a key-value store, for tests"""
+
+    def __init__(self):
+        """Constructor."""
+        self.data = {}
+        self.subscribers = {}
+        self._lock = threading.Lock()
+
+
+class MemoryKVClient(KVClient):
+    """Client of MemoryKVServer which counts its round trips"""
+
+    def __init__(self, server=None):
+        """Constructor."""
+        self.server = server or MemoryKVServer()
+        self.round_trips = 0
+
+    def mget(self, keys):
+        self.round_trips += 1
+        data = self.server.data
+        return [data.get(key) for key in keys]
+
+    def mset(self, mapping):
+        self.round_trips += 1
+        with self.server._lock:
+            self.server.data.update(mapping)
+
+    def delete(self, keys):
+        self.round_trips += 1
+        with self.server._lock:
+            for key in keys:
+                self.server.data.pop(key, None)
+
+    def scan(self, prefix):
+        self.round_trips += 1
+        with self.server._lock:
+            return dict((key, value)
+                        for key, value in self.server.data.items()
+                        if key.startswith(prefix))
+
+    def publish(self, channel, message):
+        self.round_trips += 1
+        with self.server._lock:
+            callbacks = list(self.server.subscribers.get(channel, ()))
+        for callback in callbacks:
+            callback(message)
+
+    def subscribe(self, channel, callback):
+        with self.server._lock:
+            self.server.subscribers.setdefault(channel, []).append(callback)
+
+
+class KVBackend(SimpleBackend):
+    """A shared storage in a key-value store.
+
+    Roles, role parents, privileges and rules are kept in the store
+    under prefix, so all processes share one policy. Role and privilege
+    instances are loaded on demand and kept in memory. Rule lookups are
+    kept in a near-cache for ttl seconds; every change of a rule is
+    published on channel, and all backends subscribed to it drop the
+    cached lookup at once, so ttl only bounds the staleness when a
+    message is lost. Changes of role parents are published too, and
+    the ACLs of loaded roles read the parents again.
+
+    A check fetches all candidate rules of the role ancestors, contexts
+    and privileges which are not in the near-cache in one mget(), see
+    find_rule().
+
+    Use functools.partial(KVBackend, client) as backend_class of Acl.
+    """
+
+    prefix = 'simpleacl:'
+    ttl = 1.0
+    cache_size = 100000
+
+    def __init__(self, client=None, prefix=None, ttl=None, cache_size=None,
+                 channel=None):
+        """Constructor."""
+        super(KVBackend, self).__init__()
+        self.client = client or MemoryKVClient()
+        if prefix is not None:
+            self.prefix = prefix
+        if ttl is not None:
+            self.ttl = ttl
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self.channel = channel or self.prefix + 'invalidate'
+        self._cache = {}  # Rule key to (value, expiry time)
+        self._local = threading.local()
+        self.client.subscribe(self.channel, self._invalidate)
+
+    def _invalidate(self, message):
+        """Drops the cached lookup or role named by an invalidation message"""
+        if message == FLUSH:
+            self._cache = {}
+        elif message.startswith(self._role_prefix):
+            role = self._roles.get(message[len(self._role_prefix):])
+            if role is not None and role.acl is not None:
+                role.acl._reload_role(role)
+        else:
+            self._cache.pop(message, None)
+
+    def clear_cache(self):
+        """Drops cached lookups"""
+        self._cache = {}
+
+    def _write(self, mapping=None, deleted=None):
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None:  # Later writes of a key win, None deletes
+            pending.update(mapping or {})
+            pending.update(dict.fromkeys(deleted or ()))
+            return
+        if mapping:
+            self.client.mset(mapping)
+        if deleted:
+            self.client.delete(deleted)
+        for key in list(mapping or ()) + list(deleted or ()):
+            if key.startswith(self._rule_prefix):
+                self._cache.pop(key, None)
+                self.client.publish(self.channel, key)
+            elif key.startswith(self._role_prefix):
+                self.client.publish(self.channel, key)
+
+    @contextmanager
+    def batch(self):
+        """Collects writes and sends them in two round trips on exit.
+
+        Reads within the block do not see the pending writes, and other
+        backends are told to drop their whole near-cache and to reload
+        the changed roles.
+        """
+        if getattr(self._local, 'pending', None) is not None:
+            yield self  # Nested batch
+            return
+        self._local.pending = pending = {}
+        try:
+            yield self
+        finally:
+            self._local.pending = None
+        mapping = dict((key, value) for key, value in pending.items()
+                       if value is not None)
+        deleted = [key for key, value in pending.items() if value is None]
+        if mapping:
+            self.client.mset(mapping)
+        if deleted:
+            self.client.delete(deleted)
+        self.clear_cache()
+        self.client.publish(self.channel, FLUSH)
+        for key in mapping:
+            if key.startswith(self._role_prefix):
+                self.client.publish(self.channel, key)
+
+    @property
+    def _rule_prefix(self):
+        return self.prefix + 'rule:'
+
+    @property
+    def _role_prefix(self):
+        return self._get_name_key('role', '')
+
+    def _get_key(self, role, privilege, context):
+        return self._rule_prefix + json.dumps(
+            [get_context_key(context), role.name, privilege.name],
+            separators=(',', ':')
+        )
+
+    def _get_name_key(self, kind, name):
+        return '{0}{1}:{2}'.format(self.prefix, kind, name)
+
+    def add_role(self, role, parents=None):
+        """Adds role"""
+        self._roles.setdefault(role.get_name(), role)
+        key = self._get_name_key('role', role.get_name())
+        if self.client.mget([key])[0] is None:
+            self._write({key: '[]'})
+        return self
+
+    def get_role(self, role_name):
+        """Returns a role instance"""
+        try:
+            return self._roles[role_name]
+        except KeyError:
+            pass
+        if self.client.mget([self._get_name_key('role', role_name)])[0] \
+                is None:
+            raise MissingRole(
+                'Role must be added before requested.'
+            )
+        return self._roles.setdefault(role_name, self.role_class(role_name))
+
+    def get_role_parents(self, role_name):
+        """Returns names of stored parents of role"""
+        value = self.client.mget([self._get_name_key('role', role_name)])[0]
+        return json.loads(value) if value else []
+
+    def set_role_parents(self, role, parents):
+        """Stores parents of role"""
+        self._write({self._get_name_key('role', role.get_name()): json.dumps(
+            [parent.get_name() for parent in parents]
+        )})
+        return self
+
+    def add_privilege(self, privilege):
+        """Adds privilege"""
+        self._privileges.setdefault(privilege.get_name(), privilege)
+        self._write({self._get_name_key('privilege', privilege.get_name()):
+                     ALLOW})
+        return self
+
+    def get_privilege(self, privilege_name):
+        """Returns a privilege instance"""
+        try:
+            return self._privileges[privilege_name]
+        except KeyError:
+            pass
+        if self.client.mget([
+                self._get_name_key('privilege', privilege_name)])[0] is None:
+            raise MissingPrivilege(
+                'Privilege must be added before requested.'
+            )
+        return self._privileges.setdefault(
+            privilege_name, self.privilege_class(privilege_name)
+        )
+
+    def _get_names(self, kind):
+        prefix = self._get_name_key(kind, '')
+        return [key[len(prefix):] for key in self.client.scan(prefix)]
+
+    def get_role_names(self):
+        """Returns names of all roles"""
+        return self._get_names('role')
+
+    def get_privilege_names(self):
+        """Returns names of all privileges"""
+        return self._get_names('privilege')
+
+    def iter_rules(self):
+        """Yields (role, privilege, context, allow) for all rules.
+
+        Contexts are given by their keys, see get_context_key().
+        """
+        prefix = self._rule_prefix
+        for key, value in self.client.scan(prefix).items():
+            context, role, privilege = json.loads(key[len(prefix):])
+            yield (self.get_role(role), self.get_privilege(privilege),
+                   context, value == ALLOW)
+
+    def get_rules(self, role, context=None):
+        """Returns {privilege name: allow} of rules of role in context"""
+        prefix = self._rule_prefix
+        rows = self.client.scan(prefix + json.dumps(
+            [get_context_key(context), role.name], separators=(',', ':')
+        )[:-1] + ',')
+        return dict((json.loads(key[len(prefix):])[2], value == ALLOW)
+                    for key, value in rows.items())
+
+    copy = None  # Acl.edit() uses batch(), see there
+
+    # Children of roles which are not loaded yet are unknown, so
+    # Acl.roles_with_privilege() checks all roles
+    get_roles_with_rule = None
+
+    def add_rule(self, role, privilege=ALL_PRIVILEGES,
+                 context=None, allow=True):
+        """Adds rule to the ACL"""
+        self._write({self._get_key(role, privilege, context):
+                     ALLOW if allow else DENY})
+        return self
+
+    def add_rules_bulk(self, rules):
+        """Adds many rules given as {context: {role: {privilege: allow}}}
+
+        All rules are written by one mset().
+        """
+        with self.batch():
+            self._write(dict(
+                (self._get_key(role, privilege, context),
+                 ALLOW if allow else DENY)
+                for context, roles in rules.items()
+                for role, privileges in roles.items()
+                for privilege, allow in privileges.items()
+            ))
+        return self
+
+    def remove_rule(self, role, privilege=ALL_PRIVILEGES,
+                    context=None, allow=True):
+        """Removes rule from ACL"""
+        key = self._get_key(role, privilege, context)
+        if self.client.mget([key])[0] == (ALLOW if allow else DENY):
+            self._write(deleted=[key])
+        return self
+
+    def role_has_privilege(self, role, privilege, context=None, allow=True):
+        """Returns True if there is such a rule"""
+        return self.is_allowed(role, privilege, context) == allow
+
+    def is_allowed(self, role, privilege, context=None, undef=None):
+        """Returns True if active role is allowed
+
+        for given privilege in given given context
+        """
+        return self.is_allowed_many([(role, privilege, context)], undef)[0]
+
+    def is_allowed_many(self, keys, undef=None):
+        """Returns is_allowed() for each (role, privilege, context) key.
+
+        Lookups which are not in the near-cache are fetched by one mget().
+        """
+        keys = [self._get_key(role, privilege, context)
+                for role, privilege, context in keys]
+        cache = self._cache
+        now = clock()
+        values = {}
+        missing = []
+        for key in keys:
+            try:
+                value, expiry = cache[key]
+            except KeyError:
+                missing.append(key)
+                continue
+            if expiry <= now:
+                missing.append(key)
+            else:
+                values[key] = value
+        if missing:
+            missing = list(set(missing))
+            expiry = now + self.ttl
+            if len(cache) + len(missing) > self.cache_size:
+                cache = self._cache = {}
+            for key, value in zip(missing, self.client.mget(missing)):
+                values[key] = value
+                cache[key] = (value, expiry)
+        result = []
+        for key in keys:
+            value = values[key]
+            result.append(undef if value is None else value == ALLOW)
+        return result
+
+    def find_rule(self, roles, privileges, contexts):
+        """Returns the first rule of given keys, or None if there is none.
+
+        All keys are looked up at once, see is_allowed_many(), and the
+        first rule in the order of Acl._resolve() is returned.
+        """
+        for allow in self.is_allowed_many([
+                (role, privilege, context)
+                for role in roles
+                for context in contexts
+                for privilege in privileges]):
+            if allow is not None:
+                return allow
+        return None
@@ -1,51 +1,246 @@
 from __future__ import absolute_import, unicode_literals
-#######################################################################
-# Simpleacl Middleware - A small access control list
-# Copyright (C) 2010  Kyle Terry <kyle@fiverlabs.com>
-#
-# This program is free software: you can redistribute it and/or modify
-# it under the terms of the GNU General Public License as published by
-# the Free Software Foundation, either version 3 of the License, or
-# (at your option) any later version.
-#
-# This program is distributed in the hope that it will be useful,
-# but WITHOUT ANY WARRANTY; without even the implied warranty of
-# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
-# GNU General Public License for more details.
-#
-# You should have received a copy of the GNU General Public License
-# along with this program.  If not, see <http://www.gnu.org/licenses/>.
-#######################################################################
-
-def class_maker(name, classname):
-    """
-    This will dynamically make a class object from a
-    dynamically imported module. This is so a user
-    can call the class whatever they want.
-    """
-    mod = __import__(name)
-    comps = name.split('.')
-    for comp in comps[1:]:
-        mod = getattr(mod, comp)
-    _class = getattr(mod, classname)
-    return _class
-
-class AclMiddleware(object):
-    def __init__(self, app, config):
-        self.app = app
-        self.config = config
-
-    def __call__(self, environ, start_response):
-        acl_builder = class_maker(self.config['simpleacl.build.module'], self.config['simpleacl.build.class'])
-        acl_builder = acl_builder()
-        acl = acl_builder()
-        environ['simpleacl'] = acl
-        return self.app(environ, start_response)
-
-
-class AclMiddlewareException(Exception):
-    def __init__(self, value):
-        self.value = value
-
-    def __str__(self):
-        return repr(self.value)
+#######################################################################
+# Simpleacl Middleware - A small access control list
+# Copyright (C) 2010  Kyle Terry <kyle@fiverlabs.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#######################################################################
+import logging
+import os
+import threading
+import time
+
+from simpleacl.generation import SharedGeneration
+
+logger = logging.getLogger(__name__)
+
+TRUE = ('true', 'yes', 'on', '1')
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+def class_maker(name, classname):
+    """
+    This will dynamically make a class object from a
+    dynamically imported module. This is so a user
+    can call the class whatever they want.
+    """
+    mod = __import__(name)
+    comps = name.split('.')
+    for comp in comps[1:]:
+        mod = getattr(mod, comp)
+    _class = getattr(mod, classname)
+    return _class
+
+class AclMiddleware(object):
+    """Puts the ACL into environ['simpleacl'].
+
+    The builder class (simpleacl.build.module and simpleacl.build.class
+    in config) is resolved and called once, and all requests share the
+    built ACL; the active role is bound per thread, see Acl.active_role.
+
+    environ['simpleacl'] is a LazyAcl proxy, so requests which never
+    touch it do not pay for it. With simpleacl.build.lazy set the ACL is
+    built by the first request which needs it.
+
+    If simpleacl.reload.interval is set, the policy version is checked
+    at most once per that many seconds, and when it has changed the ACL
+    is rebuilt in a background thread and swapped in. The version is the
+    mtime of simpleacl.reload.path, or the result of the builder's
+    get_version() method.
+
+    If simpleacl.reload.generation is set to a path, the version is the
+    SharedGeneration counter in that file instead. It is checked by
+    every request which uses the ACL, as that is one read of shared
+    memory, so all workers rebuild as soon as the counter is bumped.
+    """
+
+    def __init__(self, app, config):
+        self.app = app
+        self.config = config
+        try:
+            self.builder_class = class_maker(
+                config['simpleacl.build.module'],
+                config['simpleacl.build.class']
+            )
+        except KeyError as e:
+            raise AclMiddlewareException(
+                'Missing configuration option: {0}'.format(e.args[0])
+            )
+        self.builder = self.builder_class()
+        self.reload_interval = float(
+            config.get('simpleacl.reload.interval') or 0
+        )
+        self.reload_path = config.get('simpleacl.reload.path')
+        self.generation = None
+        if config.get('simpleacl.reload.generation'):
+            self.generation = SharedGeneration(
+                config['simpleacl.reload.generation']
+            )
+        self._lock = threading.Lock()
+        self._reload_thread = None
+        self._failed = None
+        self._checked_at = clock()
+        self._version = self.get_version()
+        self.acl = None
+        if str(config.get('simpleacl.build.lazy')).lower() not in TRUE:
+            self.acl = self.builder()
+
+    def __call__(self, environ, start_response):
+        environ['simpleacl'] = LazyAcl(self.get_acl)
+        return self.app(environ, start_response)
+
+    def get_acl(self):
+        """Returns the shared ACL prepared for the current request"""
+        if self.generation is not None:
+            version = self.generation.get()
+            # Unlocked, so failed versions and reloads in flight cost
+            # requests nothing
+            if version != self._version and version != self._failed and \
+                    self._reload_thread is None:
+                self.check_generation()
+        elif self.reload_interval:
+            self.check_version()
+        acl = self.acl
+        if acl is None:
+            with self._lock:
+                if self.acl is None:
+                    self.acl = self.builder()
+            acl = self.acl
+        acl.clear_active_role()  # Threads are reused between requests
+        return acl
+
+    def get_version(self):
+        """Returns the version of policy source"""
+        if self.generation is not None:
+            return self.generation.get()
+        if self.reload_path:
+            try:
+                return os.stat(self.reload_path).st_mtime
+            except OSError:
+                return None
+        get_version = getattr(self.builder, 'get_version', None)
+        if get_version is not None:
+            return get_version()
+        return None
+
+    def check_version(self):
+        """Starts reload if interval has passed and version has changed"""
+        now = clock()
+        if now - self._checked_at < self.reload_interval:
+            return
+        with self._lock:
+            if now - self._checked_at < self.reload_interval or \
+                    self._reload_thread is not None:
+                return
+            self._checked_at = now
+            version = self.get_version()
+            if version != self._version:
+                self._start_reload(version)
+
+    def check_generation(self):
+        """Starts reload if the shared generation has changed"""
+        with self._lock:
+            version = self.get_version()
+            if version != self._version and version != self._failed and \
+                    self._reload_thread is None:
+                self._start_reload(version)
+
+    def _start_reload(self, version):
+        self._reload_thread = threading.Thread(
+            target=self.reload, args=(version, )
+        )
+        self._reload_thread.daemon = True
+        self._reload_thread.start()
+
+    def reload(self, version=None):
+        """Builds a new ACL and swaps it in"""
+        if version is None:
+            version = self.get_version()
+        try:
+            acl = self.builder()
+        except Exception:
+            logger.exception('Unable to rebuild ACL, keeping the old one.')
+            self._failed = version  # Not retried until the next bump
+        else:
+            self.acl = acl  # Atomic, requests in flight keep the old one
+            self._version = version
+        finally:
+            self._reload_thread = None
+
+
+class LazyAcl(object):
+    """Proxy which gets the ACL on first attribute access.
+
+    Results of is_allowed() and check() are memoized for the lifetime of
+    the proxy, that is for one request. Any change of the policy drops
+    the memo.
+    """
+
+    __slots__ = ('_factory', '_acl', '_memo', '_generation')
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_acl', None)
+        object.__setattr__(self, '_memo', {})
+        object.__setattr__(self, '_generation', None)
+
+    def _get_acl(self):
+        acl = self._acl
+        if acl is None:
+            acl = self._factory()
+            object.__setattr__(self, '_acl', acl)
+        return acl
+
+    def __getattr__(self, name):
+        return getattr(self._get_acl(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_acl(), name, value)
+
+    def is_allowed(self, privilege, context=None, undef=False):
+        """Memoized Acl.is_allowed()"""
+        acl = self._get_acl()
+        return self._memoize(
+            acl, acl._get_decision_key(acl.active_role, privilege, context) +
+            (undef, ),
+            acl.is_allowed, privilege, context, undef
+        )
+
+    def check(self, role, privilege, context=None, undef=False):
+        """Memoized Acl.check()"""
+        acl = self._get_acl()
+        return self._memoize(
+            acl, acl._get_decision_key(role, privilege, context) + (undef, ),
+            acl.check, role, privilege, context, undef
+        )
+
+    def _memoize(self, acl, key, func, *args):
+        generation = acl._generation
+        if generation != self._generation:
+            self._memo.clear()
+            object.__setattr__(self, '_generation', generation)
+        try:
+            return self._memo[key]
+        except KeyError:
+            value = self._memo[key] = func(*args)
+            return value
+
+
+class AclMiddlewareException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
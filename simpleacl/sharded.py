@@ -0,0 +1,323 @@
+from __future__ import absolute_import, unicode_literals
+import threading
+from collections import OrderedDict, namedtuple
+
+from simpleacl import SimpleBackend, ALL_PRIVILEGES, get_context_key
+
+ShardInfo = namedtuple('ShardInfo', ['hits', 'misses', 'evictions',
+                                     'shards', 'rules'])
+
+# Fields of a shard entry
+CONTEXTS = 0  # Contexts whose rules the shard holds
+RULES = 1  # Number of rules loaded or added
+DIRTY = 2  # Changed in memory only, so it can not be reloaded
+
+
+class ShardedBackend(SimpleBackend):
+    """In-memory storage which loads rules by shards on demand.
+
+    Rules are partitioned by shard_key(context), which is the context
+    key by default (see get_context_key()); pass a function which
+    returns a tenant key to load all contexts of a tenant at once.
+    loader(shard) is called on the first lookup in a shard and returns
+    (role name, privilege name, context, allow) rows; the rules of None
+    context are in the '' shard. Rules are kept by context keys, as in
+    SqliteBackend, so a context matches its key, and loaders may return
+    either. Shards are kept in LRU order, and
+    the least recently used ones are dropped when there are more than
+    max_shards of them, or more than max_rules rules in memory.
+
+    Roles and privileges are kept in memory, add them to the ACL as
+    usual. Changes of rules are passed to writer(shard, added, removed),
+    with lists of (role name, privilege name, context key, allow) rows,
+    before they are made in memory; it should store them in the
+    loader's source, an added row replacing the rule of the same role,
+    privilege and context. Without a writer, shards changed by add_rule()
+    and the like stay in memory until invalidate() drops them.
+    iter_rules() yields the rules in memory only, with context keys.
+
+    Use functools.partial(ShardedBackend, loader, ...) as backend_class.
+    """
+
+    max_shards = 1000
+    max_rules = None
+    _parent = None  # Backend of a copy(), see there
+
+    def __init__(self, loader=None, shard_key=None, max_shards=None,
+                 max_rules=None, writer=None):
+        """Constructor."""
+        super(ShardedBackend, self).__init__()
+        self.loader = loader or (lambda shard: ())
+        self.writer = writer
+        self.shard_key = shard_key or get_context_key
+        if max_shards is not None:
+            self.max_shards = max_shards
+        if max_rules is not None:
+            self.max_rules = max_rules
+        self._shards = OrderedDict()  # Shard key to entry, in LRU order
+        self._resident = 0  # Rules in memory
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _load(self, contexts):
+        """Makes sure the shards of contexts are in memory.
+
+        None of them is dropped on the way, so the limits may be exceeded
+        by the shards of one lookup.
+        """
+        with self._lock:
+            if self._parent is not None:
+                # Shards not changed by the copy are read through
+                self._parent._load([
+                    context for context in contexts
+                    if self.shard_key(context) not in self._shards
+                ])
+                return [self.shard_key(context) for context in contexts]
+            shards = []
+            loaded = False
+            for context in contexts:
+                shard = self.shard_key(context)
+                shards.append(shard)
+                entry = self._shards.pop(shard, None)
+                if entry is None:
+                    entry = self._load_shard(shard)
+                    loaded = True
+                else:
+                    self.hits += 1
+                self._shards[shard] = entry  # Mark as most recently used
+            if loaded:
+                self._evict(shards)
+            return shards
+
+    def _load_shard(self, shard):
+        self.misses += 1
+        rules = {}
+        count = 0
+        for role, privilege, context, allow in self.loader(shard):
+            context = self.get_context_key(context)
+            role = self._roles.get(role, role)
+            privilege = self._privileges.get(privilege, privilege)
+            rules.setdefault(context, {}).setdefault(role, {})[privilege] = \
+                bool(allow)
+            count += 1
+        super(ShardedBackend, self).add_rules_bulk(rules)
+        self._resident += count
+        return [set(rules), count, False]
+
+    def _evict(self, keep=()):
+        """Drops least recently used shards while limits are exceeded"""
+        for shard in list(self._shards):
+            if len(self._shards) <= self.max_shards and (
+                    self.max_rules is None or
+                    self._resident <= self.max_rules):
+                break
+            if shard not in keep and not self._shards[shard][DIRTY]:
+                self._drop(shard)
+                self.evictions += 1
+
+    def _drop(self, shard):
+        contexts, count, dirty = self._shards.pop(shard)
+        for context in contexts:
+            self._acl.pop(context, None)
+            self._rindex.pop(context, None)
+        self._resident -= count
+
+    def get_context_key(self, context):
+        """Returns string which identifies context in memory and shards"""
+        return get_context_key(context)
+
+    def _write(self, context, added=None, removed=None):
+        """Passes the changed rules of context to the writer, if any.
+
+        A copy() keeps them until it is committed.
+        """
+        if not added and not removed:
+            return
+        added = added or []
+        removed = removed or []
+        if self._parent is not None:
+            self._writes.append((self.shard_key(context), added, removed))
+        elif self.writer is not None:
+            self.writer(self.shard_key(context), added, removed)
+
+    def _mark_dirty(self, context, count=0):
+        """Records count more rules in the loaded shard of context.
+
+        The shard is changed in memory only unless there is a writer.
+        """
+        with self._lock:
+            shard = self.shard_key(context)
+            if self._parent is not None and shard not in self._shards:
+                # The copy takes the whole shard, so it does not depend on
+                # the original keeping it in memory
+                contexts, rules, dirty = self._parent._shards[shard]
+                for item in contexts:
+                    self._get_rows(item)
+                self._shards[shard] = [set(contexts), rules, True]
+            entry = self._shards[shard]
+            entry[CONTEXTS].add(self.get_context_key(context))
+            entry[RULES] += count
+            self._resident += count
+            if self._parent is None:
+                entry[DIRTY] = entry[DIRTY] or self.writer is None
+
+    def _get_allow(self, role, privilege, context):
+        """Returns allow of the rule in memory, or None"""
+        return self._acl.get(self.get_context_key(context), {}).get(
+            role, {}
+        ).get(privilege)
+
+    def invalidate(self, shard=None):
+        """Drops the shard, or all shards, so they are loaded again"""
+        with self._lock:
+            for key in ([shard] if shard is not None else list(self._shards)):
+                if key in self._shards:
+                    self._drop(key)
+
+    def shard_info(self):
+        """Returns hits/misses/evictions statistics of shards"""
+        return ShardInfo(self.hits, self.misses, self.evictions,
+                         len(self._shards), self._resident)
+
+    def copy(self):
+        """Returns a draft backend, see SimpleBackend.copy().
+
+        The draft shares the lock of this backend, loads shards into it,
+        and keeps the shards it changes only.
+        """
+        with self._lock:
+            other = super(ShardedBackend, self).copy()
+            other._parent = self
+            other._shards = OrderedDict()
+            other._resident = 0
+            other._writes = []
+            return other
+
+    def commit(self, draft):
+        """Applies the changes of draft, a copy() of this backend"""
+        with self._lock:
+            if self.writer is not None:
+                for shard, added, removed in draft._writes:
+                    self.writer(shard, added, removed)
+            super(ShardedBackend, self).commit(draft)
+            for shard, entry in draft._shards.items():
+                previous = self._shards.pop(shard, None)
+                if previous is not None:
+                    self._resident -= previous[RULES]
+                    entry[DIRTY] = previous[DIRTY]
+                else:
+                    entry[DIRTY] = False
+                entry[DIRTY] = entry[DIRTY] or self.writer is None
+                self._resident += entry[RULES]
+                self._shards[shard] = entry
+            self._evict()
+            return self
+
+    def add_rule(self, role, privilege=ALL_PRIVILEGES,
+                 context=None, allow=True):
+        """Adds rule to the ACL"""
+        with self._lock:
+            self._load([context])
+            new = self._get_allow(role, privilege, context) is None
+            self._write(context, added=[(role.get_name(),
+                                         privilege.get_name(),
+                                         self.get_context_key(context),
+                                         bool(allow))])
+            self._mark_dirty(context, int(new))
+            super(ShardedBackend, self).add_rule(
+                role, privilege, self.get_context_key(context), allow
+            )
+            self._evict([self.shard_key(context)])
+            return self
+
+    def remove_rule(self, role, privilege=ALL_PRIVILEGES,
+                    context=None, allow=True):
+        """Removes rule from ACL"""
+        with self._lock:
+            self._load([context])
+            if self._get_allow(role, privilege, context) != allow:
+                return self  # There is no such rule
+            self._write(context, removed=[(role.get_name(),
+                                           privilege.get_name(),
+                                           self.get_context_key(context),
+                                           bool(allow))])
+            self._mark_dirty(context, -1)
+            return super(ShardedBackend, self).remove_rule(
+                role, privilege, self.get_context_key(context), allow
+            )
+
+    def add_rules_bulk(self, rules):
+        """Adds many rules given as {context: {role: {privilege: allow}}}"""
+        with self._lock:
+            keyed = {}
+            self._load(list(rules))  # None of them is dropped on the way
+            for context, roles in rules.items():
+                key = self.get_context_key(context)
+                rows = [(role.get_name(), privilege.get_name(), key,
+                         bool(allow))
+                        for role, privileges in roles.items()
+                        for privilege, allow in privileges.items()]
+                self._write(context, added=rows)
+                merged = keyed.setdefault(key, {})
+                self._mark_dirty(context, sum(
+                    1 for role, privileges in roles.items()
+                    for privilege in privileges
+                    if self._get_allow(role, privilege, context) is None and
+                    privilege not in merged.get(role, ())
+                ))
+                for role, privileges in roles.items():
+                    merged.setdefault(role, {}).update(privileges)
+            super(ShardedBackend, self).add_rules_bulk(keyed)
+            self._evict([self.shard_key(context) for context in rules])
+            return self
+
+    def find_rule(self, roles, privileges, contexts):
+        """Returns the first rule of given keys, see SimpleBackend"""
+        with self._lock:
+            self._load(contexts)
+            return super(ShardedBackend, self).find_rule(
+                roles, privileges,
+                [self.get_context_key(context) for context in contexts]
+            )
+
+    def get_rules(self, role, context=None):
+        """Returns {privilege: allow} of rules of role in context"""
+        with self._lock:
+            self._load([context])
+            return dict(super(ShardedBackend, self).get_rules(
+                role, self.get_context_key(context)
+            ))
+
+    def get_roles_with_rule(self, privilege, context=None):
+        """Returns {role: allow} of rules for privilege in context"""
+        with self._lock:
+            self._load([context])
+            return dict(super(ShardedBackend, self).get_roles_with_rule(
+                privilege, self.get_context_key(context)
+            ))
+
+    def role_has_privilege(self, role, privilege, context=None, allow=True):
+        """Returns True if there is such a rule"""
+        with self._lock:
+            self._load([context])
+            return super(ShardedBackend, self).role_has_privilege(
+                role, privilege, self.get_context_key(context), allow
+            )
+
+    def is_allowed(self, role, privilege, context=None, undef=None):
+        """Returns True if active role is allowed
+
+        for given privilege in given given context
+        """
+        with self._lock:
+            self._load([context])
+            return super(ShardedBackend, self).is_allowed(
+                role, privilege, self.get_context_key(context), undef
+            )
+
+    def is_allowed_many(self, keys, undef=None):
+        """Returns is_allowed() for each (role, privilege, context) key"""
+        return [self.is_allowed(role, privilege, context, undef)
+                for role, privilege, context in keys]
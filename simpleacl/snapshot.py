@@ -0,0 +1,430 @@
+"""Compiled read-only ACL image.
+
+An image is written once by Acl.compile_snapshot() and mapped read-only
+by SnapshotBackend, so pre-fork workers share its pages and start with
+no parsing. All integers are little-endian. After the header follow,
+each padded to 8 bytes:
+
+    role names, privilege names, context keys:
+        (n + 1) uint32 offsets, UTF-8 blob; sorted by encoded name
+    role parents:       (roles + 1) uint32 offsets, uint32 role ids
+    dotted parents:     roles uint32 role ids, NONE if there is none
+    role ancestors:     (roles + 1) uint32 offsets, uint32 role ids
+    rules:              sorted uint64 keys, see pack_rule()
+"""
+from __future__ import absolute_import, unicode_literals
+import mmap
+import os
+import struct
+import sys
+from bisect import bisect_left
+
+from simpleacl import Acl, SimpleBackend, get_context_key
+from simpleacl.exceptions import MissingRole, MissingPrivilege,\
+    ReadOnlyBackend
+
+MAGIC = b'SACL'
+VERSION = 1
+HEADER = struct.Struct('<4s10I')
+NONE = 0xFFFFFFFF
+
+
+def pack_rule(context_id, role_id, privilege_id, allow,
+              roles_count, privileges_count):
+    """Packs rule into an integer, ordered by context, role, privilege"""
+    key = (context_id * roles_count + role_id) * privileges_count + \
+        privilege_id
+    return key * 2 + int(bool(allow))
+
+
+def _pad(data):
+    return data + b'\0' * (-len(data) % 8)
+
+
+def _names_section(names):
+    offsets = [0]
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+    return (struct.pack('<%dI' % len(offsets), *offsets),
+            b''.join(names))
+
+
+def _lists_section(lists):
+    offsets = [0]
+    items = []
+    for ids in lists:
+        items.extend(ids)
+        offsets.append(len(items))
+    return (struct.pack('<%dI' % len(offsets), *offsets),
+            struct.pack('<%dI' % len(items), *items))
+
+
+def write_snapshot(acl, path):
+    """Writes compiled image of acl into path"""
+    backend = acl._backend
+    roles = sorted(name.encode('utf-8') for name in backend.get_role_names())
+    privileges = sorted(
+        name.encode('utf-8') for name in backend.get_privilege_names()
+    )
+    role_ids = dict((name.decode('utf-8'), i) for i, name in enumerate(roles))
+    privilege_ids = dict(
+        (name.decode('utf-8'), i) for i, name in enumerate(privileges)
+    )
+
+    rules = []
+    contexts = set()
+    for role, privilege, context, allow in backend.iter_rules():
+        context = get_context_key(context).encode('utf-8')
+        contexts.add(context)
+        rules.append((context, role.get_name(), privilege.get_name(), allow))
+    contexts = sorted(contexts)
+    context_ids = dict((name, i) for i, name in enumerate(contexts))
+    if len(contexts) * len(roles) * len(privileges) * 2 >= 1 << 64:
+        raise ValueError('The policy is too large for snapshot.')
+    keys = sorted(
+        pack_rule(context_ids[context], role_ids[role],
+                  privilege_ids[privilege], allow,
+                  len(roles), len(privileges))
+        for context, role, privilege, allow in rules
+    )
+
+    parents = []
+    dotted = []
+    ancestors = []
+    for name in roles:
+        role = acl.get_role(name.decode('utf-8'))
+        parents.append([role_ids[parent.get_name()]
+                        for parent in role.get_parents()])
+        dotted.append(NONE if role._dotted_parent is None else
+                      role_ids[role._dotted_parent.get_name()])
+        ancestors.append([role_ids[ancestor.get_name()]
+                          for ancestor in role.get_ancestors()])
+
+    sections = []
+    sections.extend(_names_section(roles))
+    sections.extend(_names_section(privileges))
+    sections.extend(_names_section(contexts))
+    sections.extend(_lists_section(parents))
+    sections.append(struct.pack('<%dI' % len(dotted), *dotted))
+    sections.extend(_lists_section(ancestors))
+    sections.append(struct.pack('<%dQ' % len(keys), *keys))
+
+    header = HEADER.pack(
+        MAGIC, VERSION, len(roles), len(privileges), len(contexts), len(keys),
+        sum(len(ids) for ids in parents), sum(len(ids) for ids in ancestors),
+        len(sections[1]), len(sections[3]), len(sections[5])
+    )
+    # Workers which mapped the old image keep using it until they reopen
+    temp = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(_pad(header))
+        for section in sections:
+            f.write(_pad(section))
+    getattr(os, 'replace', os.rename)(temp, path)
+
+
+class _Names(object):
+    """Sorted string table in the image"""
+
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        return bytes(
+            self._blob[self._offsets[index]:self._offsets[index + 1]]
+        )
+
+    def index(self, name):
+        """Returns the id of name, or -1"""
+        name = name.encode('utf-8')
+        i = bisect_left(self, name)
+        if i < len(self) and self[i] == name:
+            return i
+        return -1
+
+
+class _Lists(object):
+    """Lists of ids in the image"""
+
+    def __init__(self, offsets, items):
+        self._offsets = offsets
+        self._items = items
+
+    def __getitem__(self, index):
+        return self._items[self._offsets[index]:self._offsets[index + 1]]
+
+
+class _Table(object):
+    """Integers in the image, read as they are indexed.
+
+    Stands in for memoryview.cast(), which Python 2 does not have.
+    """
+
+    def __init__(self, data, start, size, format):
+        self._data = data
+        self._start = start
+        self._struct = struct.Struct('<' + format)
+        self._len = size // self._struct.size
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._len))]
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError(index)
+        return self._struct.unpack_from(
+            self._data, self._start + index * self._struct.size
+        )[0]
+
+
+class SnapshotBackend(SimpleBackend):
+    """Read-only storage which answers from a memory-mapped image.
+
+    Role and privilege instances are created on first use only. Use
+    functools.partial(SnapshotBackend, path) as backend_class of Acl, or
+    load_snapshot(path).
+    """
+
+    context_cache_size = 100000
+
+    def __init__(self, path):
+        """Constructor."""
+        super(SnapshotBackend, self).__init__()
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self._mmap
+        header = HEADER.unpack_from(data)
+        if header[0] != MAGIC or header[1] != VERSION:
+            raise ValueError('Not a simpleacl snapshot: {0}'.format(path))
+        if sys.byteorder != 'little':  # Tables are read in native order
+            raise ValueError('Snapshots require a little-endian host.')
+        (roles, privileges, contexts, rules, parents, ancestors,
+         role_blob, privilege_blob, context_blob) = header[2:]
+        self._counts = (roles, privileges)
+        position = [HEADER.size + (-HEADER.size % 8)]
+
+        def section(size, format=None):
+            start = position[0]
+            position[0] = start + size + (-size % 8)
+            if not hasattr(memoryview, 'cast'):  # Python 2.* compatible
+                if format is not None:
+                    return _Table(data, start, size, format)
+                return buffer(data, start, size)
+            view = memoryview(data)[start:start + size]
+            if format is not None:
+                view = view.cast(format)
+            return view
+
+        self._role_names = _Names(section(4 * (roles + 1), 'I'),
+                                  section(role_blob))
+        self._privilege_names = _Names(section(4 * (privileges + 1), 'I'),
+                                       section(privilege_blob))
+        self._context_names = _Names(section(4 * (contexts + 1), 'I'),
+                                     section(context_blob))
+        self._parents = _Lists(section(4 * (roles + 1), 'I'),
+                               section(4 * parents, 'I'))
+        self._dotted = section(4 * roles, 'I')
+        self._ancestors = _Lists(section(4 * (roles + 1), 'I'),
+                                 section(4 * ancestors, 'I'))
+        self._rules = section(8 * rules, 'Q')
+        self._role_ids = {}
+        self._privilege_ids = {}
+        self._context_ids = {}
+        self._by_id = {}
+
+    def add_role(self, role, parents=None):
+        """Adds role, which must be in the image already"""
+        self.get_role(role.get_name())
+        return self
+
+    def add_privilege(self, privilege):
+        """Adds privilege, which must be in the image already"""
+        self.get_privilege(privilege.get_name())
+        return self
+
+    def add_rule(self, role, privilege=None, context=None, allow=True):
+        raise ReadOnlyBackend('Snapshot can not be changed.')
+
+    remove_rule = add_rule
+
+    def set_role_parents(self, role, parents):
+        raise ReadOnlyBackend('Snapshot can not be changed.')
+
+    def get_role(self, role_name):
+        """Returns a role instance"""
+        try:
+            return self._roles[role_name]
+        except KeyError:
+            pass
+        role_id = self._role_names.index(role_name)
+        if role_id < 0:
+            raise MissingRole(
+                'Role must be added before requested.'
+            )
+        return self._get_role_by_id(role_id)
+
+    def _get_role_by_id(self, role_id):
+        try:
+            return self._by_id[role_id]
+        except KeyError:
+            pass
+        name = self._role_names[role_id].decode('utf-8')
+        role = self._by_id[role_id] = self._roles[name] = self.role_class(name)
+        self._role_ids[name] = role_id
+        role._parents = [self._get_role_by_id(parent_id)
+                         for parent_id in self._parents[role_id]]
+        if self._dotted[role_id] != NONE:
+            role._dotted_parent = self._get_role_by_id(self._dotted[role_id])
+        role._ancestors = tuple(self._get_role_by_id(ancestor_id)
+                                for ancestor_id in self._ancestors[role_id])
+        return role
+
+    def get_privilege(self, privilege_name):
+        """Returns a privilege instance"""
+        try:
+            return self._privileges[privilege_name]
+        except KeyError:
+            pass
+        privilege_id = self._privilege_names.index(privilege_name)
+        if privilege_id < 0:
+            raise MissingPrivilege(
+                'Privilege must be added before requested.'
+            )
+        self._privilege_ids[privilege_name] = privilege_id
+        return self._privileges.setdefault(
+            privilege_name, self.privilege_class(privilege_name)
+        )
+
+    def get_role_names(self):
+        """Returns names of all roles"""
+        return [self._role_names[i].decode('utf-8')
+                for i in range(len(self._role_names))]
+
+    def get_privilege_names(self):
+        """Returns names of all privileges"""
+        return [self._privilege_names[i].decode('utf-8')
+                for i in range(len(self._privilege_names))]
+
+    def iter_rules(self):
+        """Yields (role, privilege, context, allow) for all rules.
+
+        Contexts are given by their keys, see get_context_key().
+        """
+        roles, privileges = self._counts
+        for key in self._rules:
+            key, allow = divmod(key, 2)
+            key, privilege_id = divmod(key, privileges)
+            context_id, role_id = divmod(key, roles)
+            yield (
+                self._get_role_by_id(role_id),
+                self.get_privilege(
+                    self._privilege_names[privilege_id].decode('utf-8')
+                ),
+                self._context_names[context_id].decode('utf-8'),
+                bool(allow)
+            )
+
+    def get_rules(self, role, context=None):
+        """Returns {privilege name: allow} of rules of role in context"""
+        context_id = self._get_context_id(context)
+        role_id = self._role_ids.get(role.name)
+        if context_id < 0 or role_id is None:
+            return {}
+        roles, privileges = self._counts
+        start = pack_rule(context_id, role_id, 0, False, roles, privileges)
+        stop = start + 2 * privileges
+        rules = self._rules
+        result = {}
+        for i in range(bisect_left(rules, start), len(rules)):
+            key = rules[i]
+            if key >= stop:
+                break
+            privilege_id, allow = divmod(key - start, 2)
+            name = self._privilege_names[privilege_id].decode('utf-8')
+            result[name] = bool(allow)
+        return result
+
+    get_roles_with_rule = None  # There is no reverse index in the image
+
+    def _get_context_id(self, context):
+        key = get_context_key(context)
+        try:
+            return self._context_ids[key]
+        except KeyError:
+            pass
+        if len(self._context_ids) >= self.context_cache_size:
+            self._context_ids = {}
+        context_id = self._context_ids[key] = self._context_names.index(key)
+        return context_id
+
+    def is_allowed(self, role, privilege, context=None, undef=None):
+        """Returns True if active role is allowed
+
+        for given privilege in given given context
+        """
+        context_id = self._get_context_id(context)
+        if context_id < 0:
+            return undef
+        try:
+            role_id = self._role_ids[role.name]
+            privilege_id = self._privilege_ids[privilege.name]
+        except KeyError:
+            return undef
+        key = pack_rule(context_id, role_id, privilege_id, False,
+                        *self._counts)
+        rules = self._rules
+        i = bisect_left(rules, key)
+        if i < len(rules) and rules[i] >> 1 == key >> 1:
+            return bool(rules[i] & 1)
+        return undef
+
+    def find_rule(self, roles, privileges, contexts):
+        """Returns the first rule of given keys, or None if there is none.
+
+        See SimpleBackend.find_rule(). Contexts, roles and privileges
+        which are not in the image are skipped without a search.
+        """
+        context_ids = [context_id for context_id in
+                       map(self._get_context_id, contexts) if context_id >= 0]
+        privilege_ids = [self._privilege_ids[privilege.name]
+                         for privilege in privileges
+                         if privilege.name in self._privilege_ids]
+        if not context_ids or not privilege_ids:
+            return None
+        rules = self._rules
+        size = len(rules)
+        for role in roles:
+            role_id = self._role_ids.get(role.name)
+            if role_id is None:
+                continue
+            for context_id in context_ids:
+                for privilege_id in privilege_ids:
+                    key = pack_rule(context_id, role_id, privilege_id, False,
+                                    *self._counts)
+                    i = bisect_left(rules, key)
+                    if i < size and rules[i] >> 1 == key >> 1:
+                        return bool(rules[i] & 1)
+        return None
+
+    def role_has_privilege(self, role, privilege, context=None, allow=True):
+        """Returns True if there is such rule"""
+        return self.is_allowed(role, privilege, context) == allow
+
+    def is_allowed_many(self, keys, undef=None):
+        """Returns is_allowed() for each (role, privilege, context) key"""
+        return [self.is_allowed(role, privilege, context, undef)
+                for role, privilege, context in keys]
+
+
+def load_snapshot(path, acl_class=Acl):
+    """Returns ACL which answers from the image in path"""
+    return acl_class(backend_class=lambda: SnapshotBackend(path))
@@ -0,0 +1,378 @@
+from __future__ import absolute_import, unicode_literals
+import itertools
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+from operator import itemgetter
+
+from simpleacl import SimpleBackend, ALL_PRIVILEGES, get_context_key
+from simpleacl.exceptions import MissingRole, MissingPrivilege
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS simpleacl_role ('
+    ' name TEXT PRIMARY KEY'
+    ') WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS simpleacl_role_parent ('
+    ' role TEXT NOT NULL, position INTEGER NOT NULL, parent TEXT NOT NULL,'
+    ' PRIMARY KEY (role, position)'
+    ') WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS simpleacl_privilege ('
+    ' name TEXT PRIMARY KEY'
+    ') WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS simpleacl_rule ('
+    ' context TEXT NOT NULL, role TEXT NOT NULL, privilege TEXT NOT NULL,'
+    ' allow INTEGER NOT NULL,'
+    ' PRIMARY KEY (context, role, privilege)'
+    ') WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS simpleacl_rule_privilege'
+    ' ON simpleacl_rule (context, privilege, role)',
+)
+
+INSERT_ROLE = 'INSERT OR IGNORE INTO simpleacl_role (name) VALUES (?)'
+SELECT_ROLE = 'SELECT name FROM simpleacl_role WHERE name = ?'
+DELETE_ROLE_PARENTS = 'DELETE FROM simpleacl_role_parent WHERE role = ?'
+INSERT_ROLE_PARENT = ('INSERT INTO simpleacl_role_parent (role, position,'
+                      ' parent) VALUES (?, ?, ?)')
+SELECT_ROLE_PARENTS = ('SELECT parent FROM simpleacl_role_parent'
+                       ' WHERE role = ? ORDER BY position')
+INSERT_PRIVILEGE = 'INSERT OR IGNORE INTO simpleacl_privilege (name) VALUES (?)'
+SELECT_PRIVILEGE = 'SELECT name FROM simpleacl_privilege WHERE name = ?'
+INSERT_RULE = ('INSERT OR REPLACE INTO simpleacl_rule (context, role,'
+               ' privilege, allow) VALUES (?, ?, ?, ?)')
+DELETE_RULE = ('DELETE FROM simpleacl_rule WHERE context = ? AND role = ?'
+               ' AND privilege = ? AND allow = ?')
+SELECT_RULE = ('SELECT allow FROM simpleacl_rule WHERE context = ?'
+               ' AND role = ? AND privilege = ?')
+SELECT_ROLE_RULES = ('SELECT privilege, allow FROM simpleacl_rule'
+                     ' WHERE context = ? AND role = ?')
+SELECT_ROLE_NAMES = 'SELECT name FROM simpleacl_role'
+SELECT_PRIVILEGE_NAMES = 'SELECT name FROM simpleacl_privilege'
+SELECT_ALL_RULES = ('SELECT context, role, privilege, allow'
+                    ' FROM simpleacl_rule')
+SELECT_RULES = ('SELECT context, role, privilege, allow FROM simpleacl_rule'
+                ' WHERE (context, role, privilege) IN (VALUES {0})')
+
+MAX_KEYS_PER_QUERY = 300  # SQLite allows 999 parameters by default
+
+URIS = sys.version_info >= (3, 4)  # sqlite3.connect() accepts uri=True
+
+_counter = itertools.count()
+
+
+class SqliteBackend(SimpleBackend):
+    """A persistent storage in SQLite database.
+
+    Every thread uses its own connection. Role and privilege instances
+    are loaded on demand and kept in memory, rules stay in the database
+    and lookups are cached in process until this backend changes them.
+    Changes made by other processes are seen after clear_cache().
+
+    Use functools.partial(SqliteBackend, path) as backend_class of Acl.
+    Without path a private in-memory database is used. The ':memory:'
+    database (and the private one on Python < 3.4, which can not share
+    in-memory databases) has a single connection, and threads take
+    turns using it.
+    """
+
+    cache_size = 100000
+
+    def __init__(self, path=None, cache_size=None):
+        """Constructor."""
+        super(SqliteBackend, self).__init__()
+        if path is None and URIS:
+            path = 'file:simpleacl-{0}-{1}?mode=memory&cache=shared'.format(
+                os.getpid(), next(_counter)
+            )
+        elif path is None:
+            path = ':memory:'
+        self.path = path
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self._cache = {}
+        self._writes = 0  # Committed writes, see _remember()
+        self._lock = threading.RLock()
+        self._serialized = path == ':memory:'  # Threads share _master
+        self._local = threading.local()
+        # Keeps in-memory database alive, and creates the schema
+        self._master = self._connect()
+        with self._master:
+            for sql in SCHEMA:
+                self._master.execute(sql)
+
+    def _connect(self):
+        if URIS:
+            connection = sqlite3.connect(
+                self.path, uri=self.path.startswith('file:'),
+                check_same_thread=False
+            )
+        else:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+        if self.path != ':memory:' and 'mode=memory' not in self.path:
+            connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def _connection(self):
+        """Returns the connection of current thread"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self.path == ':memory:':
+                connection = self._master
+            else:
+                connection = self._connect()
+            self._local.connection = connection
+        return connection
+
+    def _execute(self, sql, params=()):
+        """Runs a query and returns all rows"""
+        connection = self._connection()
+        if not self._serialized:
+            return connection.execute(sql, params).fetchall()
+        with self._lock:
+            return connection.execute(sql, params).fetchall()
+
+    def _commit(self, statements):
+        """Runs (sql, params) writes in one transaction"""
+        connection = self._connection()
+        if self._serialized:
+            self._lock.acquire()
+        try:
+            with connection:
+                for sql, group in itertools.groupby(statements,
+                                                    key=itemgetter(0)):
+                    connection.executemany(sql, [item[1] for item in group])
+        finally:
+            if self._serialized:
+                self._lock.release()
+
+    def _write(self, sql, params):
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None:
+            pending.append((sql, params))
+            return
+        self._commit([(sql, params)])
+
+    @contextmanager
+    def batch(self):
+        """Collects writes and runs them in one transaction on exit.
+
+        Reads within the block do not see the pending writes.
+        """
+        if getattr(self._local, 'pending', None) is not None:
+            yield self  # Nested batch
+            return
+        self._local.pending = pending = []
+        try:
+            yield self
+        finally:
+            self._local.pending = None
+        self._commit(pending)
+        self.clear_cache()
+
+    def clear_cache(self):
+        """Drops cached lookups"""
+        self._forget()
+
+    def _forget(self, keys=None):
+        """Drops cached lookups of keys, or all of them, after a write"""
+        with self._lock:
+            self._writes += 1
+            if keys is None:
+                self._cache = {}
+            else:
+                for key in keys:
+                    self._cache.pop(key, None)
+
+    def _remember(self, key, allow, writes):
+        """Caches a lookup made when there were given committed writes"""
+        with self._lock:
+            if writes != self._writes:
+                return  # A write may have committed during the lookup
+            if len(self._cache) >= self.cache_size:
+                self._cache = {}
+            self._cache[key] = allow
+
+    def get_context_key(self, context):
+        """Returns string which identifies context in the database"""
+        return get_context_key(context)
+
+    def add_role(self, role, parents=None):
+        """Adds role"""
+        self._roles.setdefault(role.get_name(), role)
+        self._write(INSERT_ROLE, (role.get_name(), ))
+        return self
+
+    def get_role(self, role_name):
+        """Returns a role instance"""
+        try:
+            return self._roles[role_name]
+        except KeyError:
+            pass
+        if not self._execute(SELECT_ROLE, (role_name, )):
+            raise MissingRole(
+                'Role must be added before requested.'
+            )
+        return self._roles.setdefault(role_name, self.role_class(role_name))
+
+    def get_role_parents(self, role_name):
+        """Returns names of stored parents of role"""
+        rows = self._execute(SELECT_ROLE_PARENTS, (role_name, ))
+        return [row[0] for row in rows]
+
+    def set_role_parents(self, role, parents):
+        """Stores parents of role"""
+        name = role.get_name()
+        with self.batch():
+            self._write(DELETE_ROLE_PARENTS, (name, ))
+            for position, parent in enumerate(parents):
+                self._write(INSERT_ROLE_PARENT,
+                            (name, position, parent.get_name()))
+        return self
+
+    def add_privilege(self, privilege):
+        """Adds privilege"""
+        self._privileges.setdefault(privilege.get_name(), privilege)
+        self._write(INSERT_PRIVILEGE, (privilege.get_name(), ))
+        return self
+
+    def get_privilege(self, privilege_name):
+        """Returns a privilege instance"""
+        try:
+            return self._privileges[privilege_name]
+        except KeyError:
+            pass
+        if not self._execute(SELECT_PRIVILEGE, (privilege_name, )):
+            raise MissingPrivilege(
+                'Privilege must be added before requested.'
+            )
+        return self._privileges.setdefault(
+            privilege_name, self.privilege_class(privilege_name)
+        )
+
+    def get_role_names(self):
+        """Returns names of all roles"""
+        return [row[0] for row in self._execute(SELECT_ROLE_NAMES)]
+
+    def get_privilege_names(self):
+        """Returns names of all privileges"""
+        return [row[0] for row in self._execute(SELECT_PRIVILEGE_NAMES)]
+
+    def iter_rules(self):
+        """Yields (role, privilege, context, allow) for all rules.
+
+        Contexts are given by their keys, see get_context_key().
+        """
+        for context, role, privilege, allow in self._execute(
+                SELECT_ALL_RULES):
+            yield (self.get_role(role), self.get_privilege(privilege),
+                   context, bool(allow))
+
+    def get_rules(self, role, context=None):
+        """Returns {privilege name: allow} of rules of role in context"""
+        rows = self._execute(
+            SELECT_ROLE_RULES, (self.get_context_key(context), role.name)
+        )
+        return dict((privilege, bool(allow)) for privilege, allow in rows)
+
+    copy = None  # Acl.edit() uses batch(), see there
+
+    # Rules are not in memory, so checks go through the lookup cache,
+    # and batches through is_allowed_many()
+    find_rule = None
+
+    # Children of roles which are not loaded yet are unknown, so
+    # Acl.roles_with_privilege() checks all roles
+    get_roles_with_rule = None
+
+    def _get_key(self, role, privilege, context):
+        return (self.get_context_key(context), role.name, privilege.name)
+
+    def add_rule(self, role, privilege=ALL_PRIVILEGES,
+                 context=None, allow=True):
+        """Adds rule to the ACL"""
+        key = self._get_key(role, privilege, context)
+        self._write(INSERT_RULE, key + (int(bool(allow)), ))
+        self._forget([key])
+        return self
+
+    def add_rules_bulk(self, rules):
+        """Adds many rules given as {context: {role: {privilege: allow}}}
+
+        All rules are written by one executemany() in one transaction.
+        """
+        params = [
+            (self.get_context_key(context), role.name, privilege.name,
+             int(bool(allow)))
+            for context, roles in rules.items()
+            for role, privileges in roles.items()
+            for privilege, allow in privileges.items()
+        ]
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None:
+            pending.extend((INSERT_RULE, item) for item in params)
+            return self
+        self._commit([(INSERT_RULE, item) for item in params])
+        self.clear_cache()
+        return self
+
+    def remove_rule(self, role, privilege=ALL_PRIVILEGES,
+                    context=None, allow=True):
+        """Removes rule from ACL"""
+        key = self._get_key(role, privilege, context)
+        self._write(DELETE_RULE, key + (int(bool(allow)), ))
+        self._forget([key])
+        return self
+
+    def role_has_privilege(self, role, privilege, context=None, allow=True):
+        """Returns True if there is such rule"""
+        return self.is_allowed(role, privilege, context) == allow
+
+    def is_allowed(self, role, privilege, context=None, undef=None):
+        """Returns True if active role is allowed
+
+        for given privilege in given given context
+        """
+        key = self._get_key(role, privilege, context)
+        try:
+            allow = self._cache[key]
+        except KeyError:
+            writes = self._writes
+            rows = self._execute(SELECT_RULE, key)
+            allow = bool(rows[0][0]) if rows else None
+            self._remember(key, allow, writes)
+        if allow is None:
+            return undef
+        return allow
+
+    def is_allowed_many(self, keys, undef=None):
+        """Returns is_allowed() for each (role, privilege, context) key.
+
+        All keys missing in cache are fetched by a few queries.
+        """
+        keys = [self._get_key(role, privilege, context)
+                for role, privilege, context in keys]
+        cache = self._cache
+        answers = {}
+        missing = []
+        for key in set(keys):
+            try:
+                answers[key] = cache[key]
+            except KeyError:
+                missing.append(key)
+        writes = self._writes
+        for start in range(0, len(missing), MAX_KEYS_PER_QUERY):
+            chunk = missing[start:start + MAX_KEYS_PER_QUERY]
+            found = dict.fromkeys(chunk)
+            sql = SELECT_RULES.format(', '.join(['(?, ?, ?)'] * len(chunk)))
+            params = [value for key in chunk for value in key]
+            for context, role, privilege, allow in self._execute(sql, params):
+                found[(context, role, privilege)] = bool(allow)
+            for key, allow in found.items():
+                self._remember(key, allow, writes)
+            answers.update(found)
+        result = []
+        for key in keys:
+            allow = answers[key]
+            result.append(undef if allow is None else allow)
+        return result
@@ -0,0 +1,183 @@
+from __future__ import absolute_import, unicode_literals
+import codecs
+import time
+
+try:
+    from simplejson import JSONDecoder
+except ImportError:
+    from json import JSONDecoder
+
+CHUNK_SIZE = 65536
+WHITESPACE = ' \t\n\r'
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class LoadStats(object):
+    """Progress of a streaming load"""
+
+    def __init__(self):
+        self.roles = 0
+        self.privileges = 0
+        self.rules = 0
+        self.bytes = 0
+        self.started = clock()
+        self.elapsed = 0.0
+        self.finished = False
+
+    @property
+    def rows(self):
+        return self.roles + self.privileges + self.rules
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return ('<LoadStats {0.roles} roles, {0.privileges} privileges, '
+                '{0.rules} rules, {0.bytes} bytes in {0.elapsed:.2f}s>'
+                .format(self))
+
+
+def iter_chunks(source, stats=None):
+    """Yields text chunks of a file object or an iterable of chunks"""
+    if hasattr(source, 'read'):
+        read = source.read
+        source = iter(lambda: read(CHUNK_SIZE), read(0))
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in source:
+        if stats is not None:
+            stats.bytes += len(chunk)
+        if isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        if chunk:
+            yield chunk
+    chunk = decoder.decode(b'', True)
+    if chunk:
+        yield chunk
+
+
+class _Reader(object):
+    """Incremental reader of one JSON document"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = ''
+        self._pos = 0
+        self._exhausted = False
+        self._decoder = JSONDecoder()
+
+    def _fill(self):
+        if self._exhausted:
+            return False
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._exhausted = True
+            return False
+        # Drop consumed data, so memory stays bounded by the chunk size
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """Returns the next non-whitespace character, or ''"""
+        while True:
+            buffer, pos = self._buffer, self._pos
+            while pos < len(buffer) and buffer[pos] in WHITESPACE:
+                pos += 1
+            self._pos = pos
+            if pos < len(buffer):
+                return buffer[pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected {0!r} at {1!r}'.format(
+                chars, self._buffer[self._pos:self._pos + 20]
+            ))
+        self._pos += 1
+        return char
+
+    def value(self):
+        """Returns the next complete JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # A number may continue in the next chunk
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+
+def iter_document(chunks):
+    """Yields (key, item) for items of top-level arrays of a JSON object.
+
+    Other top-level values are yielded whole. Only one item is held in
+    memory at a time.
+    """
+    reader = _Reader(iter(chunks))
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if reader.peek() == '[':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield key, reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            yield key, reader.value()
+        if reader.expect(',}') == '}':
+            break
+
+
+def iter_lines(chunks):
+    """Yields (key, item) for newline-delimited JSON rows.
+
+    A row is {"role": name[, "parents": [...]]}, {"privilege": name}
+    or {"role": name, "privilege": name, "allow": bool}.
+    """
+    decoder = JSONDecoder()
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            for item in _parse_line(decoder, line):
+                yield item
+    for item in _parse_line(decoder, rest):
+        yield item
+
+
+def _parse_line(decoder, line):
+    line = line.strip()
+    if not line:
+        return
+    row = decoder.decode(line)
+    if 'role' in row and 'privilege' in row:
+        yield 'acl', row
+    elif 'role' in row:
+        yield 'roles', [row['role'], row.get('parents')]
+    elif 'privilege' in row:
+        yield 'privileges', row['privilege']
+    else:
+        raise ValueError('Unknown row: {0!r}'.format(line))
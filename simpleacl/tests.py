@@ -1,4 +1,13 @@
 from __future__ import absolute_import, unicode_literals
+import functools
+import io
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 if __name__ == '__main__':
@@ -9,15 +18,30 @@ if __name__ == '__main__':
     ))
 
 import simpleacl
+from simpleacl import instrument
+from simpleacl.bitset import BitsetBackend
+try:
+    from simpleacl.tests_aio import TestAsyncAcl
+except (ImportError, SyntaxError):  # Python < 3.5
+    pass
+from simpleacl.generation import SharedGeneration
+from simpleacl.kv import KVBackend, MemoryKVClient, MemoryKVServer
+from simpleacl.middleware import AclMiddleware, LazyAcl
+from simpleacl.sharded import ShardedBackend
+from simpleacl.snapshot import load_snapshot
+from simpleacl.sqlite import SqliteBackend
 from simpleacl.exceptions import MissingRole, MissingPrivilege,\
-    MissingActiveRole
+    MissingActiveRole, CyclicRoleHierarchy, CyclicContextHierarchy,\
+    ReadOnlyBackend
 from simpleacl import json
 
 
 class TestSimpleAcl(unittest.TestCase):
 
+    backend_class = None
+
     def setUp(self):
-        self.acl = simpleacl.Acl()
+        self.acl = simpleacl.Acl(backend_class=self.backend_class)
 
     def tearDown(self):
         self.acl = None
@@ -175,5 +199,1639 @@ class TestSimpleAcl(unittest.TestCase):
         acl = simpleacl.Acl.create_instance(test_json)
         self.assertTrue(isinstance(acl, simpleacl.Acl))
 
+
+class TestDecisionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.acl = simpleacl.Acl(cache_size=2)
+        self.acl.add_role('role1')
+        self.acl.add_role('role2', parents=('role1', ))
+        self.acl.add_privilege('r1')
+        self.acl.add_privilege('r2')
+        self.acl.allow('role1', 'r1')
+
+    def test_repeated_checks_hit_cache(self):
+        self.acl.active_role_is('role2')
+        self.assertTrue(self.acl.is_allowed('r1'))
+        self.assertTrue(self.acl.is_allowed('r1'))
+        self.assertFalse(self.acl.is_allowed('r2'))
+        self.assertEqual(self.acl.cache_info()[:2], (1, 2))
+
+    def test_rule_changes_invalidate(self):
+        self.acl.active_role_is('role2')
+        self.assertTrue(self.acl.is_allowed('r1'))
+        self.acl.deny('role2', 'r1')
+        self.assertFalse(self.acl.is_allowed('r1'))
+        self.acl.remove_deny('role2', 'r1')
+        self.assertTrue(self.acl.is_allowed('r1'))
+
+    def test_parent_changes_invalidate(self):
+        self.acl.active_role_is('role2')
+        self.assertTrue(self.acl.is_allowed('r1'))
+        self.acl.get_role('role2').remove_parent('role1')
+        self.assertFalse(self.acl.is_allowed('r1'))
+        self.acl.get_role('role2').add_parent('role1')
+        self.assertTrue(self.acl.is_allowed('r1'))
+
+    def test_changes_during_lookup_are_not_cached(self):
+        resolve = self.acl._resolve
+
+        def racing(role, privilege, context):
+            allow = resolve(role, privilege, context)
+            del self.acl._resolve
+            self.acl.deny('role2', 'r1')  # Committed by another thread
+            return allow
+        self.acl._resolve = racing
+        self.acl.active_role_is('role2')
+        self.assertTrue(self.acl.is_allowed('r1'))
+        self.assertFalse(self.acl.is_allowed('r1'))
+        self.assertFalse(self.acl.is_allowed('r1'))
+
+    def test_known_roles_do_not_invalidate(self):
+        self.acl.active_role_is('role2')
+        self.assertTrue(self.acl.is_allowed('r1'))
+        self.acl.add_role('role2', parents=('role1', ))
+        self.assertTrue(self.acl.is_allowed('r1'))
+        self.assertEqual(self.acl.cache_info()[:2], (1, 1))
+        self.acl.add_role('role3')
+        self.assertTrue(self.acl.is_allowed('r1'))
+        self.assertEqual(self.acl.cache_info()[:2], (1, 2))
+
+    def test_lru_is_bounded(self):
+        self.acl.active_role_is('role1')
+        self.acl.is_allowed('r1')
+        self.acl.is_allowed('r2')
+        self.acl.is_allowed('all')
+        self.assertEqual(self.acl.cache_info().currsize, 2)
+
+    def test_active_role_is_kept(self):
+        self.acl.active_role_is('role2')
+        self.acl.is_allowed('r1')
+        self.assertEqual(self.acl.active_role.get_name(), 'role2')
+
+    def test_disabled_by_default(self):
+        self.assertTrue(simpleacl.Acl().cache_info() is None)
+
+
+class TestStatelessCheck(unittest.TestCase):
+
+    def setUp(self):
+        self.acl = simpleacl.Acl()
+        self.acl.add_role('member')
+        self.acl.add_role('admin', parents=('member', ))
+        self.acl.add_privilege('view')
+        self.acl.add_privilege('edit')
+        self.acl.allow('member', 'view')
+        self.acl.allow('admin', 'edit')
+
+    def test_check_does_not_need_active_role(self):
+        self.assertTrue(self.acl.check('admin', 'view'))
+        self.assertFalse(self.acl.check('member', 'edit'))
+        self.assertTrue(self.acl.active_role is None)
+
+    def test_check_keeps_active_role(self):
+        self.acl.active_role_is('admin')
+        self.acl.check('member', 'view')
+        self.assertTrue(self.acl.is_allowed('view'))
+        self.assertEqual(self.acl.active_role.get_name(), 'admin')
+
+    def test_as_role(self):
+        self.acl.active_role_is('member')
+        with self.acl.as_role('admin') as acl:
+            self.assertTrue(acl.is_allowed('edit'))
+        self.assertFalse(self.acl.is_allowed('edit'))
+        self.acl.clear_active_role()
+        self.assertTrue(self.acl.active_role is None)
+
+    def test_active_role_is_thread_local(self):
+        self.acl.active_role_is('admin')
+        seen = []
+
+        def worker():
+            seen.append(self.acl.active_role)
+            self.acl.active_role_is('member')
+            seen.append(self.acl.is_allowed('edit'))
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [None, False])
+        self.assertTrue(self.acl.is_allowed('edit'))
+
+
+class TestRoleAncestors(unittest.TestCase):
+
+    def setUp(self):
+        self.acl = simpleacl.Acl()
+        self.acl.add_role('base')
+        self.acl.add_role('left', parents=('base', ))
+        self.acl.add_role('right', parents=('base', ))
+        self.acl.add_role('left.child', parents=('right', ))
+
+    def names(self, role):
+        return [r.get_name() for r in self.acl.get_role(role).get_ancestors()]
+
+    def test_diamond_is_linearized_once(self):
+        self.assertEqual(
+            self.names('left.child'), ['left.child', 'right', 'base', 'left']
+        )
+
+    def test_add_role_returns_stored_instance(self):
+        self.assertTrue(
+            self.acl.add_role('base') is self.acl.get_role('base')
+        )
+
+    def test_add_privilege_returns_stored_instance(self):
+        view = self.acl.add_privilege('view')
+        self.assertTrue(self.acl.add_privilege('view') is view)
+        self.assertTrue(
+            self.acl.add_privilege(simpleacl.Privilege('view')) is view
+        )
+        self.assertTrue(
+            self.acl.get_privilege(simpleacl.Privilege('view')) is view
+        )
+
+    def test_get_role_returns_stored_instance(self):
+        base = self.acl.get_role('base')
+        self.assertTrue(self.acl.get_role(simpleacl.Role('base')) is base)
+        self.assertTrue(self.acl.add_role(simpleacl.Role('base')) is base)
+
+    def test_compact_instances(self):
+        role = self.acl.get_role('base')
+        self.assertFalse(hasattr(role, '__dict__'))
+        self.assertFalse(hasattr(simpleacl.Privilege('view'), '__dict__'))
+        self.assertEqual(role, 'base')
+        self.assertEqual(role, simpleacl.Role('base'))
+        self.assertNotEqual(role, 'left')
+        self.assertEqual(hash(role), hash('base'))
+        context = simpleacl.Context(['unhashable'])
+        self.assertEqual(context, simpleacl.Context(['unhashable']))
+        self.assertRaises(TypeError, hash, context)
+        self.acl.add_privilege('view')
+        self.assertRaises(TypeError, self.acl.check, 'base', 'view', context)
+
+    def test_ancestors_follow_changes(self):
+        self.names('left.child')
+        self.acl.add_role('top')
+        self.acl.get_role('base').add_parent('top')
+        self.assertEqual(self.names('left.child')[-2:], ['top', 'left'])
+        self.acl.get_role('left.child').remove_parent('right')
+        self.assertEqual(self.names('left.child'), ['left.child', 'left',
+                                                    'base', 'top'])
+
+    def test_cycles_are_rejected(self):
+        self.assertRaises(
+            CyclicRoleHierarchy,
+            self.acl.get_role('base').add_parent,
+            'left.child'
+        )
+        self.assertEqual(self.names('base'), ['base'])
+
+    def test_inherited_rules(self):
+        self.acl.add_privilege('view')
+        self.acl.deny('right', 'view')
+        self.acl.allow('base', 'view')
+        self.assertFalse(self.acl.check('left.child', 'view'))
+        self.assertTrue(self.acl.check('left', 'view'))
+
+
+class TestContextHierarchy(unittest.TestCase):
+
+    def setUp(self):
+        self.acl = simpleacl.Acl()
+        self.acl.add_role('member')
+        self.acl.add_privilege('view')
+        self.org = simpleacl.Context('org')
+        self.project = simpleacl.Context('project', parents=[self.org])
+        self.folder = simpleacl.Context('folder', parents=[self.project])
+        self.document = simpleacl.Context('document', parents=[self.folder])
+
+    def test_parents_are_per_instance(self):
+        self.assertEqual(self.org.get_parents(), [])
+        self.assertEqual(self.document.get_parents(), [self.folder])
+        self.assertEqual(simpleacl.Context('other').get_parents(), [])
+
+    def test_nested_rules(self):
+        self.acl.allow('member', 'view', self.org)
+        self.acl.deny('member', 'view', self.folder)
+        self.assertTrue(self.acl.check('member', 'view', self.project))
+        self.assertFalse(self.acl.check('member', 'view', self.document))
+        self.assertFalse(self.acl.check('member', 'view', 'other'))
+
+    def test_ancestors_follow_changes(self):
+        self.assertEqual(
+            self.document.get_ancestors(),
+            (self.document, self.folder, self.project, self.org)
+        )
+        shared = simpleacl.Context('shared')
+        self.folder.add_parent(shared)
+        self.assertEqual(self.document.get_ancestors()[-1], shared)
+        self.folder.remove_parent(self.project)
+        self.assertEqual(self.document.get_ancestors(),
+                         (self.document, self.folder, shared))
+
+    def test_changes_invalidate_descendants_only(self):
+        other = simpleacl.Context('other')
+        self.assertEqual(other.get_ancestors(), (other, ))
+        self.document.get_ancestors()
+        self.project.add_parent(simpleacl.Context('shared'))
+        self.assertTrue(other._ancestors is not None)
+        self.assertTrue(self.document._ancestors is None)
+        self.assertEqual(self.document.get_ancestors()[-1], 'shared')
+
+    def test_cached_decisions_follow_changes(self):
+        acl = simpleacl.Acl(cache_size=10)
+        acl.add_role('member')
+        acl.add_privilege('view')
+        acl.allow('member', 'view', self.org)
+        self.assertTrue(acl.check('member', 'view', self.document))
+        self.assertFalse(acl.check('member', 'view', 'document'))
+        for i in range(3):  # New leaf contexts do not drop the cache
+            self.assertTrue(acl.check('member', 'view', simpleacl.Context(
+                'doc{0}'.format(i), [self.folder]
+            )))
+        self.assertTrue(acl.check('member', 'view', self.document))
+        self.assertEqual(acl.cache_info().hits, 1)
+        self.folder.remove_parent(self.project)
+        self.assertFalse(acl.check('member', 'view', self.document))
+
+    def test_cycles_are_rejected(self):
+        self.assertRaises(CyclicContextHierarchy, self.org.add_parent,
+                          self.document)
+        self.assertRaises(CyclicContextHierarchy, self.org.add_parent,
+                          self.org)
+        self.assertEqual(self.org.get_parents(), [])
+
+    def test_instrumentation_level(self):
+        decisions = []
+        self.acl.instrumentation = instrument.Instrumentation(
+            decisions.append
+        )
+        self.acl.allow('member', 'view', self.org)
+        self.assertTrue(self.acl.check('member', 'view', self.document))
+        self.assertEqual(decisions[-1].level, instrument.CONTEXT_PARENT)
+
+
+class TestBatchCheck(unittest.TestCase):
+
+    backend_class = None
+
+    def setUp(self):
+        self.acl = simpleacl.Acl(backend_class=self.backend_class)
+        self.acl.add_role('guest')
+        self.acl.add_role('member', parents=('guest', ))
+        self.acl.add_role('member.editor')
+        self.acl.add_role('admin')
+        for name in ('view', 'edit', 'delete'):
+            self.acl.add_privilege(name)
+        self.acl.allow('guest', 'view')
+        self.acl.allow('member.editor', 'edit')
+        self.acl.deny('member', 'view', 'secret')
+        self.acl.allow('admin', 'all')
+        self.acl.deny('admin', 'delete', 'secret')
+
+    def queries(self):
+        for role in ('guest', 'member', 'member.editor', 'admin'):
+            for privilege in ('view', 'edit', 'delete', 'all'):
+                for context in (None, 'secret'):
+                    yield role, privilege, context
+
+    def test_same_answers_as_check(self):
+        queries = list(self.queries())
+        self.assertEqual(
+            self.acl.is_allowed_many(queries),
+            [self.acl.check(*query) for query in queries]
+        )
+
+    def test_find_rule_same_as_lookups(self):
+        self.acl.remove_allow('guest', 'view')
+        self.acl.allow('guest', 'view', 'public')
+        queries = list(self.queries())
+        expected = [self.acl.check(*query) for query in queries]
+        self.acl._backend.find_rule = None
+        self.assertEqual([self.acl.check(*query) for query in queries],
+                         expected)
+
+    def test_short_queries_and_undef(self):
+        self.assertEqual(
+            self.acl.is_allowed_many(
+                [('member', 'edit'), ('member', 'view')], undef=None
+            ),
+            [None, True]
+        )
+
+    def test_backend_is_called_once(self):
+        # In-memory backends are asked by find_rule(), use the batch path
+        self.acl._backend.find_rule = None
+        calls = []
+        original = self.acl._backend.is_allowed_many
+
+        def is_allowed_many(keys, undef=None):
+            calls.append(len(keys))
+            return original(keys, undef)
+
+        self.acl._backend.is_allowed_many = is_allowed_many
+        self.acl.is_allowed_many(self.queries())
+        self.assertEqual(len(calls), 1)
+
+    def test_uses_cache(self):
+        acl = simpleacl.Acl(cache_size=100)
+        acl.bulk_load({'roles': ['r'], 'privileges': ['p']})
+        acl.allow('r', 'p')
+        self.assertEqual(acl.is_allowed_many([('r', 'p')] * 2), [True, True])
+        self.assertTrue(acl.check('r', 'p'))
+        # The repeated query is answered from the cache as well
+        self.assertEqual(acl.cache_info().hits, 2)
+
+
+class TestBitsetAcl(TestSimpleAcl):
+
+    backend_class = BitsetBackend
+
+
+class TestBitsetBatchCheck(TestBatchCheck):
+
+    backend_class = BitsetBackend
+
+    def test_effective_privileges(self):
+        self.acl.add_privilege('article.edit.title')
+        self.acl.add_privilege('article.view')
+        self.acl.allow('member', 'article')
+        self.acl.deny('member', 'article.edit')
+        self.acl.allow('admin', 'article.edit.title')
+        self.acl.deny('admin', 'all', 'public')
+        privileges = [self.acl.get_privilege(name) for name in
+                      self.acl._backend._privileges]
+        for role in ('guest', 'member', 'member.editor', 'admin'):
+            for context in (None, 'secret', 'public'):
+                layers = [(ancestor, context) for ancestor in
+                          self.acl.get_role(role).get_ancestors()]
+                effective = self.acl._backend.get_effective_privileges(layers)
+                for privilege in privileges:
+                    self.assertEqual(
+                        effective.get(privilege),
+                        self.acl.check(role, privilege, context, None)
+                    )
+
+
+class TestBulkRules(unittest.TestCase):
+
+    backend_class = None
+
+    def setUp(self):
+        self.acl = simpleacl.Acl(backend_class=self.backend_class)
+        self.acl.bulk_load({'roles': ['guest', 'member'],
+                            'privileges': ['view', 'edit']})
+
+    def test_rows_of_all_shapes(self):
+        self.acl.add_rules([
+            ('guest', 'view'),
+            ('member', ['view', 'edit'], 'wiki'),
+            {'role': 'member', 'privilege': 'edit', 'context': 'wiki',
+             'allow': False},
+            {'role': 'guest', 'privileges': ['edit'], 'allow': False},
+            ('member', 'all', None, True),
+        ])
+        self.assertEqual(
+            self.acl.is_allowed_many([
+                ('guest', 'view'), ('guest', 'edit'),
+                ('member', 'view', 'wiki'), ('member', 'edit', 'wiki'),
+                ('member', 'edit'),
+            ]),
+            [True, False, True, False, True]
+        )
+
+    def test_atomic_mode(self):
+        self.assertRaises(MissingPrivilege, self.acl.add_rules, [
+            ('guest', 'view'), ('guest', 'missing'),
+        ])
+        self.assertFalse(self.acl.role_has_privilege('guest', 'view'))
+
+    def test_non_atomic_mode(self):
+        rows = [('guest', 'view')] * simpleacl.BULK_CHUNK_SIZE
+        rows.append(('nobody', 'view'))
+        self.assertRaises(MissingRole, self.acl.add_rules, rows,
+                          atomic=False)
+        self.assertTrue(self.acl.role_has_privilege('guest', 'view'))
+
+    def test_non_atomic_chunk_is_all_or_nothing(self):
+        self.assertRaises(MissingRole, self.acl.add_rules,
+                          [('guest', 'view'), ('nobody', 'view')],
+                          atomic=False)
+        self.assertFalse(self.acl.role_has_privilege('guest', 'view'))
+
+    def test_invalidates_cache(self):
+        acl = simpleacl.Acl(backend_class=self.backend_class, cache_size=10)
+        acl.bulk_load({'roles': ['guest'], 'privileges': ['view']})
+        self.assertFalse(acl.check('guest', 'view'))
+        acl.add_rules([('guest', 'view')])
+        self.assertTrue(acl.check('guest', 'view'))
+
+
+class TestBitsetBulkRules(TestBulkRules):
+
+    backend_class = BitsetBackend
+
+
+class TestSqliteBulkRules(TestBulkRules):
+
+    backend_class = SqliteBackend
+
+
+class TestEnumeration(unittest.TestCase):
+
+    backend_class = None
+
+    def setUp(self):
+        self.acl = simpleacl.Acl(backend_class=self.backend_class)
+        self.acl.add_role('guest')
+        self.acl.add_role('member', parents=('guest', ))
+        self.acl.add_role('member.editor')
+        self.acl.add_role('admin', parents=('member.editor', ))
+        self.acl.add_privilege('view')
+        self.acl.add_privilege('article.edit')
+        self.acl.add_privilege('article.delete')
+        self.acl.allow('guest', 'view')
+        self.acl.allow('member.editor', 'article')
+        self.acl.deny('member.editor', 'article.delete')
+        self.acl.deny('member', 'view', 'secret')
+        self.acl.allow('admin', 'all', 'secret')
+        self.contexts = (None, 'secret', 'other')
+
+    def names(self, items):
+        return [item.get_name() for item in items]
+
+    def test_effective_privileges(self):
+        self.assertEqual(
+            self.names(self.acl.effective_privileges('member.editor')),
+            ['article', 'article.edit', 'view']
+        )
+        self.assertEqual(
+            self.names(self.acl.effective_privileges('member', 'secret')),
+            []
+        )
+        self.assertEqual(
+            self.names(self.acl.effective_privileges('admin', 'secret')),
+            ['all', 'article', 'article.delete', 'article.edit', 'view']
+        )
+
+    def test_roles_with_privilege(self):
+        self.assertEqual(self.names(self.acl.roles_with_privilege('view')),
+                         ['admin', 'guest', 'member', 'member.editor'])
+        self.assertEqual(
+            self.names(self.acl.roles_with_privilege('view', 'secret')),
+            ['admin']
+        )
+        self.assertEqual(
+            self.names(self.acl.roles_with_privilege('article.delete',
+                                                     'secret')),
+            ['admin']
+        )
+
+    def test_same_as_check(self):
+        roles = ('guest', 'member', 'member.editor', 'admin')
+        privileges = ('view', 'all', 'article', 'article.edit',
+                      'article.delete')
+        for context in self.contexts:
+            for role in roles:
+                self.assertEqual(
+                    self.names(self.acl.effective_privileges(role, context)),
+                    sorted(privilege for privilege in privileges
+                           if self.acl.check(role, privilege, context))
+                )
+            for privilege in privileges:
+                self.assertEqual(
+                    self.names(self.acl.roles_with_privilege(privilege,
+                                                             context)),
+                    sorted(role for role in roles
+                           if self.acl.check(role, privilege, context))
+                )
+
+    def test_follows_changes(self):
+        self.acl.remove_rule('guest', 'view')
+        self.assertEqual(self.acl.roles_with_privilege('view'), [])
+        self.acl.add_role('visitor')
+        self.acl.get_role('guest').add_parent('visitor')
+        self.acl.allow('visitor', 'view')
+        self.assertEqual(len(self.acl.roles_with_privilege('view')), 5)
+
+
+class TestBitsetEnumeration(TestEnumeration):
+
+    backend_class = BitsetBackend
+
+
+class TestSqliteEnumeration(TestEnumeration):
+
+    backend_class = SqliteBackend
+
+
+class TestWildcardPrivileges(unittest.TestCase):
+
+    backend_class = None
+
+    def setUp(self):
+        self.acl = simpleacl.Acl(backend_class=self.backend_class)
+        self.acl.add_role('member')
+        self.acl.add_privilege('article.edit.title')
+        self.acl.add_privilege('article.view')
+        self.acl.add_privilege('article.*')
+        self.acl.add_privilege('article.edit.*')
+        self.acl.allow('member', 'article.*')
+        self.acl.deny('member', 'article.edit')
+        self.acl.allow('member', 'article.edit.*', 'draft')
+        self.privileges = ('article', 'article.*', 'article.view',
+                           'article.edit', 'article.edit.*',
+                           'article.edit.title', 'all')
+
+    def names(self, items):
+        return [item.get_name() for item in items]
+
+    def test_chain(self):
+        self.assertEqual(
+            self.names(self.acl._get_privilege_chain(
+                self.acl.get_privilege('article.edit.title')
+            )),
+            ['article.edit.title', 'all', 'article.edit.*', 'article.edit',
+             'article.*', 'article']
+        )
+        self.assertEqual(
+            self.names(self.acl._get_privilege_chain(
+                self.acl.get_privilege('article.*')
+            )),
+            ['article.*', 'all', 'article']
+        )
+
+    def test_wildcard_matches_subtree(self):
+        self.assertTrue(self.acl.check('member', 'article.view'))
+        self.assertFalse(self.acl.check('member', 'article'))
+        self.assertFalse(self.acl.check('member', 'article.edit'))
+        self.assertFalse(self.acl.check('member', 'article.edit.title'))
+        self.assertFalse(self.acl.check('member', 'article.edit', 'draft'))
+        self.assertTrue(
+            self.acl.check('member', 'article.edit.title', 'draft')
+        )
+
+    def test_wildcard_added_later(self):
+        self.assertTrue(self.acl.check('member', 'article.view'))
+        self.acl.add_privilege('article.view.history')
+        self.acl.add_privilege('article.view.*')
+        self.acl.deny('member', 'article.view.*')
+        self.assertTrue(self.acl.check('member', 'article.view'))
+        self.assertFalse(self.acl.check('member', 'article.view.history'))
+
+    def test_effective_privileges(self):
+        for context in (None, 'draft'):
+            self.assertEqual(
+                self.names(self.acl.effective_privileges('member', context)),
+                sorted(privilege for privilege in self.privileges
+                       if self.acl.check('member', privilege, context))
+            )
+
+
+class TestBitsetWildcardPrivileges(TestWildcardPrivileges):
+
+    backend_class = BitsetBackend
+
+
+class TestSqliteWildcardPrivileges(TestWildcardPrivileges):
+
+    backend_class = SqliteBackend
+
+
+class TestFilterAllowed(unittest.TestCase):
+
+    backend_class = None
+
+    def setUp(self):
+        self.acl = simpleacl.Acl(backend_class=self.backend_class)
+        self.acl.add_role('guest')
+        self.acl.add_role('member', parents=('guest', ))
+        self.acl.add_privilege('view')
+        self.open = simpleacl.Context('open')
+        self.closed = simpleacl.Context('closed')
+        self.acl.allow('guest', 'view', self.open)
+        self.acl.deny('guest', 'view', self.closed)
+        self.acl.allow('member', 'view', 'doc3')
+        self.documents = [
+            {'id': 'doc{0}'.format(i),
+             'context': simpleacl.Context('doc{0}'.format(i), [
+                 self.closed if i % 3 else self.open
+             ])}
+            for i in range(10)
+        ]
+
+    def test_same_as_check(self):
+        self.acl.active_role_is('member')
+        allowed = self.acl.filter_allowed(
+            'view', self.documents, key=lambda document: document['context']
+        )
+        self.assertEqual(
+            [document['id'] for document in allowed],
+            [document['id'] for document in self.documents
+             if self.acl.check('member', 'view', document['context'])]
+        )
+        self.assertEqual(
+            list(self.acl.filter_allowed(
+                'view', [self.open, 'doc3', self.closed], role='guest'
+            )),
+            [self.open]
+        )
+
+    def test_is_lazy(self):
+        contexts = (simpleacl.Context(i, [self.open])
+                    for i in itertools.count())
+        allowed = self.acl.filter_allowed('view', contexts, role='guest')
+        self.assertEqual([context.base for context in
+                          itertools.islice(allowed, 3)], [0, 1, 2])
+
+    def test_parents_are_looked_up_once(self):
+        lookups = []
+        find_layer_rule = self.acl._find_layer_rule
+
+        def counting(ancestors, chain, context):
+            lookups.append(context)
+            return find_layer_rule(ancestors, chain, context)
+        self.acl._find_layer_rule = counting
+        list(self.acl.filter_allowed(
+            'view', [document['context'] for document in self.documents],
+            role='member'
+        ))
+        self.assertEqual(lookups.count(self.closed), 1)
+        self.assertEqual(lookups.count(self.open), 1)
+        del lookups[:]
+        list(self.acl.filter_allowed(  # Contexts built while filtering
+            'view', (simpleacl.Context(i, [self.open]) for i in range(5)),
+            role='member'
+        ))
+        self.assertEqual(lookups.count(self.open), 1)
+
+    def test_requires_role(self):
+        self.assertRaises(MissingActiveRole, self.acl.filter_allowed,
+                          'view', [])
+
+
+class TestBitsetFilterAllowed(TestFilterAllowed):
+
+    backend_class = BitsetBackend
+
+
+class TestSqliteFilterAllowed(TestFilterAllowed):
+
+    backend_class = SqliteBackend
+
+
+class TestEdit(unittest.TestCase):
+
+    backend_class = None
+
+    def setUp(self):
+        self.acl = simpleacl.Acl(backend_class=self.backend_class,
+                                 cache_size=10)
+        self.acl.bulk_load({'roles': ['guest', 'member'],
+                            'privileges': ['view', 'edit']})
+        self.acl.allow('guest', 'view')
+        self.acl.allow('member', 'view', 'wiki')
+
+    def test_changes_are_published_on_exit(self):
+        with self.acl.edit() as draft:
+            draft.deny('guest', 'view')
+            draft.allow('member', 'edit', 'wiki')
+            self.assertTrue(self.acl.check('guest', 'view'))
+            self.assertFalse(self.acl.check('member', 'edit', 'wiki'))
+        self.assertFalse(self.acl.check('guest', 'view'))
+        self.assertTrue(self.acl.check('member', 'edit', 'wiki'))
+        self.assertTrue(self.acl.check('member', 'view', 'wiki'))
+
+    def test_changes_are_dropped_on_error(self):
+        try:
+            with self.acl.edit() as draft:
+                draft.deny('guest', 'view')
+                draft.allow('guest', 'missing')
+        except MissingPrivilege:
+            pass
+        self.assertTrue(self.acl.check('guest', 'view'))
+        self.assertFalse(self.acl._draft)
+        thread = threading.Thread(target=self.acl.allow,
+                                  args=('guest', 'edit'))
+        thread.start()
+        thread.join(5)
+        self.assertTrue(self.acl.check('guest', 'edit'))
+
+    def test_nested_edits(self):
+        with self.acl.edit() as draft:
+            with draft.edit() as inner:
+                inner.deny('guest', 'view')
+            with self.acl.edit() as other:
+                other.allow('guest', 'edit')
+        self.assertFalse(self.acl.check('guest', 'view'))
+        self.assertTrue(self.acl.check('guest', 'edit'))
+
+    def test_writes_during_edit_are_kept(self):
+        with self.acl.edit() as draft:
+            draft.deny('guest', 'view')
+            self.acl.allow('guest', 'edit')
+            thread = threading.Thread(target=self.acl.add_rules,
+                                      args=([('member', 'edit', 'wiki')], ))
+            thread.start()
+            thread.join(0.05)
+            self.assertTrue(thread.is_alive())  # Waits for the edit
+        thread.join(5)
+        self.assertFalse(self.acl.check('guest', 'view'))
+        self.assertTrue(self.acl.check('guest', 'edit'))
+        self.assertTrue(self.acl.check('member', 'edit', 'wiki'))
+
+    def test_roles_are_shared(self):
+        with self.acl.edit() as draft:
+            draft.add_role('admin', parents=['member'])
+            draft.allow('admin', 'edit')
+        self.assertTrue(self.acl.get_role('admin').acl is self.acl)
+        self.assertTrue(self.acl.check('admin', 'view', 'wiki'))
+        self.assertTrue(self.acl.check('admin', 'edit'))
+
+
+class TestCopyOnWriteEdit(TestEdit):
+
+    def test_draft_sees_changes(self):
+        with self.acl.edit() as draft:
+            draft.remove_allow('guest', 'view')
+            self.assertFalse(draft.check('guest', 'view'))
+
+    def test_readers_see_old_rules_until_swap(self):
+        backend = self.acl._backend
+        seen = []
+        with self.acl.edit() as draft:
+            draft.deny('guest', 'view')
+            draft.deny('member', 'view', 'wiki')
+            thread = threading.Thread(target=lambda: seen.extend([
+                self.acl.check('guest', 'view'),
+                self.acl.check('member', 'view', 'wiki'),
+            ]))
+            thread.start()
+            thread.join()
+        self.assertEqual(seen, [True, True])
+        self.assertTrue(self.acl._backend is backend)
+        self.assertFalse(backend.is_allowed(self.acl.get_role('guest'),
+                                            self.acl.get_privilege('view')))
+
+    def test_copy_writes_do_not_leak_into_original(self):
+        backend = self.acl._backend
+        other = backend.copy()
+        other.add_rule(self.acl.get_role('guest'),
+                       self.acl.get_privilege('view'), allow=False)
+        other.remove_rule(self.acl.get_role('member'),
+                          self.acl.get_privilege('view'), 'wiki')
+        guest, member = self.acl.get_role('guest'), self.acl.get_role('member')
+        view = self.acl.get_privilege('view')
+        self.assertTrue(backend.is_allowed(guest, view))
+        self.assertTrue(backend.is_allowed(member, view, 'wiki'))
+        self.assertFalse(other.is_allowed(guest, view))
+        self.assertEqual(other.is_allowed(member, view, 'wiki'), None)
+
+    def test_copy_keeps_changed_contexts_only(self):
+        for i in range(100):
+            self.acl.allow('guest', 'edit', 'doc{0}'.format(i))
+        with self.acl.edit() as draft:
+            draft.deny('guest', 'edit', 'doc5')
+            self.assertEqual(list(dict.keys(draft._backend._acl)), ['doc5'])
+            self.assertEqual(len(list(draft._backend.iter_rules())), 102)
+        self.assertFalse(self.acl.check('guest', 'edit', 'doc5'))
+        self.assertTrue(self.acl.check('guest', 'edit', 'doc6'))
+
+
+class TestBitsetEdit(TestCopyOnWriteEdit):
+
+    backend_class = BitsetBackend
+
+
+class TestSqliteEdit(TestEdit):
+
+    backend_class = SqliteBackend
+
+
+class TestSqliteAcl(TestSimpleAcl):
+
+    backend_class = SqliteBackend
+
+
+class TestSqliteBatchCheck(TestBatchCheck):
+
+    backend_class = SqliteBackend
+
+
+class TestKVAcl(TestSimpleAcl):
+
+    backend_class = KVBackend
+
+
+class TestKVBatchCheck(TestBatchCheck):
+
+    backend_class = KVBackend
+
+
+class TestKVEnumeration(TestEnumeration):
+
+    backend_class = KVBackend
+
+
+class TestKVEdit(TestEdit):
+
+    backend_class = KVBackend
+
+
+class TestKVBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MemoryKVServer()
+        self.client = MemoryKVClient(self.server)
+        self.acl = self.create(self.client)
+        self.acl.add_role('guest')
+        self.acl.add_role('member', parents=('guest', ))
+        self.acl.add_role('member.editor')
+        self.acl.add_privilege('article.edit')
+        self.acl.allow('guest', 'article')
+        self.acl.deny('member', 'article.edit', 'archive')
+
+    def create(self, client, **kwargs):
+        return simpleacl.Acl(backend_class=functools.partial(
+            KVBackend, client, **kwargs
+        ))
+
+    def test_policy_is_shared(self):
+        acl = self.create(MemoryKVClient(self.server))
+        self.assertTrue(acl.check('member.editor', 'article.edit'))
+        self.assertFalse(acl.check('member.editor', 'article.edit',
+                                   'archive'))
+        self.assertEqual(
+            [role.get_name() for role in
+             acl.get_role('member.editor').get_ancestors()],
+            ['member.editor', 'member', 'guest']
+        )
+        self.assertEqual(len(list(acl._backend.iter_rules())), 2)
+
+    def test_one_round_trip_per_check(self):
+        self.acl.check('member.editor', 'article.edit', 'archive')
+        trips = self.client.round_trips
+        self.acl.clear_cache()
+        self.acl._backend.clear_cache()
+        self.assertFalse(self.acl.check('member.editor', 'article.edit',
+                                        'archive'))
+        self.assertEqual(self.client.round_trips, trips + 1)
+        self.assertFalse(self.acl.check('member.editor', 'article.edit',
+                                        'archive'))
+        self.assertEqual(self.client.round_trips, trips + 1)
+
+    def test_changes_invalidate_other_caches(self):
+        other = self.create(MemoryKVClient(self.server), ttl=3600)
+        self.assertTrue(other.check('member', 'article.edit'))
+        self.acl.deny('member', 'article')
+        self.assertFalse(other.check('member', 'article.edit'))
+        with self.acl.edit() as draft:
+            draft.remove_deny('member', 'article')
+        self.assertTrue(other.check('member', 'article.edit'))
+
+    def test_parent_changes_reach_other_processes(self):
+        other = self.create(MemoryKVClient(self.server), ttl=3600)
+        self.acl.add_role('admin')
+        self.acl.allow('admin', 'all')
+        self.assertFalse(other.check('member.editor', 'all'))
+        self.acl.get_role('member').add_parent('admin')
+        self.assertTrue(other.check('member.editor', 'all'))
+        with self.acl.edit():
+            self.acl.get_role('member').remove_parent('admin')
+        self.assertFalse(other.check('member.editor', 'all'))
+        self.assertEqual(other.get_role('member').get_parents(), ['guest'])
+
+    def test_cache_expires(self):
+        client = MemoryKVClient(self.server)
+        other = self.create(client, ttl=0)
+        self.assertTrue(other.check('guest', 'article'))
+        trips = client.round_trips
+        self.assertTrue(other.check('guest', 'article'))
+        self.assertEqual(client.round_trips, trips + 1)
+
+
+class TestSqliteBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend_class = functools.partial(
+            SqliteBackend, os.path.join(self.directory, 'acl.db')
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_policy_is_persistent(self):
+        acl = simpleacl.Acl(backend_class=self.backend_class)
+        acl.add_role('guest')
+        acl.add_role('member', parents=('guest', ))
+        acl.add_role('member.editor')
+        acl.add_privilege('view')
+        with acl._backend.batch():
+            acl.allow('guest', 'view')
+            acl.deny('member', 'view', 'secret')
+
+        acl = simpleacl.Acl(backend_class=self.backend_class)
+        self.assertTrue(acl.check('member.editor', 'view'))
+        self.assertFalse(acl.check('member.editor', 'view', 'secret'))
+        self.assertEqual(
+            [role.get_name() for role in
+             acl.get_role('member.editor').get_ancestors()],
+            ['member.editor', 'member', 'guest']
+        )
+
+    def test_wildcards_are_persistent(self):
+        acl = simpleacl.Acl(backend_class=self.backend_class)
+        acl.add_role('member')
+        acl.add_privilege('article.view')
+        acl.add_privilege('article.*')
+        acl.allow('member', 'article.*')
+
+        acl = simpleacl.Acl(backend_class=self.backend_class)
+        self.assertTrue(acl.check('member', 'article.view'))
+        self.assertFalse(acl.check('member', 'article'))
+
+    def test_threads_use_own_connections(self):
+        acl = simpleacl.Acl(backend_class=self.backend_class)
+        acl.add_role('guest')
+        acl.add_privilege('view')
+        acl.allow('guest', 'view')
+        connections = [acl._backend._connection()]
+        results = []
+
+        def worker():
+            acl._backend.clear_cache()
+            results.append(acl.check('guest', 'view'))
+            connections.append(acl._backend._connection())
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [True])
+        self.assertTrue(connections[0] is not connections[1])
+
+    def test_lookups_are_cached(self):
+        acl = simpleacl.Acl(backend_class=self.backend_class)
+        acl.add_role('guest')
+        acl.add_privilege('view')
+        self.assertFalse(acl.check('guest', 'view'))
+        acl._backend._local.connection = None  # Would fail on a query
+        self.assertFalse(acl.check('guest', 'view'))
+        acl._backend._local.connection = acl._backend._connect()
+        acl.allow('guest', 'view')
+        self.assertTrue(acl.check('guest', 'view'))
+
+    def test_writes_during_lookups_are_not_hidden(self):
+        acl = simpleacl.Acl(backend_class=self.backend_class)
+        acl.add_role('guest')
+        acl.add_privilege('view')
+        acl.allow('guest', 'view')
+        backend = acl._backend
+        execute = backend._execute
+
+        def racing(sql, params=()):
+            rows = execute(sql, params)
+            del backend._execute
+            acl.deny('guest', 'view')  # Committed by another thread
+            return rows
+        backend._execute = racing
+        self.assertTrue(acl.check('guest', 'view'))
+        self.assertFalse(acl.check('guest', 'view'))
+        self.assertFalse(acl.check('guest', 'view'))
+
+    def test_memory_database_is_shared_by_threads(self):
+        acl = simpleacl.Acl(
+            backend_class=functools.partial(SqliteBackend, ':memory:')
+        )
+        acl.add_role('guest')
+        acl.add_privilege('view')
+        results = []
+
+        def worker(i):
+            acl.add_privilege('p{0}'.format(i))
+            acl.allow('guest', 'p{0}'.format(i))
+            results.append(acl.check('guest', 'p{0}'.format(i)))
+        threads = [threading.Thread(target=worker, args=(i, ))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 8)
+        self.assertEqual(len(list(acl._backend.iter_rules())), 8)
+
+
+class TestShardedBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = {
+            '': [('guest', 'view', '', True)],
+            'doc1': [('member', 'edit', 'doc1', True)],
+            'doc2': [('member', 'view', 'doc2', False)],
+            'doc3': [('member', 'edit', 'doc3', True),
+                     ('guest', 'edit', 'doc3', False)],
+        }
+        self.loads = []
+        self.acl = self.create()
+
+    def loader(self, shard):
+        self.loads.append(shard)
+        return self.rows.get(shard, ())
+
+    def create(self, **kwargs):
+        acl = simpleacl.Acl(backend_class=functools.partial(
+            ShardedBackend, self.loader, **kwargs
+        ))
+        acl.add_role('guest')
+        acl.add_role('member', parents=('guest', ))
+        acl.add_privilege('view')
+        acl.add_privilege('edit')
+        return acl
+
+    def test_loads_on_first_use(self):
+        self.assertEqual(self.loads, [])
+        self.assertTrue(self.acl.check('member', 'edit', 'doc1'))
+        self.assertTrue(self.acl.check('member', 'view'))
+        self.assertFalse(self.acl.check('member', 'view', 'doc2'))
+        self.assertFalse(self.acl.check('member', 'view', 'doc1'))
+        self.assertEqual(self.loads, ['doc1', '', 'doc2'])
+        self.assertEqual(self.acl._backend.shard_info()[:2], (1, 3))
+
+    def test_evicts_least_recently_used(self):
+        acl = self.create(max_shards=2)
+        self.assertTrue(acl.check('member', 'edit', 'doc1'))
+        self.assertFalse(acl.check('member', 'view', 'doc2'))
+        self.assertTrue(acl.check('member', 'edit', 'doc1'))
+        self.assertFalse(acl.check('guest', 'edit', 'doc3'))
+        self.assertEqual(acl._backend.shard_info().shards, 2)
+        self.assertTrue(acl.check('member', 'edit', 'doc1'))
+        self.assertFalse(acl.check('member', 'view', 'doc2'))
+        self.assertEqual(self.loads, ['doc1', 'doc2', 'doc3', 'doc2'])
+        self.assertEqual(acl._backend.shard_info().evictions, 2)
+
+    def test_rule_limit(self):
+        acl = self.create(max_rules=2)
+        for context in ('doc1', 'doc2', 'doc3', 'doc1'):
+            self.assertEqual(
+                acl.check('guest', 'edit', context, None),
+                self.acl.check('guest', 'edit', context, None)
+            )
+        self.assertLessEqual(acl._backend.shard_info().rules, 3)
+
+    def test_tenant_shards(self):
+        self.rows['acme'] = [('member', 'edit', 'acme:1', True),
+                             ('member', 'edit', 'acme:2', False)]
+        acl = self.create(shard_key=lambda context: (
+            simpleacl.get_context_key(context).split(':')[0]
+        ))
+        self.assertTrue(acl.check('member', 'edit', 'acme:1'))
+        self.assertFalse(acl.check('member', 'edit', 'acme:2'))
+        self.assertEqual(self.loads, ['acme'])
+
+    def test_contexts_match_their_keys(self):
+        class Document(object):
+            def __init__(self, id):
+                self.id = id
+
+            def __str__(self):
+                return 'doc{0}'.format(self.id)
+
+        self.rows['5'] = [('member', 'edit', 5, True)]
+        self.assertTrue(self.acl.check('member', 'edit', 5))
+        self.assertTrue(self.acl.check('member', 'edit',
+                                       simpleacl.Context(5)))
+        self.assertTrue(self.acl.check('member', 'edit', Document(1)))
+        self.assertFalse(self.acl.check('guest', 'edit', Document(3)))
+        self.acl.deny('member', 'edit', simpleacl.Context(Document(1)))
+        self.assertFalse(self.acl.check('member', 'edit', 'doc1'))
+
+    def test_changed_shards_stay(self):
+        acl = self.create(max_shards=1)
+        acl.allow('member', 'view', 'doc2')
+        self.assertTrue(acl.check('member', 'edit', 'doc1'))
+        self.assertTrue(acl.check('member', 'view', 'doc2'))
+        self.assertEqual(self.loads.count('doc2'), 1)
+        acl._backend.invalidate('doc2')
+        self.assertFalse(acl.check('member', 'view', 'doc2'))
+
+    def test_removal_lowers_resident_rules(self):
+        self.assertFalse(self.acl.check('guest', 'edit', 'doc3'))
+        self.assertEqual(self.acl._backend.shard_info().rules, 2)
+        self.acl.remove_rule('guest', 'edit', 'doc3', allow=True)
+        self.acl.remove_rule('guest', 'edit', 'doc3', allow=False)
+        self.acl.allow('member', 'edit', 'doc3')
+        self.assertEqual(self.acl._backend.shard_info().rules, 1)
+
+    def writer(self, shard, added, removed):
+        self.writes.append((shard, added, removed))
+        rows = self.rows.setdefault(shard, [])
+        for row in added + removed:
+            rows[:] = [item for item in rows if item[:3] != row[:3]]
+        rows.extend(added)
+
+    def test_writer(self):
+        self.writes = []
+        acl = self.create(max_shards=1, writer=self.writer)
+        acl.allow('member', 'view', 'doc2')
+        acl.remove_rule('member', 'edit', 'doc1')
+        self.assertEqual(self.writes, [
+            ('doc2', [('member', 'view', 'doc2', True)], []),
+            ('doc1', [], [('member', 'edit', 'doc1', True)]),
+        ])
+        self.assertEqual(acl._backend.shard_info().shards, 1)
+        self.assertTrue(acl.check('member', 'view', 'doc2'))
+        self.assertFalse(acl.check('member', 'edit', 'doc1'))
+        self.assertEqual(self.loads, ['doc2', 'doc1', 'doc2', 'doc1'])
+        acl.add_rules([('guest', 'view', 'doc3'), ('guest', 'edit', 'doc3')])
+        self.assertEqual(acl._backend.shard_info()[3:], (1, 3))
+
+    def test_edit_with_writer(self):
+        self.writes = []
+        acl = self.create(writer=self.writer)
+        with acl.edit() as draft:
+            draft.allow('member', 'view', 'doc2')
+            self.assertEqual(self.writes, [])
+        self.assertEqual(len(self.writes), 1)
+        acl._backend.invalidate()
+        self.assertTrue(acl.check('member', 'view', 'doc2'))
+
+    def test_edit(self):
+        acl = self.create(max_shards=2)
+        self.assertTrue(acl.check('member', 'edit', 'doc1'))
+        with acl.edit() as draft:
+            draft.deny('member', 'edit', 'doc3')
+            draft.allow('member', 'view', 'doc2')
+            self.assertFalse(draft.check('member', 'edit', 'doc3'))
+            self.assertFalse(acl.check('member', 'view', 'doc2'))
+            acl._backend.invalidate()  # Read through again
+            self.assertTrue(draft.check('member', 'edit', 'doc1'))
+            self.assertEqual(list(draft._backend._shards), ['doc3', 'doc2'])
+        self.assertFalse(acl.check('member', 'edit', 'doc3'))
+        self.assertTrue(acl.check('member', 'view', 'doc2'))
+        self.assertTrue(acl.check('member', 'edit', 'doc1'))
+        self.assertEqual(self.loads.count('doc2'), 1)
+
+    def test_enumeration(self):
+        self.assertEqual(
+            [role.get_name() for role in
+             self.acl.roles_with_privilege('edit', 'doc3')],
+            ['member']
+        )
+        self.assertEqual(
+            [privilege.get_name() for privilege in
+             self.acl.effective_privileges('member', 'doc1')],
+            ['edit']
+        )
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'acl.snapshot')
+        self.acl = simpleacl.Acl()
+        self.acl.add_role('guest')
+        self.acl.add_role('member', parents=('guest', ))
+        self.acl.add_role('member.editor')
+        self.acl.add_role('admin', parents=('member.editor', 'guest'))
+        self.acl.add_privilege('article.edit')
+        self.acl.add_privilege('view')
+        self.acl.allow('guest', 'view')
+        self.acl.allow('member.editor', 'article')
+        self.acl.deny('member', 'view', 'secret')
+        self.acl.allow('admin', 'all', simpleacl.Context('secret'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_answers(self):
+        self.acl.compile_snapshot(self.path)
+        snapshot = load_snapshot(self.path)
+        for role in ('guest', 'member', 'member.editor', 'admin'):
+            for privilege in ('view', 'article', 'article.edit', 'all'):
+                for context in (None, 'secret', 'other'):
+                    self.assertEqual(
+                        snapshot.check(role, privilege, context, None),
+                        self.acl.check(role, privilege, context, None)
+                    )
+        self.assertEqual(
+            snapshot.get_role('admin').get_ancestors(),
+            self.acl.get_role('admin').get_ancestors()
+        )
+
+    def test_enumeration(self):
+        self.acl.compile_snapshot(self.path)
+        snapshot = load_snapshot(self.path)
+        for context in (None, 'secret'):
+            self.assertEqual(
+                snapshot.effective_privileges('admin', context),
+                self.acl.effective_privileges('admin', context)
+            )
+            self.assertEqual(
+                snapshot.roles_with_privilege('view', context),
+                self.acl.roles_with_privilege('view', context)
+            )
+
+    def test_snapshot_is_read_only(self):
+        self.acl.compile_snapshot(self.path)
+        snapshot = load_snapshot(self.path)
+        self.assertRaises(ReadOnlyBackend, snapshot.allow, 'guest', 'all')
+        self.assertRaises(MissingRole, snapshot.get_role, 'nobody')
+
+    def test_round_trip_through_sqlite(self):
+        acl = simpleacl.Acl(backend_class=SqliteBackend)
+        acl.add_role('guest')
+        acl.add_privilege('view')
+        acl.allow('guest', 'view', 'public')
+        acl.compile_snapshot(self.path)
+        snapshot = load_snapshot(self.path)
+        self.assertTrue(snapshot.check('guest', 'view', 'public'))
+        self.assertEqual(len(list(snapshot._backend.iter_rules())), 1)
+
+
+class TestPolicyCompiler(unittest.TestCase):
+
+    def setUp(self):
+        self.acl = simpleacl.Acl()
+        self.acl.add_role('guest')
+        self.acl.add_role('user', parents=('guest', ))
+        self.acl.add_role('member', parents=('user', ))
+        self.acl.add_role('member.editor')
+        self.acl.add_role('admin', parents=('member.editor', 'guest'))
+        self.acl.add_role('robot')
+        self.acl.add_privilege('view')
+        self.acl.add_privilege('article.edit')
+        self.acl.allow('guest', 'view')
+        self.acl.allow('member', 'view')  # Repeats the grant of guest
+        self.acl.allow('member.editor', 'article')
+        self.acl.allow('admin', 'article.edit')  # Shadowed by the above
+        self.acl.deny('member', 'view', 'secret')
+        self.acl.allow('admin', 'all', 'secret')
+
+    def test_same_answers(self):
+        compiled, report = self.acl.compile()
+        for role in ('guest', 'user', 'member', 'member.editor', 'admin',
+                     'robot'):
+            for privilege in ('view', 'article', 'article.edit', 'all'):
+                for context in (None, 'secret', 'other'):
+                    self.assertEqual(
+                        compiled.check(role, privilege, context, None),
+                        self.acl.check(role, privilege, context, None)
+                    )
+
+    def test_report(self):
+        compiled, report = self.acl.compile()
+        self.assertTrue(report.ok)
+        self.assertEqual(sorted(report.redundant), [
+            ('admin', 'article.edit', None, True),
+            ('member', 'view', None, True),
+        ])
+        self.assertEqual((report.rules_before, report.rules_after), (6, 4))
+        self.assertEqual(report.flattened, [('member', 'user')])
+        self.assertEqual(
+            compiled.get_role('member').get_ancestors(), ('member', 'guest')
+        )
+        self.assertLess(report.depth_after, report.depth_before)
+        self.assertEqual(report.unreachable, ['robot'])
+
+    def test_context_chains(self):
+        acl = simpleacl.Acl()
+        acl.add_role('a')
+        acl.add_role('d', parents=('a', ))
+        acl.add_role('c', parents=('d', ))
+        acl.add_privilege('p.e.*')
+        acl.add_privilege('p.e.x')
+        acl.allow('a', 'all', 'proj')
+        acl.allow('c', 'all', 'proj')
+        acl.deny('c', 'p.e.*', 'org')
+        acl.deny('c', 'p.e.x', 'org')  # Repeated by the deny above
+        compiled, report = acl.compile()
+        self.assertEqual(report.redundant, [('c', 'p.e.x', 'org', False)])
+        document = simpleacl.Context('doc', [
+            simpleacl.Context('proj', [simpleacl.Context('org')])
+        ])
+        self.assertTrue(compiled.check('c', 'p.e.x', document))
+        self.assertFalse(compiled.check('c', 'p.e.x', 'org'))
+
+    def test_cycles(self):
+        backend = SqliteBackend()
+        acl = simpleacl.Acl(backend_class=lambda: backend)
+        acl.add_role('a')
+        acl.add_role('b', parents=('a', ))
+        backend.set_role_parents(acl.get_role('a'), [acl.get_role('b')])
+        compiled, report = acl.compile()
+        self.assertIsNone(compiled)
+        self.assertFalse(report.ok)
+        self.assertEqual(report.cycles, [['a', 'b', 'a']])
+
+
+class TestStreamingLoad(unittest.TestCase):
+
+    document = {
+        'roles': ['guest', ['member', ['guest']], {'name_or_instance': 'x'}],
+        'privileges': ['view', 'edit'],
+        'acl': [
+            {'role': 'guest', 'privilege': 'view', 'allow': True},
+            {'role': 'member', 'privilege': 'edit', 'allow': True},
+            {'role': 'member', 'privilege': 'view', 'allow': False},
+        ],
+    }
+
+    def assertLoaded(self, acl):
+        self.assertEqual(
+            acl.is_allowed_many([('guest', 'view'), ('member', 'edit'),
+                                 ('member', 'view'), ('x', 'view')]),
+            [True, True, False, False]
+        )
+
+    def test_small_chunks(self):
+        data = json.dumps(self.document).encode('utf-8')
+        chunks = [data[i:i + 3] for i in range(0, len(data), 3)]
+        reports = []
+        acl = simpleacl.Acl().bulk_load_stream(
+            chunks, batch_size=2, progress=lambda stats: reports.append(
+                (stats.rules, stats.finished, stats.bytes)
+            )
+        )
+        self.assertLoaded(acl)
+        self.assertEqual(reports, [(2, False, reports[0][2]),
+                                   (3, True, len(data))])
+
+    def test_file_object(self):
+        # Python 2's json.dumps() returns bytes
+        source = io.StringIO('{0}'.format(json.dumps(self.document,
+                                                     indent=4)))
+        self.assertLoaded(simpleacl.Acl().bulk_load_stream(source))
+
+    def test_rules_before_roles(self):
+        document = ('{{"acl": {acl}, "roles": {roles}, '
+                    '"privileges": {privileges}}}')
+        document = document.format(**dict(
+            (key, json.dumps(value)) for key, value in self.document.items()
+        ))
+        for batch_size in (1, 2, 1000):
+            self.assertLoaded(simpleacl.Acl().bulk_load_stream(
+                [document], batch_size=batch_size
+            ))
+        self.assertLoaded(simpleacl.Acl().bulk_load(json.loads(document)))
+
+    def test_missing_role(self):
+        document = json.dumps({
+            'privileges': ['view'],
+            'acl': [{'role': 'nobody', 'privilege': 'view'}],
+        })
+        self.assertRaises(MissingRole,
+                          simpleacl.Acl().bulk_load_stream, [document],
+                          batch_size=1)
+
+    def test_lines(self):
+        rows = [{'role': 'guest'}, {'role': 'member', 'parents': ['guest']},
+                {'role': 'x'}, {'privilege': 'view'}, {'privilege': 'edit'}]
+        rows.extend(self.document['acl'])
+        source = io.BytesIO('\n'.join(
+            json.dumps(row) for row in rows
+        ).encode('utf-8'))
+        self.assertLoaded(simpleacl.Acl().bulk_load_stream(source,
+                                                           lines=True))
+
+    def test_broken_document(self):
+        self.assertRaises(ValueError, simpleacl.Acl().bulk_load_stream,
+                          ['{"roles": ["guest"'])
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.acl = simpleacl.Acl()
+        self.acl.add_role('member')
+        self.acl.add_role('editor', parents=('member', ))
+        self.acl.add_role('editor.chief')
+        self.acl.add_privilege('view')
+        self.acl.add_privilege('article')
+        self.acl.add_privilege('article.edit')
+        self.acl.allow('member', 'view')
+        self.acl.allow('editor', 'article')
+        self.acl.deny('editor', 'all', 'archive')
+        self.decisions = []
+        self.instrumentation = instrument.Instrumentation(
+            self.decisions.append
+        )
+        self.acl.instrumentation = self.instrumentation
+
+    def level(self, role, privilege, context=None):
+        self.acl.check(role, privilege, context)
+        return self.decisions[-1].level
+
+    def test_levels(self):
+        self.assertEqual(self.level('member', 'view'), instrument.DIRECT)
+        self.assertEqual(self.level('editor', 'view', 'archive'),
+                         instrument.ALL)
+        self.assertEqual(self.level('editor', 'view'), instrument.ROLE_PARENT)
+        self.assertEqual(self.level('editor.chief', 'article'),
+                         instrument.DOTTED_ROLE)
+        self.assertEqual(self.level('editor', 'article.edit'),
+                         instrument.DOTTED_PRIVILEGE)
+        self.assertEqual(self.level('member', 'article'), instrument.UNDEF)
+
+    def test_decision(self):
+        self.assertTrue(self.acl.check('editor.chief', 'view'))
+        decision = self.decisions[-1]
+        self.assertEqual(decision.role.get_name(), 'editor.chief')
+        self.assertEqual(decision.depth, 2)
+        self.assertEqual(decision.backend_calls, 5)
+        self.assertTrue(decision.elapsed >= 0)
+
+    def test_stats(self):
+        self.acl.check('member', 'view')
+        self.acl.check('editor', 'view', 'archive')
+        self.acl.check('member', 'article')
+        stats = self.instrumentation.stats()
+        self.assertEqual(stats['checks'], 3)
+        self.assertEqual((stats['allowed'], stats['denied'],
+                          stats['undecided']), (1, 1, 1))
+        self.assertEqual(sum(count for bound, count in stats['latency']), 3)
+        self.instrumentation.reset()
+        self.assertEqual(self.instrumentation.stats()['checks'], 0)
+
+    def test_cached_decisions(self):
+        acl = simpleacl.Acl(cache_size=10)
+        acl.add_role('member')
+        acl.add_privilege('view')
+        acl.allow('member', 'view')
+        acl.instrumentation = self.instrumentation
+        self.assertTrue(acl.check('member', 'view'))
+        self.assertTrue(acl.check('member', 'view'))
+        self.assertEqual([d.level for d in self.decisions],
+                         [instrument.DIRECT, instrument.CACHED])
+
+    def test_disabled(self):
+        self.acl.instrumentation = None
+        self.acl.active_role_is('member')
+        self.assertTrue(self.acl.is_allowed('view'))
+        self.assertEqual(self.decisions, [])
+
+
+class AclBuilder(object):
+    """Builder for middleware tests"""
+
+    version = 1
+    builds = 0
+
+    def get_version(self):
+        return AclBuilder.version
+
+    def __call__(self):
+        AclBuilder.builds += 1
+        acl = simpleacl.Acl()
+        acl.bulk_load({'roles': ['guest'], 'privileges': ['view']})
+        if AclBuilder.version > 1:
+            acl.allow('guest', 'view')
+        return acl
+
+
+class TestAclMiddleware(unittest.TestCase):
+
+    config = {
+        'simpleacl.build.module': 'simpleacl.tests',
+        'simpleacl.build.class': 'AclBuilder',
+    }
+
+    def setUp(self):
+        AclBuilder.version = 1
+        AclBuilder.builds = 0
+
+    def app(self, environ, start_response):
+        acl = environ['simpleacl']
+        acl.active_role_is('guest')
+        return [acl.is_allowed('view')]
+
+    def test_acl_is_built_once(self):
+        middleware = AclMiddleware(self.app, self.config)
+        self.assertEqual(middleware({}, None), [False])
+        environ = {}
+        middleware(environ, None)
+        self.assertTrue(environ['simpleacl']._get_acl() is middleware.acl)
+        self.assertEqual(AclBuilder.builds, 1)
+
+    def test_lazy_build(self):
+        config = dict(self.config)
+        config['simpleacl.build.lazy'] = 'true'
+        middleware = AclMiddleware(lambda environ, start_response: [],
+                                   config)
+        environ = {}
+        middleware(environ, None)
+        self.assertEqual(AclBuilder.builds, 0)
+        self.assertTrue(isinstance(environ['simpleacl'], LazyAcl))
+        middleware.app = self.app
+        self.assertEqual(middleware({}, None), [False])
+        self.assertEqual(AclBuilder.builds, 1)
+
+    def test_proxy_memoizes_checks(self):
+        acl = AclBuilder()()
+        calls = []
+        proxy = LazyAcl(lambda: calls.append(1) or acl)
+        proxy.active_role_is('guest')
+        self.assertFalse(proxy.is_allowed('view'))
+        acl._resolve = None  # Must not be called any more
+        self.assertFalse(proxy.is_allowed('view'))
+        self.assertFalse(proxy.check('guest', 'view'))
+        self.assertEqual(calls, [1])
+        del acl._resolve
+        proxy.allow('guest', 'view')
+        self.assertTrue(proxy.is_allowed('view'))
+
+    def test_active_role_is_reset(self):
+        middleware = AclMiddleware(lambda environ, start_response: [
+            environ['simpleacl'].active_role
+        ], self.config)
+        middleware.acl.active_role_is('guest')
+        self.assertEqual(middleware({}, None), [None])
+
+    def test_reload_on_version_change(self):
+        config = dict(self.config)
+        config['simpleacl.reload.interval'] = '0.0001'
+        middleware = AclMiddleware(self.app, config)
+        AclBuilder.version = 2
+        time.sleep(0.001)
+        middleware({}, None)
+        thread = middleware._reload_thread
+        if thread is not None:
+            thread.join()
+        self.assertEqual(AclBuilder.builds, 2)
+        self.assertEqual(middleware({}, None), [True])
+        time.sleep(0.001)
+        middleware({}, None)
+        self.assertEqual(AclBuilder.builds, 2)
+
+    def test_reload_on_generation_bump(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'generation')
+        config = dict(self.config)
+        config['simpleacl.reload.generation'] = path
+        middleware = AclMiddleware(self.app, config)
+        self.assertEqual(middleware({}, None), [False])
+        AclBuilder.version = 2
+        self.assertEqual(middleware({}, None), [False])
+        self.assertEqual(AclBuilder.builds, 1)
+        SharedGeneration(path).bump()  # Another process
+        middleware({}, None)
+        thread = middleware._reload_thread
+        if thread is not None:
+            thread.join()
+        self.assertEqual(AclBuilder.builds, 2)
+        self.assertEqual(middleware({}, None), [True])
+        self.assertEqual(AclBuilder.builds, 2)
+
+    def test_failed_generation_is_not_locked_for(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'generation')
+        config = dict(self.config)
+        config['simpleacl.reload.generation'] = path
+        middleware = AclMiddleware(self.app, config)
+        middleware.builder = lambda: 1 / 0
+        SharedGeneration(path).bump()
+        logging.disable(logging.ERROR)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        middleware({}, None)
+        thread = middleware._reload_thread
+        if thread is not None:
+            thread.join()
+        self.assertEqual(middleware._failed, 1)
+        middleware._lock = None  # Must not be taken any more
+        self.assertEqual(middleware({}, None), [False])
+
+
+class TestSharedGeneration(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'generation')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_counter_is_shared(self):
+        first = SharedGeneration(self.path)
+        second = SharedGeneration(self.path)
+        self.assertEqual(first.get(), 0)
+        self.assertEqual(second.bump(), 1)
+        self.assertEqual(first.get(), 1)
+        self.assertEqual(first.bump(), 2)
+        self.assertEqual(SharedGeneration(self.path).get(), 2)
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'Requires fork()')
+    def test_counter_is_seen_by_forked_process(self):
+        generation = SharedGeneration(self.path)
+        pid = os.fork()
+        if not pid:
+            generation.bump()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(generation.get(), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
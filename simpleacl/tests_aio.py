@@ -0,0 +1,81 @@
+"""Tests of simpleacl.aio, imported by simpleacl.tests on Python 3.5+"""
+from __future__ import absolute_import, unicode_literals
+import asyncio
+import unittest
+
+from simpleacl.aio import AsyncAcl, MemoryAsyncBackend
+
+
+class TestAsyncAcl(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MemoryAsyncBackend(latency=0.001)
+        self.acl = AsyncAcl(async_backend=self.backend)
+        self.acl.bulk_load({
+            'roles': ['guest', ['member', ['guest']], 'member.editor'],
+            'privileges': ['view', 'edit'],
+        })
+
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_check_in_one_round_trip(self):
+        async def scenario():
+            await self.acl.allow_async('guest', 'view')
+            await self.acl.deny_async('member', 'view', 'secret')
+            self.backend.round_trips = 0
+            with self.acl.as_role('member.editor'):
+                result = [
+                    await self.acl.is_allowed_async('view'),
+                    await self.acl.is_allowed_async('view', 'secret'),
+                    await self.acl.is_allowed_async('edit'),
+                ]
+            return result, self.backend.round_trips
+
+        self.assertEqual(self.run_async(scenario()), ([True, False, False], 3))
+
+    def test_concurrent_checks_are_coalesced(self):
+        async def scenario():
+            await self.acl.allow_async('guest', 'view')
+            self.backend.round_trips = 0
+            results = await asyncio.gather(*[
+                self.acl.check_async('member.editor', 'view')
+                for i in range(10)
+            ])
+            return results, self.backend.round_trips
+
+        self.assertEqual(self.run_async(scenario()), ([True] * 10, 1))
+
+    def test_rules_are_changed_by_coroutines_only(self):
+        self.assertRaises(TypeError, self.acl.allow, 'guest', 'view')
+        self.assertRaises(TypeError, self.acl.edit)
+
+    def test_rules_are_read_by_coroutines_only(self):
+        self.run_async(self.acl.allow_async('guest', 'view'))
+        self.acl.active_role_is('guest')
+        for method, args in (
+                (self.acl.check, ('guest', 'view')),
+                (self.acl.is_allowed, ('view', )),
+                (self.acl.is_allowed_many, ([('guest', 'view')], )),
+                (self.acl.role_has_privilege, ('guest', 'view')),
+                (self.acl.effective_privileges, ('guest', )),
+                (self.acl.filter_allowed, ('view', [None])),
+                (self.acl.compile, ())):
+            self.assertRaises(TypeError, method, *args)
+
+    def test_cache(self):
+        acl = AsyncAcl(async_backend=self.backend, cache_size=10)
+        acl.bulk_load({'roles': ['guest'], 'privileges': ['view']})
+
+        async def scenario():
+            first = await acl.check_async('guest', 'view')
+            await acl.allow_async('guest', 'view')
+            second = await acl.check_async('guest', 'view')
+            third = await acl.check_async('guest', 'view')
+            return first, second, third, acl.cache_info().hits
+
+        self.assertEqual(self.run_async(scenario()), (False, True, True, 1))